@@ -22,6 +22,7 @@ from distributed import (
     reduce_sum,
     get_world_size,
 )
+from src.modules.transformer.mingpt_adaptive import autocast
 
 def sample_data(loader):
     while True:
@@ -74,7 +75,7 @@ parser.add_argument("--base", type=str, default="./configs/realestate/realestate
                     help="experiments name")
 parser.add_argument("--data-path", type=str, default="/latent_opt_test/RealEstate10K_Downloader/",
                     help="data path")
-parser.add_argument("--batch-size", type=int, default=1, help="the gpu only afford batch-size = 1")
+parser.add_argument("--batch-size", type=int, default=1, help="the gpu only afford batch-size = 1 in fp32, more with --precision bf16 / fp16")
 parser.add_argument("--ckpt-iter", type=int, default=5000,
                     help="interval for visual the result")
 parser.add_argument("--visual-iter", type=int, default=500,
@@ -86,6 +87,10 @@ parser.add_argument("--topk", type=int, default=3, help="")
 parser.add_argument("--T", type=float, default=1, help="")
 parser.add_argument("--sample", action='store_true')
 parser.add_argument('--gpu', default= '0,1,2,3', type=str)
+parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "fp16", "bf16"],
+                    help="autocast precision of the forward, fp16 also turns on loss scaling")
+parser.add_argument("--checkpoint-every", type=int, default=None,
+                    help="activation checkpointing every N GPT blocks (0 = off), default from the config")
 parser.add_argument(
         "--local_rank", type=int, default=0, help="local rank for distributed training"
     )
@@ -123,6 +128,8 @@ summary = SummaryWriter(log_dir=visual_dir)
 config = OmegaConf.load(args.base)
 # init model
 model = instantiate_from_config(config.model)
+if args.checkpoint_every is not None:
+    model.transformer.checkpoint_every = args.checkpoint_every
 # init optim
 base_lr = config.model.base_learning_rate
 bs = args.batch_size
@@ -130,6 +137,8 @@ model.learning_rate = accumulate_grad_batches * ngpu * bs * base_lr
 print("Setting learning rate to {:.2e} = {} (accumulate_grad_batches) * {} (num_gpus) * {} (batchsize) * {:.2e} (base_lr)".format(model.learning_rate, accumulate_grad_batches, ngpu, bs, base_lr))
 
 optimizer, scheduler = model.configure_optimizers()
+#* fp16 的 gradient 容易 underflow, 要 loss scaling; bf16 跟 fp32 的 exponent 一樣不需要
+scaler = torch.cuda.amp.GradScaler(enabled=args.precision == "fp16")
 
 # set to DDP
 model.cuda()
@@ -181,21 +190,32 @@ for idx in pbar:
     for key in batch.keys():
         batch[key] = batch[key].cuda()
     
-    if config.model.do_cross==True:
-        forecasts, gts, loss, log_dict = module.cross_forward(batch,idx)
-    else:
-        forecasts, gts, loss, log_dict = module(batch, sample = args.sample, top_k = args.topk, temperature = args.T)
+    #* 只有 forward 在 autocast 裡, 中間 decode 出來的 frame 跟 VQ encode 仍是 fp32
+    with autocast(args.precision):
+        if config.model.do_cross==True:
+            forecasts, gts, loss, log_dict = module.cross_forward(batch,idx)
+        else:
+            forecasts, gts, loss, log_dict = module(batch, sample = args.sample, top_k = args.topk, temperature = args.T)
 
     optimizer.zero_grad()
-    loss.backward()
-    optimizer.step()
+    scaler.scale(loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
     scheduler.step()
 
+    #* 這一步的 peak memory (GB), 拿來比較 checkpoint_every / batch size / precision 的組合
+    peak_mem = torch.cuda.max_memory_allocated() / 2**30
+    torch.cuda.reset_peak_memory_stats()
+
     # update tensorboard
     summary.add_scalar(tag='loss', scalar_value=loss.mean().item(), global_step=idx)
+    summary.add_scalar(tag='peak_mem_gb', scalar_value=peak_mem, global_step=idx)
     
     if get_rank() == 0:
-        pbar.set_description((f"loss: {loss:.4f};"))
+        pbar.set_description((f"loss: {loss:.4f}; mem: {peak_mem:.2f}G;"))
+        if idx == 0:
+            print("peak memory of one step: %.2f GB (batch size %d, %s, checkpoint every %d blocks)"
+                  % (peak_mem, bs, args.precision, module.transformer.checkpoint_every))
 
         if idx % args.ckpt_iter == 0:
             torch.save(module.state_dict(), os.path.join(save_dir, f"{idx}.ckpt"))
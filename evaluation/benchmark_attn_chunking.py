@@ -0,0 +1,107 @@
+import time
+import argparse
+
+import numpy as np
+import sys, importlib
+sys.path.insert(0, ".")
+
+import torch
+
+from omegaconf import OmegaConf
+
+# args
+parser = argparse.ArgumentParser(description="full-sequence GPT.test(): whole attention vs query-chunked attention")
+parser.add_argument("--base", type=str, default="./configs/realestate/realestate_16x16_sine_cview_adaptive_epipolar.yaml",
+                    help="config of the GPT (weights are random, only the shapes matter)")
+parser.add_argument("--device", type=str, default="cuda", help="cuda / cpu")
+parser.add_argument("--batch-size", type=int, default=1, help="")
+parser.add_argument("--chunks", type=str, default="256,64", help="query rows per tile")
+parser.add_argument("--memory-mb", type=str, default="16", help="attention memory ceilings (MB), the tile size follows from them")
+parser.add_argument("--repeat", type=int, default=5, help="# of timed runs, after one warmup")
+parser.add_argument("--threads", type=int, default=None, help="intra-op threads when running on cpu")
+
+args = parser.parse_args()
+
+device = torch.device(args.device)
+if device.type == "cpu" and args.threads is not None:
+    torch.set_num_threads(args.threads)
+
+def synchronize():
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+def get_obj_from_str(string, reload=False):
+    module, cls = string.rsplit(".", 1)
+    if reload:
+        module_imp = importlib.import_module(module)
+        importlib.reload(module_imp)
+    return getattr(importlib.import_module(module, package=None), cls)
+
+def instantiate_from_config(config):
+    if not "target" in config:
+        raise KeyError("Expected key `target` to instantiate.")
+    return get_obj_from_str(config["target"])(**config.get("params", dict()))
+
+#* 只需要 GPT, VQGAN 等其他部分不影響 test()
+config = OmegaConf.load(args.base)
+gpt = instantiate_from_config(config.model.params.transformer_config).to(device).eval()
+
+B = args.batch_size
+n_embd = gpt.config.n_embd
+n_head = gpt.config.n_head
+vocab_size = gpt.config.vocab_size
+T = gpt.block_size
+torch.manual_seed(0)
+#* 整個序列一次做完 (condition 572 + 最後一張 frame 的 255 個 token), 最大的 (T, T) attention
+cond = torch.randn(B, 572, n_embd, device=device)
+p = [torch.randn(B, 30, device=device) for _ in range(3)]
+maps = [(torch.rand(B, 256, 256, device=device) > 0.8).float() for _ in range(3)]
+forward_map = maps if gpt.epipolar in ("forward", "bidirectional") else None
+backward_map = maps if gpt.epipolar in ("backward", "bidirectional") else None
+tokens = torch.randint(0, vocab_size, (B, T - 572), device=device)
+
+@torch.no_grad()
+def run():
+    logits, _, _, _, ratio = gpt.test(cond, tokens, p,
+                                      forward_epipolar_map=forward_map,
+                                      backward_epipolar_map=backward_map,
+                                      inference=True)
+    return logits, ratio
+
+def timeit(chunk_size, memory_mb):
+    gpt.set_attn_chunking(chunk_size, memory_mb)
+    run()
+    times = []
+    peak = None
+    for _ in range(args.repeat):
+        synchronize()
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        out = run()
+        synchronize()
+        times.append(time.perf_counter() - start)
+        if device.type == "cuda":
+            peak = torch.cuda.max_memory_allocated() / 2**20
+    return out, np.median(times), peak
+
+print("GPT: %d blocks, n_embd %d, n_head %d, epipolar %s | batch %d, T %d on %s"
+      % (len(gpt.blocks), n_embd, n_head, gpt.epipolar, B, T, device))
+(base_logits, base_ratio), base_time, base_peak = timeit(None, None)
+#* 一個 (B, nh, T, T) fp32 的 att, 分塊後每個 tile 的大小跟 rows 成正比
+att_mb = B * n_head * T * T * 4 / 2**20
+print("whole attention   : %.2f ms, one (T, T) att %.1f MB%s"
+      % (base_time * 1e3, att_mb, "" if base_peak is None else ", peak %.1f MB" % base_peak))
+settings = [(int(c), None) for c in args.chunks.split(",") if c] + [(None, float(m)) for m in args.memory_mb.split(",") if m]
+for chunk_size, memory_mb in settings:
+    (logits, ratio), t, peak = timeit(chunk_size, memory_mb)
+    with torch.no_grad():
+        rows = gpt.blocks[0].attn.chunk_rows(B, T, T)
+    name = "chunk %d" % chunk_size if memory_mb is None else "memory %g MB" % memory_mb
+    line = ("%-18s: %.2f ms (%.2fx), %d rows per tile, att tile %.1f MB%s | max |logits - whole| %.2e"
+            % (name, t * 1e3, base_time / t, rows, att_mb * rows / T,
+               "" if peak is None else ", peak %.1f MB" % peak, (logits - base_logits).abs().max().item()))
+    if base_ratio is not None:
+        line += ", max |bi_epi_ratio - whole| %.2e" % (ratio - base_ratio).nan_to_num().abs().max().item()
+    print(line)
+gpt.set_attn_chunking(None, None)
@@ -0,0 +1,116 @@
+import time
+import argparse
+
+import sys, importlib
+sys.path.insert(0, ".")
+
+import torch
+
+from omegaconf import OmegaConf
+
+# args
+parser = argparse.ArgumentParser(description="sample_latent_candidates checks: width-1 beam vs greedy, ratio-pruned vs log-prob beams")
+parser.add_argument("--base", type=str, default="realestate_16x16_adaptive",
+                    help="experiments name")
+parser.add_argument("--exp", type=str, default="exp_1_error",
+                    help="experiments name")
+parser.add_argument("--ckpt", type=str, default="last",
+                    help="checkpoint name")
+parser.add_argument("--device", type=str, default="cuda", help="cuda / cpu")
+parser.add_argument("--video_limit", type=int, default=5, help="# of held-out videos to check")
+parser.add_argument("--n_candidates", type=int, default=4, help="beam width")
+parser.add_argument("--top_k", type=int, default=100, help="")
+
+args = parser.parse_args()
+
+device = torch.device(args.device)
+
+def synchronize():
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+# config
+config_path = "./configs/realestate/%s.yaml" % args.base
+if args.exp[-5:]=="error":
+    cpt_path = "./experiments/%s/model/%s.ckpt" % (args.exp, args.ckpt)
+else:
+    cpt_path = "./experiments/realestate/%s/model/%s.ckpt" % (args.exp, args.ckpt)
+
+# load model
+def get_obj_from_str(string, reload=False):
+    module, cls = string.rsplit(".", 1)
+    if reload:
+        module_imp = importlib.import_module(module)
+        importlib.reload(module_imp)
+    return getattr(importlib.import_module(module, package=None), cls)
+
+def instantiate_from_config(config):
+    if not "target" in config:
+        raise KeyError("Expected key `target` to instantiate.")
+    return get_obj_from_str(config["target"])(**config.get("params", dict()))
+
+config = OmegaConf.load(config_path)
+model = instantiate_from_config(config.model)
+model.load_state_dict(torch.load(cpt_path, map_location="cpu"))
+model = model.to(device).eval()
+
+# load dataloader
+from src.data.realestate.re10k_dataset import Re10k_dataset
+dataset_abs = Re10k_dataset(data_root="../dataset",mode="test",infer_len=3)
+
+test_loader_abs = torch.utils.data.DataLoader(
+        dataset_abs,
+        batch_size=1,
+        shuffle=False,
+        num_workers=0,
+    )
+
+@torch.no_grad()
+def first_window(batch):
+    """ condition of the first generated frame, same as rollout_frames """
+    R_s, t_s = batch["R_s"], batch["t_s"]
+    example = dict()
+    example["K"] = batch["K"]
+    example["K_inv"] = batch["K_inv"]
+    _, c_indices = model.encode_to_c(batch["rgbs"][:, :, 0, ...])
+    c_emb = model.transformer.tok_emb(c_indices)
+    example["R_rel"], example["t_rel"] = model.compute_camera_pose(R_s[:, 1], t_s[:, 1], R_s[:, 0], t_s[:, 0])
+    prototype = torch.cat([c_emb, model.encode_to_e(example)], 1)
+    p1 = model.encode_to_p(example)
+    return prototype, [p1, None, None], batch.get("K_ori"), batch.get("w2c_seq")
+
+def timed(fn, *args, **kwargs):
+    synchronize()
+    start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    synchronize()
+    return out, time.perf_counter() - start
+
+N = args.n_candidates
+print("%s | epipolar %s, beam width %d, top_k %d on %s" % (args.exp, model.epipolar, N, args.top_k, device))
+for i, batch in enumerate(test_loader_abs):
+    if i >= args.video_limit:
+        break
+    batch = {k: v.to(device) if torch.is_tensor(v) else v for k, v in batch.items()}
+    prototype, p, k_ori, w2c = first_window(batch)
+    x = prototype.new_zeros(1, 0, dtype=torch.long)
+    kwargs = dict(k_ori=k_ori, w2c=None if w2c is None else w2c[:, 0:3, ...], top_k=args.top_k)
+
+    #* width-1 beam 每一步都取最大的, 應該跟 greedy 的 sample_latent 一樣 (除了剛好 logit 一樣大的 token)
+    (greedy, _), greedy_time = timed(model.sample_latent, x, prototype, p, 256, sample=False, **kwargs)
+    (beam1, _, beam1_lp, _), beam1_time = timed(model.sample_latent_candidates, x, prototype, p, 256,
+                                                n_candidates=1, beam=True, **kwargs)
+    line = ("video %d | width-1 beam vs greedy: %d/256 tokens equal, log-prob %.3f (%.2f ms vs %.2f ms)"
+            % (i, (beam1[0, 0] == greedy[0]).sum().item(), beam1_lp[0, 0].item(), beam1_time * 1e3, greedy_time * 1e3))
+
+    #* 用 bi_epi_ratio 剪枝的 beam 應該留下跟 log-prob beam 不一樣的 hypothesis
+    if model.epipolar == "bidirectional":
+        (lp_x, _, lp_lp, lp_ratio), lp_time = timed(model.sample_latent_candidates, x, prototype, p, 256,
+                                                    n_candidates=N, beam=True, score="logprob", **kwargs)
+        (ratio_x, _, ratio_lp, ratio_ratio), ratio_time = timed(model.sample_latent_candidates, x, prototype, p, 256,
+                                                                n_candidates=N, beam=True, score="ratio", **kwargs)
+        differ = sum(not any(torch.equal(ratio_x[0, a], lp_x[0, b]) for b in range(N)) for a in range(N))
+        line += ("\n         ratio beam vs log-prob beam: %d/%d hypotheses differ, best mean bi_epi_ratio %.4f vs %.4f, best log-prob %.3f vs %.3f (%.2f ms vs %.2f ms)"
+                 % (differ, N, ratio_ratio[0].mean(-1).max().item(), lp_ratio[0].mean(-1).max().item(),
+                    ratio_lp[0].max().item(), lp_lp[0].max().item(), ratio_time * 1e3, lp_time * 1e3))
+    print(line)
@@ -0,0 +1,116 @@
+import time
+import argparse
+
+import numpy as np
+import sys, importlib
+sys.path.insert(0, ".")
+
+import torch
+
+from omegaconf import OmegaConf
+
+# args
+parser = argparse.ArgumentParser(description="per-token latency of the GPT decode step: dynamic KV cache vs static decode")
+parser.add_argument("--base", type=str, default="./configs/realestate/realestate_16x16_sine_cview_adaptive_epipolar.yaml",
+                    help="config of the GPT (weights are random, only the shapes matter)")
+parser.add_argument("--device", type=str, default="cuda", help="cuda / cpu")
+parser.add_argument("--batch-size", type=int, default=1, help="# of videos generated together")
+parser.add_argument("--cond", type=int, default=572, help="condition length, 286 (first frame) or 572")
+parser.add_argument("--steps", type=int, default=255, help="# of decode steps timed")
+parser.add_argument("--repeat", type=int, default=3, help="# of timed runs per mode, the first one is dropped as warmup")
+parser.add_argument("--modes", type=str, default="dynamic,static,compile,graph", help="decode modes to compare")
+parser.add_argument("--threads", type=int, default=None, help="intra-op threads when running on cpu")
+
+args = parser.parse_args()
+
+device = torch.device(args.device)
+if device.type == "cpu" and args.threads is not None:
+    torch.set_num_threads(args.threads)
+
+def synchronize():
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+def get_obj_from_str(string, reload=False):
+    module, cls = string.rsplit(".", 1)
+    if reload:
+        module_imp = importlib.import_module(module)
+        importlib.reload(module_imp)
+    return getattr(importlib.import_module(module, package=None), cls)
+
+def instantiate_from_config(config):
+    if not "target" in config:
+        raise KeyError("Expected key `target` to instantiate.")
+    return get_obj_from_str(config["target"])(**config.get("params", dict()))
+
+#* 只需要 GPT, VQGAN 等其他部分不影響 decode step
+config = OmegaConf.load(args.base)
+gpt = instantiate_from_config(config.model.params.transformer_config).to(device).eval()
+
+B = args.batch_size
+n_embd = gpt.config.n_embd
+vocab_size = gpt.config.vocab_size
+torch.manual_seed(0)
+cond = torch.randn(B, args.cond, n_embd, device=device)
+p = [torch.randn(B, 30, device=device) for _ in range(3)]
+#* 隨機的 epipolar map, 只有一部分 key 有權重 (跟真的 epipolar line 差不多稀疏)
+maps = [(torch.rand(B, 256, 256, device=device) > 0.8).float() for _ in range(3)]
+forward_map = maps if gpt.epipolar in ("forward", "bidirectional") else None
+backward_map = maps if gpt.epipolar in ("backward", "bidirectional") else None
+tokens = torch.randint(0, vocab_size, (B, args.steps), device=device)
+
+def prefill():
+    return gpt.test_with_past(cond, tokens[:, :0], p,
+                              forward_epipolar_map=forward_map,
+                              backward_epipolar_map=backward_map,
+                              positions=slice(-1, None))
+
+@torch.no_grad()
+def run(mode):
+    """ feeds the same tokens in every mode, returns the per-token latencies (s) and the logits of every step """
+    _, past, _ = prefill()
+    decoder = None
+    if mode != "dynamic":
+        decoder = gpt.static_decoder(mode, B, device)
+        decoder.start(past, forward_map, backward_map)
+
+    latencies = []
+    logits = []
+    for k in range(args.steps):
+        synchronize()
+        start = time.perf_counter()
+        if decoder is None:
+            step_logits, past, _ = gpt.test_with_past(None, tokens[:, k:k+1], p,
+                                                      forward_epipolar_map=forward_map,
+                                                      backward_epipolar_map=backward_map,
+                                                      past=past)
+        else:
+            step_logits = decoder.step(tokens[:, k:k+1])
+        synchronize()
+        latencies.append(time.perf_counter() - start)
+        logits.append(step_logits[:, -1].float().clone())
+    return latencies, torch.stack(logits, 1)
+
+modes = [mode for mode in args.modes.split(",") if mode]
+if device.type != "cuda" and "graph" in modes:
+    print("skip graph: CUDA graphs need --device cuda")
+    modes.remove("graph")
+if "compile" in modes and not hasattr(torch, "compile"):
+    print("skip compile: torch.compile needs pytorch 2")
+    modes.remove("compile")
+
+print("GPT: %d blocks, n_embd %d, epipolar %s | batch %d, condition %d, %d steps on %s"
+      % (len(gpt.blocks), n_embd, gpt.epipolar, B, args.cond, args.steps, device))
+
+results = {}
+for mode in modes:
+    runs = [run(mode) for _ in range(max(args.repeat, 2))]
+    latencies = np.concatenate([np.array(r[0]) for r in runs[1:]])
+    results[mode] = (latencies, runs[-1][1])
+
+base = results[modes[0]]
+for mode in modes:
+    latencies, logits = results[mode]
+    print("%-8s per token: mean %.3f ms, median %.3f ms, p90 %.3f ms | speedup %.2fx | max |logits - %s| %.2e"
+          % (mode, latencies.mean()*1e3, np.median(latencies)*1e3, np.percentile(latencies, 90)*1e3,
+             np.median(base[0]) / np.median(latencies), modes[0], (logits - base[1]).abs().max().item()))
@@ -0,0 +1,86 @@
+import time
+import math
+import argparse
+
+import numpy as np
+import sys
+sys.path.insert(0, ".")
+
+import torch
+
+# args
+parser = argparse.ArgumentParser(description="cpu benchmark of the epipolar maps: pairwise (original) vs closed form")
+parser.add_argument("--batch-size", type=int, default=2, help="")
+parser.add_argument("--size", type=int, default=16, help="token map size h = w")
+parser.add_argument("--repeat", type=int, default=10, help="# of timed runs")
+parser.add_argument("--threads", type=int, default=None, help="intra-op threads")
+parser.add_argument("--seed", type=int, default=2333, help="")
+
+args = parser.parse_args()
+
+if args.threads is not None:
+    torch.set_num_threads(args.threads)
+torch.manual_seed(args.seed)
+
+from src.modules.transformer.mingpt_adaptive import GPT
+
+#* 只用到 get_epipolar_tensor*, 開一個最小的 GPT 就好
+gpt = GPT(vocab_size=16, block_size=827, time_len=3, n_layer=2, n_head=1, n_embd=8, n_unmasked=286,
+          epipolar="bidirectional").eval()
+
+def rotation(axis_angle):
+    angle = axis_angle.norm()
+    kx, ky, kz = (axis_angle / angle).tolist()
+    cross = torch.tensor([[0., -kz, ky], [kz, 0., -kx], [-ky, kx, 0.]])
+    return torch.eye(3) + math.sin(angle) * cross + (1 - math.cos(angle)) * cross @ cross
+
+#* 隨機的 3 個 camera (小角度旋轉 + 平移), intrinsic 跟資料集一樣是 normalize 過的
+B = args.batch_size
+h = w = args.size
+K = torch.zeros(B, 4, 4)
+K[:, 0, 0] = 0.5 + 0.2 * torch.rand(B)
+K[:, 1, 1] = 0.9 + 0.3 * torch.rand(B)
+K[:, 0, 2] = 0.5
+K[:, 1, 2] = 0.5
+K[:, 2, 2] = 1
+K[:, 3, 3] = 1
+w2c = torch.eye(4).repeat(B, 3, 1, 1)
+for b in range(B):
+    for t in range(3):
+        w2c[b, t, :3, :3] = rotation(0.15 * torch.randn(3))
+        w2c[b, t, :3, 3] = 0.5 * torch.randn(3)
+
+#* training 一步要的 6 個 pair: f01 f02 f12 b01 b02 b12
+pairs = [(0, 1), (0, 2), (1, 2), (1, 0), (2, 0), (2, 1)]
+src_w2c = torch.stack([w2c[:, i] for i, _ in pairs], 1)
+target_w2c = torch.stack([w2c[:, j] for _, j in pairs], 1)
+
+def pairwise():
+    #* 原本的版本一次只能算一個 pair, 而且 b > 1 時 in-place 寫到 repeat 出來的 tensor, 所以一個 sample 一個 sample 算
+    return torch.stack([torch.stack([gpt.get_epipolar_tensor_pairwise(1, h, w, K[b:b+1].clone(), w2c[b:b+1, i], w2c[b:b+1, j])[0]
+                                     for i, j in pairs]) for b in range(B)])
+
+def closed_form():
+    return gpt.get_epipolar_tensors(h, w, K, src_w2c, target_w2c)
+
+def timeit(fn):
+    fn()
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - start)
+    return out, np.array(times)
+
+with torch.no_grad():
+    ref, t_ref = timeit(pairwise)
+    new, t_new = timeit(closed_form)
+
+hw = h * w
+print("batch %d, %dx%d tokens, %d pairs, %d threads" % (B, h, w, len(pairs), torch.get_num_threads()))
+print("pairwise    : median %.2f ms, largest intermediate (hw*hw,3) per pair %.1f MB"
+      % (np.median(t_ref) * 1e3, hw * hw * 3 * 4 / 2**20))
+print("closed form : median %.2f ms, largest intermediate (B,P,hw,hw) %.1f MB, speedup %.1fx"
+      % (np.median(t_new) * 1e3, B * len(pairs) * hw * hw * 4 / 2**20, np.median(t_ref) / np.median(t_new)))
+print("max |closed form - pairwise| %.2e, rows without an epipolar line: %d / %d"
+      % ((new - ref).abs().max().item(), (ref == 1).all(-1).sum().item(), B * len(pairs) * hw))
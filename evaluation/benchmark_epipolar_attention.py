@@ -0,0 +1,150 @@
+import time
+import math
+import argparse
+
+import numpy as np
+import sys, importlib
+sys.path.insert(0, ".")
+
+import torch
+
+from omegaconf import OmegaConf
+
+# args
+parser = argparse.ArgumentParser(description="training step of one epipolar block: explicit in-place path vs EpipolarAttention")
+parser.add_argument("--base", type=str, default="./configs/realestate/realestate_16x16_sine_cview_adaptive_epipolar.yaml",
+                    help="config of the GPT (weights are random, only the shapes matter)")
+parser.add_argument("--device", type=str, default="cuda", help="cuda / cpu")
+parser.add_argument("--batch-size", type=int, default=2, help="")
+parser.add_argument("--mask-cam", action='store_true', help="also mask the camera tokens of the epipolar rows")
+parser.add_argument("--repeat", type=int, default=5, help="# of timed runs, after one warmup")
+parser.add_argument("--threads", type=int, default=None, help="intra-op threads when running on cpu")
+parser.add_argument("--seed", type=int, default=2333, help="")
+
+args = parser.parse_args()
+
+device = torch.device(args.device)
+if device.type == "cpu" and args.threads is not None:
+    torch.set_num_threads(args.threads)
+torch.manual_seed(args.seed)
+
+def synchronize():
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+def get_obj_from_str(string, reload=False):
+    module, cls = string.rsplit(".", 1)
+    if reload:
+        module_imp = importlib.import_module(module)
+        importlib.reload(module_imp)
+    return getattr(importlib.import_module(module, package=None), cls)
+
+def instantiate_from_config(config):
+    if not "target" in config:
+        raise KeyError("Expected key `target` to instantiate.")
+    return get_obj_from_str(config["target"])(**config.get("params", dict()))
+
+#* 只留第一個 block (epipolar block), dropout 關掉才比得了 gradient
+config = OmegaConf.load(args.base)
+config.model.params.transformer_config.params.n_layer = 2
+config.model.params.transformer_config.params.mask_cam = args.mask_cam
+config.model.params.transformer_config.params.attn_pdrop = 0.
+config.model.params.transformer_config.params.resid_pdrop = 0.
+gpt = instantiate_from_config(config.model.params.transformer_config).to(device)
+assert gpt.epipolar is not None, "the config has no epipolar attention"
+gpt.train()
+block = gpt.blocks[0]
+attn = block.attn
+
+def rotation(axis_angle):
+    angle = axis_angle.norm()
+    kx, ky, kz = (axis_angle / angle).tolist()
+    cross = torch.tensor([[0., -kz, ky], [kz, 0., -kx], [-ky, kx, 0.]])
+    return torch.eye(3) + math.sin(angle) * cross + (1 - math.cos(angle)) * cross @ cross
+
+#* 真的 epipolar map: 隨機的 3 個相鄰 camera (小角度旋轉 + 平移)
+B = args.batch_size
+K = torch.zeros(B, 3, 3)
+K[:, 0, 0] = 0.5 + 0.1 * torch.rand(B)
+K[:, 1, 1] = 0.9 + 0.2 * torch.rand(B)
+K[:, 0:2, 2] = 0.5
+K[:, 2, 2] = 1
+w2c = torch.eye(4).repeat(B, 3, 1, 1)
+for b in range(B):
+    for t in range(3):
+        w2c[b, t, :3, :3] = rotation(0.05 * torch.randn(3))
+        w2c[b, t, :3, 3] = 0.3 * torch.randn(3)
+pairs = [(0, 1), (0, 2), (1, 2), (1, 0), (2, 0), (2, 1)]
+maps = gpt.get_epipolar_tensors(16, 16, K.to(device),
+                                torch.stack([w2c[:, i] for i, _ in pairs], 1).to(device),
+                                torch.stack([w2c[:, j] for _, j in pairs], 1).to(device))
+forward_map = list(maps[:, :3].unbind(1))
+backward_map = list(maps[:, 3:].unbind(1))
+
+T = gpt.block_size
+n_embd = gpt.config.n_embd
+x = torch.randn(B, T, n_embd, device=device)
+x_kv = torch.randn(B, T, n_embd, device=device)
+p = [torch.randn(B, 30, device=device) for _ in range(3)]
+with torch.no_grad():
+    h = gpt.locality(*p)
+
+def saved_bytes(y):
+    """ bytes the autograd graph of y keeps for backward (tensors saved by the nodes, EpipolarAttention's block softmax included) """
+    storages = {}
+    seen = set()
+    stack = [y.grad_fn]
+    while stack:
+        node = stack.pop()
+        if node is None or node in seen:
+            continue
+        seen.add(node)
+        tensors = list(getattr(node, "saved_tensors", ()) or ()) + list(getattr(node, "block_softmax", ()))
+        for name in dir(node):
+            if name.startswith("_saved_"):
+                value = getattr(node, name)
+                tensors += value if isinstance(value, (list, tuple)) else [value]
+        for t in tensors:
+            if isinstance(t, torch.Tensor):
+                storages[t.data_ptr()] = t.numel() * t.element_size()
+        stack += [next_node for next_node, _ in node.next_functions]
+    return sum(storages.values())
+
+def run(fused):
+    attn.fused_epipolar = fused
+    gpt.zero_grad()
+    x_in = x.clone().requires_grad_()
+    y = block(x_in, x_kv, h, forward_map=forward_map, backward_map=backward_map)[0]
+    saved = saved_bytes(y)
+    y.square().mean().backward()
+    return y.detach(), x_in.grad, attn.query.weight.grad.clone(), saved
+
+def timeit(fused):
+    run(fused)
+    times = []
+    peak = None
+    for _ in range(args.repeat):
+        synchronize()
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        out = run(fused)
+        synchronize()
+        times.append(time.perf_counter() - start)
+        if device.type == "cuda":
+            peak = torch.cuda.max_memory_allocated() / 2**20
+    return out, np.median(times), peak
+
+print("epipolar %s, mask_cam %s, n_embd %d, n_head %d | batch %d, T %d on %s, forward + backward"
+      % (gpt.epipolar, args.mask_cam, n_embd, gpt.config.n_head, B, T, device))
+results = {}
+for name, fused in [("explicit", False), ("EpipolarAttention", True)]:
+    results[name] = timeit(fused)
+    (_, _, _, saved), t, peak = results[name]
+    print("%-18s: %.2f ms, saved for backward %.1f MB%s"
+          % (name, t * 1e3, saved / 2**20, "" if peak is None else ", peak %.1f MB" % peak))
+(y0, gx0, gq0, saved0), t0, _ = results["explicit"]
+(y1, gx1, gq1, saved1), t1, _ = results["EpipolarAttention"]
+print("speedup %.2fx, saved memory %.2fx | max |y - explicit| %.2e, max |grad x - explicit| %.2e (max |grad x| %.2e), max |grad query - explicit| %.2e (max %.2e)"
+      % (t0 / t1, saved0 / saved1, (y1 - y0).abs().max().item(), (gx1 - gx0).abs().max().item(), gx0.abs().max().item(),
+         (gq1 - gq0).abs().max().item(), gq0.abs().max().item()))
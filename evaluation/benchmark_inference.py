@@ -0,0 +1,101 @@
+import time
+import argparse
+
+import numpy as np
+import sys, importlib
+sys.path.insert(0, ".")
+
+import torch
+
+from omegaconf import OmegaConf
+
+# args
+parser = argparse.ArgumentParser(description="per-step latency of GPT.test() while sampling: explicit path vs inference fast path")
+parser.add_argument("--base", type=str, default="./configs/realestate/realestate_16x16_sine_cview_adaptive_epipolar.yaml",
+                    help="config of the GPT (weights are random, only the shapes matter)")
+parser.add_argument("--device", type=str, default="cuda", help="cuda / cpu")
+parser.add_argument("--batch-size", type=int, default=1, help="# of videos generated together")
+parser.add_argument("--cond", type=int, default=572, help="condition length, 286 (first frame) or 572")
+parser.add_argument("--steps", type=str, default="0,128,255", help="decode steps timed (k new tokens after the condition), 255 completes the frame")
+parser.add_argument("--repeat", type=int, default=5, help="# of timed runs per step, after one warmup")
+parser.add_argument("--threads", type=int, default=None, help="intra-op threads when running on cpu")
+
+args = parser.parse_args()
+
+device = torch.device(args.device)
+if device.type == "cpu" and args.threads is not None:
+    torch.set_num_threads(args.threads)
+
+def synchronize():
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+def get_obj_from_str(string, reload=False):
+    module, cls = string.rsplit(".", 1)
+    if reload:
+        module_imp = importlib.import_module(module)
+        importlib.reload(module_imp)
+    return getattr(importlib.import_module(module, package=None), cls)
+
+def instantiate_from_config(config):
+    if not "target" in config:
+        raise KeyError("Expected key `target` to instantiate.")
+    return get_obj_from_str(config["target"])(**config.get("params", dict()))
+
+#* 只需要 GPT, VQGAN 等其他部分不影響 test()
+config = OmegaConf.load(args.base)
+gpt = instantiate_from_config(config.model.params.transformer_config).to(device).eval()
+
+B = args.batch_size
+n_embd = gpt.config.n_embd
+vocab_size = gpt.config.vocab_size
+torch.manual_seed(0)
+cond = torch.randn(B, args.cond, n_embd, device=device)
+p = [torch.randn(B, 30, device=device) for _ in range(3)]
+#* 隨機的 epipolar map, 只有一部分 key 有權重 (跟真的 epipolar line 差不多稀疏)
+maps = [(torch.rand(B, 256, 256, device=device) > 0.8).float() for _ in range(3)]
+forward_map = maps if gpt.epipolar in ("forward", "bidirectional") else None
+backward_map = maps if gpt.epipolar in ("backward", "bidirectional") else None
+tokens = torch.randint(0, vocab_size, (B, 256), device=device)
+
+#* diagnostics: 原本 sampling 每一步做的事 (每個 epipolar layer 都複製 att_for / epipolar map, 算 bi_epi_ratio)
+#* explicit: 沒有要看 attention map 的完整版本, inference: 只算最後的 attention weight
+modes = {
+    "diagnostics": dict(return_attn=True),
+    "explicit": dict(),
+    "inference": dict(inference=True),
+}
+
+@torch.no_grad()
+def run(k, kwargs):
+    logits, _, _, _, ratio = gpt.test(cond, tokens[:, :k], p,
+                                      forward_epipolar_map=forward_map,
+                                      backward_epipolar_map=backward_map,
+                                      positions=slice(-1, None),
+                                      **kwargs)
+    return logits, ratio
+
+def timeit(k, kwargs):
+    run(k, kwargs)
+    times = []
+    for _ in range(args.repeat):
+        synchronize()
+        start = time.perf_counter()
+        out = run(k, kwargs)
+        synchronize()
+        times.append(time.perf_counter() - start)
+    return out, np.median(times)
+
+print("GPT: %d blocks, n_embd %d, n_head %d, epipolar %s | batch %d, condition %d on %s"
+      % (len(gpt.blocks), n_embd, gpt.config.n_head, gpt.epipolar, B, args.cond, device))
+for k in [int(k) for k in args.steps.split(",") if k]:
+    results = {mode: timeit(k, kwargs) for mode, kwargs in modes.items()}
+    (base_logits, base_ratio), base_time = results["diagnostics"]
+    line = "step %3d (T = %d):" % (k, args.cond + k)
+    for mode, ((logits, ratio), t) in results.items():
+        line += " %s %.2f ms (%.2fx)" % (mode, t * 1e3, base_time / t)
+    (logits, ratio), _ = results["inference"]
+    line += " | max |logits - diagnostics| %.2e" % (logits - base_logits).abs().max().item()
+    if base_ratio is not None:
+        line += ", max |bi_epi_ratio - diagnostics| %.2e" % (ratio - base_ratio).nan_to_num().abs().max().item()
+    print(line)
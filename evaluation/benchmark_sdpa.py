@@ -0,0 +1,106 @@
+import time
+import argparse
+
+import numpy as np
+import sys, importlib
+sys.path.insert(0, ".")
+
+import torch
+
+from omegaconf import OmegaConf
+
+# args
+parser = argparse.ArgumentParser(description="one non-epipolar GPT block: explicit attention vs F.scaled_dot_product_attention")
+parser.add_argument("--base", type=str, default="./configs/realestate/realestate_16x16_sine_cview_adaptive_epipolar.yaml",
+                    help="config of the GPT (weights are random, only the shapes matter)")
+parser.add_argument("--device", type=str, default="cuda", help="cuda / cpu")
+parser.add_argument("--batch-size", type=int, default=2, help="")
+parser.add_argument("--train", action='store_true', help="time forward + backward instead of forward only")
+parser.add_argument("--repeat", type=int, default=5, help="# of timed runs, after one warmup")
+parser.add_argument("--threads", type=int, default=None, help="intra-op threads when running on cpu")
+parser.add_argument("--seed", type=int, default=2333, help="")
+
+args = parser.parse_args()
+
+device = torch.device(args.device)
+if device.type == "cpu" and args.threads is not None:
+    torch.set_num_threads(args.threads)
+torch.manual_seed(args.seed)
+
+def synchronize():
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+def get_obj_from_str(string, reload=False):
+    module, cls = string.rsplit(".", 1)
+    if reload:
+        module_imp = importlib.import_module(module)
+        importlib.reload(module_imp)
+    return getattr(importlib.import_module(module, package=None), cls)
+
+def instantiate_from_config(config):
+    if not "target" in config:
+        raise KeyError("Expected key `target` to instantiate.")
+    return get_obj_from_str(config["target"])(**config.get("params", dict()))
+
+#* 只需要第二個 block (非 epipolar, 一般的 causal attention), dropout 關掉才比得了結果
+config = OmegaConf.load(args.base)
+config.model.params.transformer_config.params.n_layer = 2
+config.model.params.transformer_config.params.attn_pdrop = 0.
+config.model.params.transformer_config.params.resid_pdrop = 0.
+gpt = instantiate_from_config(config.model.params.transformer_config).to(device)
+assert hasattr(torch.nn.functional, "scaled_dot_product_attention"), "F.scaled_dot_product_attention needs pytorch 2"
+gpt.train(args.train)
+#* epipolar = None 的 config 兩個 block 都是一般 attention, 第一個有 locality bias
+block = gpt.blocks[0] if gpt.epipolar is None else gpt.blocks[1]
+attn = block.attn
+
+B = args.batch_size
+T = gpt.block_size
+n_embd = gpt.config.n_embd
+x = torch.randn(B, T, n_embd, device=device)
+p = [torch.randn(B, 30, device=device) for _ in range(3)]
+with torch.no_grad():
+    h = gpt.locality(*p)
+
+def run(sdpa):
+    attn.sdpa = sdpa
+    if args.train:
+        gpt.zero_grad()
+        x_in = x.clone().requires_grad_()
+        y = block(x_in, x_in, h)[0]
+        y.square().mean().backward()
+        return y.detach(), x_in.grad
+    with torch.no_grad():
+        y = block(x, x, h)[0]
+    return y, None
+
+def timeit(sdpa):
+    run(sdpa)
+    times = []
+    peak = None
+    for _ in range(args.repeat):
+        synchronize()
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        out = run(sdpa)
+        synchronize()
+        times.append(time.perf_counter() - start)
+        if device.type == "cuda":
+            peak = torch.cuda.max_memory_allocated() / 2**20
+    return out, np.median(times), peak
+
+print("adaptive %s, n_embd %d, n_head %d | batch %d, T %d on %s, %s"
+      % (attn.adaptive, n_embd, gpt.config.n_head, B, T, device, "forward + backward" if args.train else "forward"))
+results = {}
+for name, sdpa in [("explicit", False), ("sdpa", True)]:
+    results[name] = timeit(sdpa)
+    _, t, peak = results[name]
+    print("%-8s: %.2f ms%s" % (name, t * 1e3, "" if peak is None else ", peak %.1f MB" % peak))
+(y0, g0), t0, _ = results["explicit"]
+(y1, g1), t1, _ = results["sdpa"]
+line = "speedup %.2fx | max |y - explicit| %.2e" % (t0 / t1, (y1 - y0).abs().max().item())
+if g0 is not None:
+    line += ", max |grad x - explicit| %.2e (max |grad x| %.2e)" % ((g1 - g0).abs().max().item(), g0.abs().max().item())
+print(line)
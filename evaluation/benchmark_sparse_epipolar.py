@@ -0,0 +1,145 @@
+import time
+import math
+import argparse
+
+import numpy as np
+import sys, importlib
+sys.path.insert(0, ".")
+
+import torch
+
+from omegaconf import OmegaConf
+
+# args
+parser = argparse.ArgumentParser(description="dense vs sparse (banded) epipolar attention of one epipolar block")
+parser.add_argument("--base", type=str, default="./configs/realestate/realestate_16x16_sine_cview_adaptive_epipolar.yaml",
+                    help="config of the GPT (weights are random, only the shapes matter)")
+parser.add_argument("--device", type=str, default="cuda", help="cuda / cpu")
+parser.add_argument("--batch-size", type=int, default=2, help="")
+parser.add_argument("--thresholds", type=str, default="1e-3,1e-2", help="epipolar weight thresholds of the sparse mode")
+parser.add_argument("--repeat", type=int, default=10, help="# of timed runs, after one warmup")
+parser.add_argument("--train", action='store_true', help="time forward + backward instead of forward only")
+parser.add_argument("--threads", type=int, default=None, help="intra-op threads when running on cpu")
+parser.add_argument("--seed", type=int, default=2333, help="")
+
+args = parser.parse_args()
+
+device = torch.device(args.device)
+if device.type == "cpu" and args.threads is not None:
+    torch.set_num_threads(args.threads)
+torch.manual_seed(args.seed)
+
+def synchronize():
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+def get_obj_from_str(string, reload=False):
+    module, cls = string.rsplit(".", 1)
+    if reload:
+        module_imp = importlib.import_module(module)
+        importlib.reload(module_imp)
+    return getattr(importlib.import_module(module, package=None), cls)
+
+def instantiate_from_config(config):
+    if not "target" in config:
+        raise KeyError("Expected key `target` to instantiate.")
+    return get_obj_from_str(config["target"])(**config.get("params", dict()))
+
+#* 只留第一個 block (epipolar block), 其他 block 不影響比較
+config = OmegaConf.load(args.base)
+config.model.params.transformer_config.params.n_layer = 2
+gpt = instantiate_from_config(config.model.params.transformer_config).to(device)
+assert gpt.epipolar is not None, "the config has no epipolar attention"
+gpt.eval()
+block = gpt.blocks[0]
+attn = block.attn
+
+def rotation(axis_angle):
+    angle = axis_angle.norm()
+    kx, ky, kz = (axis_angle / angle).tolist()
+    cross = torch.tensor([[0., -kz, ky], [kz, 0., -kx], [-ky, kx, 0.]])
+    return torch.eye(3) + math.sin(angle) * cross + (1 - math.cos(angle)) * cross @ cross
+
+#* 真的 epipolar map: 隨機的 3 個相鄰 camera (小角度旋轉 + 平移)
+B = args.batch_size
+K = torch.zeros(B, 3, 3)
+K[:, 0, 0] = 0.5 + 0.1 * torch.rand(B)
+K[:, 1, 1] = 0.9 + 0.2 * torch.rand(B)
+K[:, 0:2, 2] = 0.5
+K[:, 2, 2] = 1
+w2c = torch.eye(4).repeat(B, 3, 1, 1)
+for b in range(B):
+    for t in range(3):
+        w2c[b, t, :3, :3] = rotation(0.05 * torch.randn(3))
+        w2c[b, t, :3, 3] = 0.3 * torch.randn(3)
+pairs = [(0, 1), (0, 2), (1, 2), (1, 0), (2, 0), (2, 1)]
+maps = gpt.get_epipolar_tensors(16, 16, K.to(device),
+                                torch.stack([w2c[:, i] for i, _ in pairs], 1).to(device),
+                                torch.stack([w2c[:, j] for _, j in pairs], 1).to(device))
+forward_map = list(maps[:, :3].unbind(1))
+backward_map = list(maps[:, 3:].unbind(1))
+
+T = 827
+n_embd = gpt.config.n_embd
+x = torch.randn(B, T, n_embd, device=device)
+x_kv = torch.randn(B, T, n_embd, device=device)
+p = [torch.randn(B, 30, device=device) for _ in range(3)]
+h = gpt.locality(*p)
+
+def run(threshold):
+    attn.sparse_epipolar = threshold
+    if args.train:
+        x_in = x.clone().requires_grad_()
+        y = block(x_in, x_kv, h, forward_map=forward_map, backward_map=backward_map)[0]
+        y.square().mean().backward()
+        return y.detach(), x_in.grad
+    with torch.no_grad():
+        y = block(x, x_kv, h, forward_map=forward_map, backward_map=backward_map)[0]
+    return y, None
+
+def timeit(threshold):
+    run(threshold)
+    times = []
+    for _ in range(args.repeat):
+        synchronize()
+        start = time.perf_counter()
+        out = run(threshold)
+        synchronize()
+        times.append(time.perf_counter() - start)
+    return out, np.median(times)
+
+def band_stats(threshold):
+    """ fraction of the (query, key) pairs of the cross-frame blocks that are skipped """
+    attn.sparse_epipolar = threshold
+    skipped, padded, dense_blocks, n_blocks = [], [], 0, 0
+    for row_start, row_end, key_blocks in attn.layout.epipolar_segments:
+        for _, _, m in key_blocks:
+            if gpt.epipolar == "forward":
+                weight = forward_map[m]
+            elif gpt.epipolar == "backward":
+                weight = backward_map[m].permute(0, 2, 1)
+            else:
+                weight = forward_map[m] * backward_map[m].permute(0, 2, 1)
+            n_blocks += 1
+            skipped.append((weight < threshold).float().mean().item())
+            band = attn.epipolar_band(weight)
+            if band is None:
+                dense_blocks += 1
+                padded.append(0.)
+            else:
+                padded.append(1 - band[0].shape[-1] / weight.shape[-1])
+    return np.mean(skipped), np.mean(padded), dense_blocks, n_blocks
+
+print("epipolar %s, n_embd %d, n_head %d | batch %d, T %d on %s, %s"
+      % (gpt.epipolar, n_embd, gpt.config.n_head, B, T, device, "forward + backward" if args.train else "forward"))
+(dense_y, dense_grad), dense_time = timeit(None)
+print("dense          : %.2f ms" % (dense_time * 1e3))
+for threshold in [float(t) for t in args.thresholds.split(",") if t]:
+    (y, grad), sparse_time = timeit(threshold)
+    skipped, padded, dense_blocks, n_blocks = band_stats(threshold)
+    line = ("sparse %-8g: %.2f ms, speedup %.2fx | keys below threshold %.1f%%, skipped after padding %.1f%%, dense fallback %d/%d blocks | max |y - dense| %.2e"
+            % (threshold, sparse_time * 1e3, dense_time / sparse_time, skipped * 100, padded * 100, dense_blocks, n_blocks,
+               (y - dense_y).abs().max().item()))
+    if grad is not None:
+        line += ", max |grad - dense| %.2e" % (grad - dense_grad).abs().max().item()
+    print(line)
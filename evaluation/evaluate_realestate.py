@@ -24,11 +24,12 @@ import torchvision
 torch.set_num_threads(cpu_num)
 
 from omegaconf import OmegaConf
-from einops import rearrange
 from SiamMae import *
+from src.modules.siamese import confidence_noise, sample_siamese_masks
 
 from torchsummary import summary
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 # args
 parser = argparse.ArgumentParser(description="training codes")
@@ -49,10 +50,30 @@ parser.add_argument("--GT_start", action='store_true')
 parser.add_argument("--mask_ratio", type=float, default=0.9, help="")
 parser.add_argument("--mix_frame", type=int, default=10, help="")
 parser.add_argument("--type",type=str, default='forward')
+parser.add_argument("--batch-size", type=int, default=1, help="# of videos generated together")
+parser.add_argument("--device", type=str, default="cuda", help="cuda / cpu")
+parser.add_argument("--int8", action='store_true', help="sample with the int8 quantized GPT (cpu only)")
+parser.add_argument("--threads", type=int, default=cpu_num, help="intra-op threads when running on cpu")
+parser.add_argument("--parallel-iters", type=int, default=None, help="refinement iterations of parallel decoding, compared against autoregressive")
+parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "fp16", "bf16"], help="autocast precision of the GPT while sampling")
+parser.add_argument("--epipolar-cache", type=float, default=0, help="MB of epipolar maps kept between frames / videos, 0 = recompute every time")
+parser.add_argument("--epipolar-cache-path", type=str, default=None, help="file the epipolar cache is loaded from and saved to, shared across runs")
+parser.add_argument("--attn-chunk", type=int, default=None, help="query rows per tile of the chunked attention, None = whole attention at once")
+parser.add_argument("--attn-memory-mb", type=float, default=None, help="hard ceiling (MB) on the attention scores of one tile, picks the tile size")
 
 args = parser.parse_args()
 os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
 
+device = torch.device(args.device)
+if device.type == "cpu":
+    #* CPU 推論: 速度主要看 matmul 的 intra-op thread 數, inter-op 平行用不到
+    torch.set_num_threads(args.threads)
+    torch.set_num_interop_threads(1)
+
+def synchronize():
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
 # fix the seed
 # torch.manual_seed(args.seed)
 # torch.cuda.manual_seed(args.seed)
@@ -75,6 +96,10 @@ frame_limit = args.len
 target_save_path = "./experiments/realestate/%s/evaluate_frame_%d_video_%d_ckpt_%s_mask%f/" % (args.exp, frame_limit, video_limit, args.ckpt,args.mask_ratio)
 if args.GT_start:
     target_save_path = "./experiments/realestate/%s/evaluate_frame_%d_video_%d_GTstart/" % (args.exp, frame_limit, video_limit)
+if args.parallel_iters is not None:
+    target_save_path = target_save_path.rstrip("/") + "_parallel%d/" % args.parallel_iters
+if args.precision != "fp32":
+    target_save_path = target_save_path.rstrip("/") + "_%s/" % args.precision
 os.makedirs(target_save_path, exist_ok=True)
 
 attend_test_folder = f"{args.type}_attn_test"
@@ -88,9 +113,8 @@ os.makedirs(ckpt_test_folder, exist_ok=True)
 from src.metric.metrics import perceptual_sim, psnr, ssim_metric
 from src.metric.pretrained_networks import PNet
 
-vgg16 = PNet().to("cuda")
+vgg16 = PNet(device=device)
 vgg16.eval()
-vgg16.cuda()
 
 # load model
 def get_obj_from_str(string, reload=False):
@@ -117,15 +141,25 @@ def compute_camera_pose(R_dst, t_dst, R_src, t_src):
 
 config = OmegaConf.load(config_path)
 model = instantiate_from_config(config.model)
-model.cuda()
-model.load_state_dict(torch.load(cpt_path))
+model.to(device)
+model.load_state_dict(torch.load(cpt_path, map_location=device))
 model.eval()
+if args.int8:
+    #* int8 的 Linear 只能在 CPU 上跑
+    from src.modules.transformer.mingpt_adaptive import quantize_gpt
+    assert device.type == "cpu", "--int8 needs --device cpu"
+    model.transformer = quantize_gpt(model.transformer)
+if args.epipolar_cache > 0:
+    from src.modules.transformer.mingpt_adaptive import EpipolarCache
+    model.transformer.epipolar_cache = EpipolarCache(max_mb=args.epipolar_cache, path=args.epipolar_cache_path)
+if args.attn_chunk is not None or args.attn_memory_mb is not None:
+    model.transformer.set_attn_chunking(args.attn_chunk, args.attn_memory_mb)
 
 #* load siamese model
 siamese_model_path = 'Siamese_folder/mask095_fulldata_epoch_42.pt'
 siamese_model = sim_mae_vit_small_patch8_dec512d8b()
-siamese_model = nn.DataParallel(siamese_model).to("cuda")
-siamese_model.load_state_dict(torch.load(siamese_model_path))
+siamese_model = nn.DataParallel(siamese_model).to(device)
+siamese_model.load_state_dict(torch.load(siamese_model_path, map_location=device))
 siamese_model.eval()
 
 # load dataloader
@@ -138,10 +172,10 @@ dataset_abs = Re10k_dataset(data_root="../dataset",mode="test",infer_len=args.le
 
 test_loader_abs = torch.utils.data.DataLoader(
         dataset_abs,
-        batch_size=1,
+        batch_size=args.batch_size,
         shuffle=False,
         num_workers=0,
-        pin_memory=True,
+        pin_memory=device.type == "cuda",
         drop_last = True
     )
 
@@ -172,248 +206,106 @@ def as_grayscale_image(tensor):
     resized_img = cv2.resize(img, (256, 256), interpolation=cv2.INTER_LINEAR)
     return Image.fromarray(resized_img)
 
-def evaluate_per_batch(temp_model, batch, total_time_len = 20, time_len = 1, show = False,siamese=False):
-    video_clips = []
-    video_clips.append(batch["rgbs"][:, :, 0, ...])
-
-    # first generate one frame
-    with torch.no_grad():
-        for i in range(1):
-            conditions = []
-            R_src = batch["R_s"][0, i, ...]
-            R_src_inv = R_src.transpose(-1,-2)
-            t_src = batch["t_s"][0, i, ...]
-
-            # create dict
-            example = dict()
-            example["K"] = batch["K"]
-            example["K_inv"] = batch["K_inv"]
-
-            example["src_img"] = video_clips[-1]
-            _, c_indices = temp_model.encode_to_c(example["src_img"])
-            c_emb = temp_model.transformer.tok_emb(c_indices)
-            conditions.append(c_emb)
-
-            R_dst = batch["R_s"][0, i+1, ...]
-            t_dst = batch["t_s"][0, i+1, ...]
-
-            R_rel = R_dst@R_src_inv
-            t_rel = t_dst-R_rel@t_src
-
-            example["R_rel"] = R_rel.unsqueeze(0)
-            example["t_rel"] = t_rel.unsqueeze(0)
-
-            embeddings_warp = temp_model.encode_to_e(example)
-            conditions.append(embeddings_warp)
-            # p1
-            p1 = temp_model.encode_to_p(example)
-
-            prototype = torch.cat(conditions, 1) #* (1,286,1024) rgb1+camera 的embed
-            z_start_indices = c_indices[:, :0]
-
-            index_sample,bi_epi_ratio = temp_model.sample_latent(z_start_indices, prototype, [p1, None, None],
-                                        steps=c_indices.shape[1],
-                                        k_ori=batch["K_ori"],w2c=batch['w2c_seq'][:,i:i+3,...],
-                                        temperature=1.0,
-                                        sample=False,
-                                        top_k=100,
-                                        callback=lambda k: None,
-                                        embeddings=None)
-
-            #* shape (1 3 256 256)
-            sample_dec = temp_model.decode_to_img(index_sample, [1, 256, 16, 16])
-            video_clips.append(sample_dec) # update video_clips list
-
-
-            #* 因為siamese 是使用8x8 的mask,lor 則是使用16x16的token, 所以要做一層對應的轉換
-            #* 然後siamese 是取前幾小的做保留其餘做mask, 但bi_epi_ratio 則是想保留前幾大的, 所以都取了倒數進行對應
-            masked_token = torch.zeros((32, 32))
-            for j in range(32):
-                for k in range(32):
-                    masked_token[j][k] = 1/bi_epi_ratio[0,(j//2)*16+(k//2)]
-            masked_token = rearrange(masked_token,'h w -> (h w)')
-
-            sorted_indices = torch.argsort(masked_token)
-            small_index = sorted_indices[:int(1024*0.5)]
-
-            masked_token = masked_token.unsqueeze(0)
-
-    #! siamese
-
-            if siamese==True:
-                for k in range(5):
-                    # #* 拿src img 和 最新predict 的image 去做 siamese 
-                    pred_images = []
-                    for j in range(args.mix_frame):
-
-                        #* 將保留的token 進行拆分分別做recon，以免每次都算到一樣的
-                        sliced_mask_token = masked_token.clone()
-                        shuffled_tensor = small_index[torch.randperm(small_index.size(0))]
-                        for l in range(int(1024*(1-args.mask_ratio))):
-                            sliced_mask_token[0,shuffled_tensor[l]]=0
-
-                        #* data shape (b c t h w) (1 3 2 256 256)
-                        # if i == 0:
-                        siamese_data = torch.stack([video_clips[-2],video_clips[-1]],dim=2)
-                        # else:
-                        #     siamese_data = torch.stack([video_clips[-3],video_clips[-1]],dim=2)
-                        loss, pred = siamese_model.forward(siamese_data,mask_ratio=args.mask_ratio,mask_example=sliced_mask_token)
-                        pred_image = siamese_model.module.unpatchify(pred)
-                        pred_images.append(pred_image)
-
-
-                    #* 平均多次計算的結果
-                    pred_image = pred_images[0]
-                    for j in range(1,args.mix_frame):
-                        pred_image += pred_images[j]
-                    pred_image/=args.mix_frame
-                    
-                    # current_im = as_png(pred_image.permute(0,2,3,1)[0])
-                    # current_im.save(f'{ckpt_test_folder}/mask_recon_{k}.png')
-                    # print(f"save recon {k} ...")
-
-                    #* 替換最後結果
-                    video_clips[-1] = pred_image
-                current_im = as_png(pred_image.permute(0,2,3,1)[0])
-
-#! -----------------
-
-
-    with torch.no_grad():
-        for i in range(0, total_time_len-2, time_len):
-            conditions = []
-
-            R_src = batch["R_s"][0, i, ...]
-            R_src_inv = R_src.transpose(-1,-2)
-            t_src = batch["t_s"][0, i, ...]
-
-            print(f"i={i}")
-
-            # create dict
-            example = dict()
-            example["K"] = batch["K"]
-            example["K_inv"] = batch["K_inv"]
-
-            for t in range(time_len):
-                example["src_img"] = video_clips[-2]
-                _, c_indices = temp_model.encode_to_c(example["src_img"])
-                c_emb = temp_model.transformer.tok_emb(c_indices)
-                conditions.append(c_emb)
-
-                R_dst = batch["R_s"][0, i+t+1, ...]
-                t_dst = batch["t_s"][0, i+t+1, ...]
-
-                R_rel = R_dst@R_src_inv
-                t_rel = t_dst-R_rel@t_src
-
-                example["R_rel"] = R_rel.unsqueeze(0)
-                example["t_rel"] = t_rel.unsqueeze(0)
-                # print(f"data device = {R_rel.device}")
-                embeddings_warp = temp_model.encode_to_e(example)
-                conditions.append(embeddings_warp)
-                # p1
-                p1 = temp_model.encode_to_p(example)
-
-                example["src_img"] = video_clips[-1]
-                _, c_indices = temp_model.encode_to_c(example["src_img"])
-                c_emb = temp_model.transformer.tok_emb(c_indices)
-                conditions.append(c_emb)
-
-                R_dst = batch["R_s"][0, i+t+2, ...]
-                t_dst = batch["t_s"][0, i+t+2, ...]
-
-                R_rel = R_dst@R_src_inv
-                t_rel = t_dst-R_rel@t_src
-
-                example["R_rel"] = R_rel.unsqueeze(0)
-                example["t_rel"] = t_rel.unsqueeze(0)
-                embeddings_warp = temp_model.encode_to_e(example)
-                conditions.append(embeddings_warp)
-                # p2
-                p2 = temp_model.encode_to_p(example)
-                # p3
-                R_rel, t_rel = compute_camera_pose(batch["R_s"][0, i+t+2, ...], batch["t_s"][0, i+t+2, ...], 
-                                                   batch["R_s"][0, i+t+1, ...], batch["t_s"][0, i+t+1, ...])
-                example["R_rel"] = R_rel.unsqueeze(0)
-                example["t_rel"] = t_rel.unsqueeze(0)
-                p3 = temp_model.encode_to_p(example)
-
-                prototype = torch.cat(conditions, 1)
-
-                z_start_indices = c_indices[:, :0]
-
-                index_sample,bi_epi_ratio = temp_model.sample_latent(z_start_indices, prototype, [p1, p2, p3],
-                                        steps=c_indices.shape[1],
-                                        k_ori=batch["K_ori"],w2c=batch['w2c_seq'][:,i:i+3,...],
+def siamese_refine(video_clips, bi_epi_ratio, window=None):
+    #* 第一張做5次, 之後只有奇數 window 做3次
+    if window is None:
+        iters = 5
+    elif window%2==0:
+        return video_clips[-1]
+    else:
+        iters = 3
+        print(f"do siamese for frame {len(video_clips)-1}...")
+
+    #* 因為siamese 是使用8x8 的mask,lor 則是使用16x16的token, 所以要做一層對應的轉換 (倒數, 見 confidence_noise)
+    noise = confidence_noise(bi_epi_ratio)
+    pred_image = video_clips[-1]
+
+    #* 拿src img 和 最新predict 的image 去做 siamese 
+    for k in range(iters):
+        pred_images = []
+        #* 將保留的token 進行拆分分別做recon，以免每次都算到一樣的, mix_frame 個 mask 一次抽好 (mix_frame, B, 1024)
+        masks = sample_siamese_masks(noise, args.mix_frame, args.mask_ratio)
+        for j in range(args.mix_frame):
+            #* data shape (b c t h w) (B 3 2 256 256)
+            siamese_data = torch.stack([video_clips[-2],pred_image],dim=2)
+            loss, pred = siamese_model.forward(siamese_data,mask_ratio=args.mask_ratio,mask_example=masks[j])
+            pred_images.append(siamese_model.module.unpatchify(pred))
+
+        #* 平均多次計算的結果
+        pred_image = torch.stack(pred_images).mean(0)
+
+    return pred_image
+
+def evaluate_per_batch(temp_model, batch, total_time_len = 20, time_len = 1, show = False,siamese=False,parallel_iters=None):
+    #* batch 內的 B 條軌跡一起生成
+    video_clips, _ = temp_model.rollout(batch, total_time_len,
                                         temperature=1.0,
                                         sample=False,
                                         top_k=100,
-                                        callback=lambda k: None,
-                                        embeddings=None)
-
-                print(f"sample shape = {index_sample.shape}")
-                sample_dec = temp_model.decode_to_img(index_sample, [1, 256, 16, 16])
-                video_clips.append(sample_dec) # update video_clips list
-                current_im = as_png(sample_dec.permute(0,2,3,1)[0])
-
-                
-                #* 因為siamese 是使用8x8 的mask,lor 則是使用16x16的token, 所以要做一層對應的轉換
-                #* 然後siamese 是取前幾小的做保留其餘做mask, 但bi_epi_ratio 則是想保留前幾大的, 所以都取了倒數進行對應
-                masked_token = torch.zeros((32, 32))
-                for j in range(32):
-                    for k in range(32):
-                        masked_token[j][k] = 1/bi_epi_ratio[0,(j//2)*16+(k//2)]
-                masked_token = rearrange(masked_token,'h w -> (h w)')
-                sorted_indices = torch.argsort(masked_token)
-                small_index = sorted_indices[:int(1024*0.5)]
-                masked_token = masked_token.unsqueeze(0)
-                # masked_token = None
-
-        #! siamese 
-                if siamese==True:       
-                    if i%2==0:
-                        continue
-                    print(f"do siamese for frame {len(video_clips)-1}...")
-
-                    #* 拿src img 和 最新predict 的image 去做 siamese 
-                    for k in range(3):
-                        pred_images = []
-                        for j in range(args.mix_frame):
-
-                            #* 將保留的token 進行拆分分別做recon，以免每次都算到一樣的
-                            sliced_mask_token = masked_token.clone()
-                            shuffled_tensor = small_index[torch.randperm(small_index.size(0))]
-                            for l in range(int(1024*(1-args.mask_ratio))):
-                                sliced_mask_token[0,shuffled_tensor[l]]=0
-
-                            #* data shape (b c t h w) (1 3 2 256 256)
-                            siamese_data = torch.stack([video_clips[-2],video_clips[-1]],dim=2)
-                            loss, pred = siamese_model.forward(siamese_data,mask_ratio=args.mask_ratio,mask_example=sliced_mask_token)
-                            pred_image = siamese_model.module.unpatchify(pred)
-                            pred_images.append(pred_image)
-
-                        #* 平均多次計算的結果
-                        pred_image = pred_images[0]
-                        for j in range(1,args.mix_frame):
-                            pred_image += pred_images[j]
-
-                        pred_image/=args.mix_frame
-
-                        #* 替換最後結果
-                        video_clips[-1] = pred_image
-                    current_im = as_png(pred_image.permute(0,2,3,1)[0])
-
-    #                 print(f"finish siamese for frame {len(video_clips)-1}...")
-
-        #!  ----------------
-                
+                                        refine=siamese_refine if siamese else None,
+                                        parallel_iters=parallel_iters,
+                                        precision=args.precision)
     return video_clips
 
+def stream_per_batch(temp_model, batch, total_time_len = 20, siamese=False, parallel_iters=None):
+    #* 跟 evaluate_per_batch 一樣, 但每生成完一張 frame 就先交出去 (i, frame, bi_epi_ratio)
+    return temp_model.rollout_frames(batch, total_time_len,
+                                     temperature=1.0,
+                                     sample=False,
+                                     top_k=100,
+                                     refine=siamese_refine if siamese else None,
+                                     parallel_iters=parallel_iters,
+                                     precision=args.precision)
+
+#* 存圖跟算指標丟到另一個 thread (GPU 上再用另一個 cuda stream), 跟下一張 frame 的 sampling 重疊
+frame_writer = ThreadPoolExecutor(max_workers=1)
+writer_stream = torch.cuda.Stream() if device.type == "cuda" else None
+
+def save_frame(sub_dirs, i, gt, pred, ready, score):
+    """ runs on frame_writer: writes frame i of every sample, returns its metrics against GT (if score) """
+    B = len(sub_dirs)
+    with torch.no_grad(), torch.cuda.stream(writer_stream):
+        if ready is not None:
+            writer_stream.wait_event(ready)
+        values = None
+        if score:
+            t_img = (gt + 1)/2
+            p_img = (pred + 1)/2
+            values = (perceptual_sim(p_img, t_img, vgg16).reshape(B, -1).mean(1).tolist(),
+                      ssim_metric(p_img, t_img).reshape(B, -1).mean(1).tolist(),
+                      psnr(p_img, t_img).tolist())
+        gt = gt.permute(0,2,3,1).cpu()
+        pred = pred.permute(0,2,3,1).cpu()
+
+    for b in range(B):
+        gt_img = np.array(as_png(gt[b]))
+        forecast_img = np.array(as_png(pred[b]))
+
+        cv2.imwrite(os.path.join(sub_dirs[b], "predict_%02d.png" % i), forecast_img[:, :, [2,1,0]])
+        cv2.imwrite(os.path.join(sub_dirs[b], "gt_%02d.png" % i), gt_img[:, :, [2,1,0]])
+
+    return values
+
+def submit_frame(sub_dirs, i, gt, pred, score):
+    #* frame 在目前的 stream 上算完之後 writer 才能開始
+    ready = None
+    if writer_stream is not None:
+        ready = torch.cuda.Event()
+        ready.record()
+    return frame_writer.submit(save_frame, sub_dirs, i, gt, pred, ready, score)
+
 # first save the frame and then evaluate the saved frame 
 n_values_percsim = []
 n_values_ssim = []
 n_values_psnr = []
 
+#* parallel decoding 對 autoregressive baseline 的指標, 以及每個 batch 的生成時間
+ar_percsim = []
+ar_ssim = []
+ar_psnr = []
+gen_times = []
+ar_times = []
+
 pbar = tqdm(total=1000)
 b_i = 0
 iteration = iter(test_loader_abs)
@@ -427,53 +319,76 @@ while b_i < video_limit:
             cnt+=1
             pbar.update(1)
             continue
+    except StopIteration:
+        break
     except:
         continue
                 
     pbar.update(1)
-        
-    values_percsim = []
-    values_ssim = []
-    values_psnr = []
-        
 
-    sub_dir = os.path.join(target_save_path, f'{"%03d" % (cnt+b_i)}-mix{args.mix_frame}-mask{args.mask_ratio}')
-    os.makedirs(sub_dir, exist_ok=True)
-            
     for key in batch.keys():
-        batch[key] = batch[key].cuda()
+        batch[key] = batch[key].to(device)
+    B = min(batch["rgbs"].shape[0], video_limit-b_i)
     
-    generate_video = evaluate_per_batch(model, batch, total_time_len = frame_limit, time_len = 1,siamese=True)
-        
-    for i in range(1, len(generate_video)):
-        gt_img = np.array(as_png(batch["rgbs"][0, :, i, ...].permute(1,2,0)))
-        forecast_img = np.array(as_png(generate_video[i][0].permute(1,2,0)))
-        
-        cv2.imwrite(os.path.join(sub_dir, "predict_%02d.png" % i), forecast_img[:, :, [2,1,0]])
-        cv2.imwrite(os.path.join(sub_dir, "gt_%02d.png" % i), gt_img[:, :, [2,1,0]])
+    sub_dirs = []
+    for b in range(B):
+        sub_dir = os.path.join(target_save_path, f'{"%03d" % (cnt+b_i+b)}-mix{args.mix_frame}-mask{args.mask_ratio}')
+        os.makedirs(sub_dir, exist_ok=True)
+        sub_dirs.append(sub_dir)
 
+    #* 每張 frame 生成完就交給 writer 存圖算指標, 這邊直接接著生成下一張
     #* 計算生成的前5張與GT 的指標就好 (short term)
-
-    for i in range(1, 6): 
-        t_img = (batch["rgbs"][:, :, i, ...] + 1)/2
-        p_img = (generate_video[i] + 1)/2
-        t_perc_sim = perceptual_sim(p_img, t_img, vgg16).item()
-
-        perc_sim = t_perc_sim
-        ssim_sim = ssim_metric(p_img, t_img).item()
-        psnr_sim = psnr(p_img, t_img).item()
-        
-        values_percsim.append(perc_sim)
-        values_ssim.append(ssim_sim)
-        values_psnr.append(psnr_sim)
+    synchronize()
+    start = time.time()
+    generate_video = [batch["rgbs"][:, :, 0, ...]]
+    jobs = []
+    for i, frame, _ in stream_per_batch(model, batch, total_time_len = frame_limit,siamese=True,parallel_iters=args.parallel_iters):
+        generate_video.append(frame)
+        jobs.append(submit_frame(sub_dirs, i, batch["rgbs"][:B, :, i, ...], frame[:B], score = i < 6))
+    frame_values = [job.result() for job in jobs]
+    synchronize()
+    gen_times.append(time.time()-start)
+
+    if args.parallel_iters is not None:
+        #* 同一個 batch 再用 autoregressive 生成一次當 baseline, 比較 parallel decoding 差多少
+        start = time.time()
+        baseline_video = evaluate_per_batch(model, batch, total_time_len = frame_limit, time_len = 1,siamese=True,parallel_iters=None)
+        synchronize()
+        ar_times.append(time.time()-start)
+
+        for i in range(1, len(generate_video)):
+            p_img = (generate_video[i][:B] + 1)/2
+            a_img = (baseline_video[i][:B] + 1)/2
+            ar_percsim.extend(perceptual_sim(p_img, a_img, vgg16).reshape(B, -1).mean(1).tolist())
+            ar_ssim.extend(ssim_metric(p_img, a_img).reshape(B, -1).mean(1).tolist())
+            ar_psnr.extend(psnr(p_img, a_img).tolist())
+
+    #* 每個 sample 分開記
+    values_percsim = [[] for _ in range(B)]
+    values_ssim = [[] for _ in range(B)]
+    values_psnr = [[] for _ in range(B)]
+
+    for values in frame_values:
+        if values is None:
+            continue
+        perc_sim, ssim_sim, psnr_sim = values
+        for b in range(B):
+            values_percsim[b].append(perc_sim[b])
+            values_ssim[b].append(ssim_sim[b])
+            values_psnr[b].append(psnr_sim[b])
     
-    n_values_percsim.append(values_percsim)
-    n_values_ssim.append(values_ssim)
-    n_values_psnr.append(values_psnr)
+    n_values_percsim.extend(values_percsim)
+    n_values_ssim.extend(values_ssim)
+    n_values_psnr.extend(values_psnr)
     
-    b_i += 1
+    b_i += B
     
 pbar.close()
+
+if model.transformer.epipolar_cache is not None:
+    print("epipolar cache:", model.transformer.epipolar_cache.stats())
+    if args.epipolar_cache_path is not None:
+        model.transformer.epipolar_cache.save()
     
 total_percsim = []
 total_ssim = []
@@ -499,4 +414,11 @@ with open(os.path.join(target_save_path, "eval_3.txt"), 'w') as f:
             % (np.mean(total_percsim), np.std(total_percsim), 
                np.mean(total_ssim), np.std(total_ssim),
                np.mean(total_psnr), np.std(total_psnr)))
-    f.write('\n')
\ No newline at end of file
+    f.write('\n')
+
+    if args.parallel_iters is not None:
+        f.write("Parallel (%d iters) vs AR, percsim: %.03f, ssim: %.02f, psnr: %.03f" 
+                % (args.parallel_iters, np.mean(ar_percsim), np.mean(ar_ssim), np.mean(ar_psnr)))
+        f.write('\n')
+        f.write("Time per batch, parallel: %.02fs, AR: %.02fs" % (np.mean(gen_times), np.mean(ar_times)))
+        f.write('\n')
\ No newline at end of file
@@ -0,0 +1,158 @@
+import os
+import time
+import argparse
+
+import numpy as np
+from tqdm import tqdm
+import sys, importlib
+sys.path.insert(0, ".")
+
+import torch
+
+from omegaconf import OmegaConf
+
+# args
+parser = argparse.ArgumentParser(description="int8 GPT conversion + accuracy drift on held-out videos")
+parser.add_argument("--base", type=str, default="realestate_16x16_adaptive",
+                    help="experiments name")
+parser.add_argument("--exp", type=str, default="exp_1_error",
+                    help="experiments name")
+parser.add_argument("--ckpt", type=str, default="last",
+                    help="checkpoint name")
+parser.add_argument("--len", type=int, default=4, help="len of prediction")
+parser.add_argument("--video_limit", type=int, default=20, help="# of held-out videos to compare")
+parser.add_argument("--threads", type=int, default=os.cpu_count(), help="intra-op threads")
+parser.add_argument("--save", type=str, default=None, help="where to save the int8 GPT state_dict")
+
+args = parser.parse_args()
+
+#* int8 的 Linear 只有 CPU (fbgemm) 版本, 整個比較都在 CPU 上做
+torch.set_num_threads(args.threads)
+torch.set_num_interop_threads(1)
+
+# config
+config_path = "./configs/realestate/%s.yaml" % args.base
+if args.exp[-5:]=="error":
+    cpt_path = "./experiments/%s/model/%s.ckpt" % (args.exp, args.ckpt)
+else:
+    cpt_path = "./experiments/realestate/%s/model/%s.ckpt" % (args.exp, args.ckpt)
+
+target_save_path = "./experiments/realestate/%s/quantize_frame_%d_video_%d_ckpt_%s/" % (args.exp, args.len, args.video_limit, args.ckpt)
+os.makedirs(target_save_path, exist_ok=True)
+
+from src.metric.metrics import psnr
+from src.modules.transformer.mingpt_adaptive import quantize_gpt
+
+# load model
+def get_obj_from_str(string, reload=False):
+    module, cls = string.rsplit(".", 1)
+    if reload:
+        module_imp = importlib.import_module(module)
+        importlib.reload(module_imp)
+    return getattr(importlib.import_module(module, package=None), cls)
+
+def instantiate_from_config(config):
+    if not "target" in config:
+        raise KeyError("Expected key `target` to instantiate.")
+    return get_obj_from_str(config["target"])(**config.get("params", dict()))
+
+config = OmegaConf.load(config_path)
+model = instantiate_from_config(config.model)
+model.load_state_dict(torch.load(cpt_path, map_location="cpu"))
+model.eval()
+
+#* 兩個 transformer 輪流掛到同一個 model 上, VQGAN 等其他部分共用
+fp_gpt = model.transformer
+int8_gpt = quantize_gpt(fp_gpt)
+
+if args.save is not None:
+    torch.save(int8_gpt.state_dict(), args.save)
+    print(f"save int8 GPT to {args.save}")
+
+# load dataloader
+from src.data.realestate.re10k_dataset import Re10k_dataset
+dataset_abs = Re10k_dataset(data_root="../dataset",mode="test",infer_len=args.len)
+
+test_loader_abs = torch.utils.data.DataLoader(
+        dataset_abs,
+        batch_size=1,
+        shuffle=False,
+        num_workers=0,
+        drop_last = True
+    )
+
+@torch.no_grad()
+def first_frame_tokens(temp_model, batch):
+    #* 第一張 frame 兩個 model 的 condition 完全一樣 (frame0 + camera), 用來比 token 一致率
+    example = dict()
+    example["K"] = batch["K"]
+    example["K_inv"] = batch["K_inv"]
+    example["R_rel"], example["t_rel"] = temp_model.compute_camera_pose(batch["R_s"][:, 1], batch["t_s"][:, 1],
+                                                                       batch["R_s"][:, 0], batch["t_s"][:, 0])
+    _, c_indices = temp_model.encode_to_c(batch["rgbs"][:, :, 0, ...])
+    c_emb = temp_model.transformer.tok_emb(c_indices)
+    prototype = torch.cat([c_emb, temp_model.encode_to_e(example)], 1)
+    p1 = temp_model.encode_to_p(example)
+
+    index_sample, _ = temp_model.sample_latent(c_indices[:, :0], prototype, [p1, None, None],
+                                   steps=c_indices.shape[1],
+                                   k_ori=batch["K_ori"],w2c=batch["w2c_seq"][:,0:3,...],
+                                   temperature=1.0,
+                                   sample=False,
+                                   top_k=100)
+    return index_sample
+
+def rollout_psnr(temp_model, batch):
+    start = time.time()
+    video_clips, _ = temp_model.rollout(batch, args.len, temperature=1.0, sample=False, top_k=100)
+    elapsed = time.time() - start
+
+    values = []
+    for i in range(1, len(video_clips)):
+        t_img = (batch["rgbs"][:, :, i, ...] + 1)/2
+        p_img = (video_clips[i] + 1)/2
+        values.append(psnr(p_img, t_img).mean().item())
+    return np.mean(values), elapsed
+
+agreements = []
+psnr_fp = []
+psnr_int8 = []
+time_fp = []
+time_int8 = []
+
+pbar = tqdm(total=args.video_limit)
+b_i = 0
+iteration = iter(test_loader_abs)
+while b_i < args.video_limit:
+    try:
+        batch, index, inter_index = next(iteration)
+    except StopIteration:
+        break
+
+    tokens = []
+    for gpt, psnrs, times in [(fp_gpt, psnr_fp, time_fp), (int8_gpt, psnr_int8, time_int8)]:
+        model.transformer = gpt
+        tokens.append(first_frame_tokens(model, batch))
+        value, elapsed = rollout_psnr(model, batch)
+        psnrs.append(value)
+        times.append(elapsed)
+
+    agreements.append((tokens[0] == tokens[1]).float().mean().item())
+
+    pbar.update(1)
+    b_i += 1
+
+pbar.close()
+model.transformer = fp_gpt
+
+with open(os.path.join(target_save_path, "quantize.txt"), 'w') as f:
+    for i in range(len(agreements)):
+        f.write("#%d, token agreement: %.04f, psnr fp32: %.02f, psnr int8: %.02f" % (i, agreements[i], psnr_fp[i], psnr_int8[i]))
+        f.write('\n')
+
+    summary = ("Total, token agreement: %.04f, psnr fp32: %.03f, psnr int8: %.03f, psnr delta: %.03f, time fp32: %.02fs, time int8: %.02fs"
+               % (np.mean(agreements), np.mean(psnr_fp), np.mean(psnr_int8), np.mean(psnr_int8) - np.mean(psnr_fp),
+                  np.mean(time_fp), np.mean(time_int8)))
+    f.write(summary)
+    f.write('\n')
+print(summary)
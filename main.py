@@ -22,6 +22,7 @@ from distributed import (
     reduce_sum,
     get_world_size,
 )
+from src.modules.transformer.mingpt_adaptive import autocast
 
 def sample_data(loader):
     while True:
@@ -39,10 +40,9 @@ def data_sampler(dataset, shuffle, distributed):
         return data.SequentialSampler(dataset)
     
 def worker_init_fn_seed(worker_id):
-    seed = 10
-    seed += worker_id
-    np.random.seed(seed)
-    print(worker_id)
+    #* 每個 worker 的 numpy random state 不一樣, 不然每個 worker 抽到一樣的 frame
+    #* torch 給每個 worker (每個 epoch) 的 seed 都不同, 固定的 10 + worker_id 會讓每個 epoch 抽到一樣的 frame
+    np.random.seed(torch.initial_seed() % 2**32)
 
 def get_obj_from_str(string, reload=False):
     module, cls = string.rsplit(".", 1)
@@ -75,7 +75,7 @@ if __name__ == '__main__':
                         help="experiments name")
     parser.add_argument("--data-path", type=str, default="/latent_opt_test/RealEstate10K_Downloader/",
                         help="data path")
-    parser.add_argument("--batch-size", type=int, default=2, help="")
+    parser.add_argument("--batch-size", type=int, default=2, help="2 fits in fp32, more with --precision bf16 / fp16")
     parser.add_argument("--ckpt-iter", type=int, default=50000,
                         help="interval for visual the result")
     parser.add_argument("--visual-iter", type=int, default=500,
@@ -85,6 +85,13 @@ if __name__ == '__main__':
     parser.add_argument("--len", type=int, default=3, help="")
     parser.add_argument("--gap", type=int, default=3, help="") # disable in realestate
     parser.add_argument('--gpu', default= '0,1,2,3', type=str)
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "fp16", "bf16"],
+                        help="autocast precision of the forward, fp16 also turns on loss scaling")
+    parser.add_argument("--checkpoint-every", type=int, default=None,
+                        help="activation checkpointing every N GPT blocks (0 = off), default from the config")
+    parser.add_argument("--num-workers", type=int, default=0, help="DataLoader worker processes")
+    parser.add_argument("--precompute-epipolar", type=str, default=None, choices=["uint8", "fp16"],
+                        help="compute the epipolar maps in the DataLoader workers and ship them in this dtype (realestate only)")
     parser.add_argument(
             "--local_rank", type=int, default=0, help="local rank for distributed training"
         )
@@ -121,6 +128,8 @@ if __name__ == '__main__':
     config = OmegaConf.load(args.base)
     # init model
     model = instantiate_from_config(config.model)
+    if args.checkpoint_every is not None:
+        model.transformer.checkpoint_every = args.checkpoint_every
     # init optim
     base_lr = config.model.base_learning_rate
     bs = args.batch_size
@@ -128,6 +137,8 @@ if __name__ == '__main__':
     print("Setting learning rate to {:.2e} = {} (accumulate_grad_batches) * {} (num_gpus) * {} (batchsize) * {:.2e} (base_lr)".format(model.learning_rate, accumulate_grad_batches, ngpu, bs, base_lr))
 
     optimizer, scheduler = model.configure_optimizers()
+    #* fp16 的 gradient 容易 underflow, 要 loss scaling; bf16 跟 fp32 的 exponent 一樣不需要
+    scaler = torch.cuda.amp.GradScaler(enabled=args.precision == "fp16")
 
     # set to DDP
     model.cuda()
@@ -145,8 +156,11 @@ if __name__ == '__main__':
         sparse_dir = "%s/sparse/" % args.data_path
         image_dir = "%s/dataset/" % args.data_path
         # dataset = VideoDataset(sparse_dir = sparse_dir, image_dir = image_dir, length = time_len, low = 3, high = 20)
-        dataset = Re10k_dataset(data_root="../dataset",mode="train")
+        dataset = Re10k_dataset(data_root="../dataset",mode="train",epipolar_dtype=args.precompute_epipolar)
     elif args.dataset == "mp3d":
+        #* mp3d 沒有 K_ori / w2c_seq, epipolar model 只能在 realestate 上跑
+        if args.precompute_epipolar is not None:
+            raise ValueError("--precompute-epipolar is only supported for realestate, mp3d has no epipolar maps")
         from src.data.mp3d.mp3d_cview import VideoDataset
         dataset = VideoDataset(root_path = args.data_path, length = time_len, gap = args.gap)
     else:
@@ -156,6 +170,9 @@ if __name__ == '__main__':
             dataset,
             batch_size=bs,
             sampler=data_sampler(dataset, shuffle=True, distributed=args.distributed),
+            num_workers=args.num_workers,
+            worker_init_fn=worker_init_fn_seed,
+            pin_memory=args.num_workers > 0,
             drop_last=True
     )
 
@@ -177,24 +194,35 @@ if __name__ == '__main__':
         batch = next(train_loader)
 
         for key in batch.keys():
-            batch[key] = batch[key].cuda()
+            batch[key] = batch[key].cuda(non_blocking=True)
         
-        forecasts, gts, loss, log_dict = module(batch)
+        #* 只有 forward 在 autocast 裡, backward 會沿用 forward 時的 dtype
+        with autocast(args.precision):
+            forecasts, gts, loss, log_dict = module(batch)
         # forecasts, gts, loss_all, loss_forward, forecasts_forward = module(batch)
         # loss = loss_all + loss_forward
 
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
         scheduler.step()
 
+        #* 這一步的 peak memory (GB), 拿來比較 checkpoint_every / batch size / precision 的組合
+        peak_mem = torch.cuda.max_memory_allocated() / 2**30
+        torch.cuda.reset_peak_memory_stats()
+
         # update tensorboard
         summary.add_scalar(tag='loss', scalar_value=loss.mean().item(), global_step=idx)
+        summary.add_scalar(tag='peak_mem_gb', scalar_value=peak_mem, global_step=idx)
         # summary.add_scalar(tag='loss_forward', scalar_value=loss_forward.mean().item(), global_step=idx)
         # summary.add_scalar(tag='loss_all', scalar_value=loss_all.mean().item(), global_step=idx)
         
         if get_rank() == 0:
-            pbar.set_description((f"loss: {loss:.4f};"))
+            pbar.set_description((f"loss: {loss:.4f}; mem: {peak_mem:.2f}G;"))
+            if idx == 0:
+                print("peak memory of one step: %.2f GB (batch size %d, %s, checkpoint every %d blocks)"
+                      % (peak_mem, bs, args.precision, module.transformer.checkpoint_every))
 
             if idx % args.ckpt_iter == 0:
                 torch.save(module.state_dict(), os.path.join(save_dir, f"{idx}.ckpt"))
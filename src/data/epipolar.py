@@ -0,0 +1,58 @@
+import numpy as np
+
+#* iter_forward 用到的 6 個 camera pair (src, target), 順序 f01 f02 f12 b01 b02 b12
+EPIPOLAR_PAIRS = [(0, 1), (0, 2), (1, 2), (1, 0), (2, 0), (2, 1)]
+
+def re10k_grid_intrinsics(K_ori, h=16):
+    """
+    normalized RealEstate10K intrinsics -> intrinsics on the h x h token grid, same convention as
+    GPT.get_epipolar_tensors (16:9 source image, principal point at h/2)
+    """
+    K = np.array(K_ori, dtype=np.float64)[0:3, 0:3] * np.array([[h*16/9], [h], [1.]])
+    K[0, 2] = h/2
+    K[1, 2] = h/2
+    return K
+
+def epipolar_maps(K, w2cs, pairs=EPIPOLAR_PAIRS, h=16, w=16, steep=5, offset=0.75):
+    """
+    numpy version of GPT.get_epipolar_tensors for one sample, runs in the DataLoader workers.
+    K: (3,3) intrinsics on the token grid, w2cs: list of (4,4) w2c, pairs: (src, target) frame index.
+    returns (P, hw, hw) float32, row = target pixel, column = src pixel
+    """
+    K = np.asarray(K, dtype=np.float64)
+    K_inv = np.linalg.inv(K)
+    w2cs = [np.asarray(w2c, dtype=np.float64) for w2c in w2cs]
+
+    y_coords, x_coords = np.meshgrid(np.arange(h), np.arange(w), indexing="ij")
+    coords = np.stack([x_coords.flatten(), y_coords.flatten(), np.ones(h*w)], 1)   #* (hw,3)
+
+    fundamentals = []
+    for src, target in pairs:
+        src_r, src_t = w2cs[src][0:3, 0:3], w2cs[src][0:3, 3]
+        #* 跟 get_epipolar_tensors 一樣, target 的 c2w 用 (R^T, -t)
+        target_c2w_r, target_c2w_t = w2cs[target][0:3, 0:3].T, -w2cs[target][0:3, 3]
+
+        ray = K @ src_r @ target_c2w_r @ K_inv
+        e = K @ (src_r @ target_c2w_t + src_t)
+        e_cross = np.array([[0., -e[2], e[1]],
+                            [e[2], 0., -e[0]],
+                            [-e[1], e[0], 0.]])
+        fundamentals.append(e_cross @ ray)
+    fundamentals = np.stack(fundamentals)                              #* (P,3,3)
+
+    lines = coords @ fundamentals.transpose(0, 2, 1)                   #* (P,hw,3)
+    distance = np.abs(lines @ coords.T) / np.linalg.norm(lines[..., 0:2], axis=-1, keepdims=True)
+
+    epipolar_map = 1 - 1 / (1 + np.exp(-steep*(distance-offset)))
+
+    #* epipolar line 不在畫面內就整個 row 都看
+    epipolar_map[epipolar_map.max(-1) < 0.5] = 1
+    return epipolar_map.astype(np.float32)
+
+def pack_epipolar_maps(maps, dtype="uint8"):
+    """ maps in [0,1] -> compact array for the batch, GPT.iter_forward turns it back into float """
+    if dtype == "uint8":
+        return np.round(maps * 255).astype(np.uint8)
+    if dtype == "fp16":
+        return maps.astype(np.float16)
+    raise ValueError(f"unknown epipolar map dtype {dtype}, should be uint8 or fp16")
@@ -7,6 +7,8 @@ from PIL import Image
 from einops import rearrange
 import re
 
+from src.data.epipolar import EPIPOLAR_PAIRS, re10k_grid_intrinsics, epipolar_maps, pack_epipolar_maps
+
 #! ------------------------------------------ 
 #! LOR utils
 
@@ -110,11 +112,15 @@ def custom_sort(file_name):
         return file_name
 
 class Re10k_dataset(Dataset):
-    def __init__(self,data_root,mode,max_interval=5,midas_transform = None,infer_len = 20,do_latent = False):
+    def __init__(self,data_root,mode,max_interval=5,midas_transform = None,infer_len = 20,do_latent = False,epipolar_dtype = None):
         assert mode == 'train' or mode == 'test' or mode == 'finetune'
 
         self.mode = mode
 
+        #* train 時在 DataLoader worker 裡先算好 6 個 epipolar map (uint8 / fp16), None = 在 GPU 上算
+        assert epipolar_dtype is None or mode == 'train', 'epipolar maps are only precomputed for the 3-frame training windows'
+        self.epipolar_dtype = epipolar_dtype
+
         self.inform_root = '{}/RealEstate10K/{}'.format(data_root, mode)
         # self.image_root = '{}/realestate/{}'.format(data_root, mode)
         self.image_root = '{}/realestate_4fps/{}'.format(data_root, mode)
@@ -404,6 +410,9 @@ class Re10k_dataset(Dataset):
             "t_12": t_12.astype(np.float32),
             "w2c_seq": w2c_tensor,
         }
+        if self.epipolar_dtype is not None:
+            maps = epipolar_maps(re10k_grid_intrinsics(K_ori), w2c[:3], EPIPOLAR_PAIRS)
+            example["epipolar_maps"] = pack_epipolar_maps(maps, self.epipolar_dtype)
 
         Rs = []
         ts = []
@@ -34,10 +34,14 @@ def cos_sim(in0, in1):
 class PNet(nn.Module):
     """Pre-trained network with all channels equally weighted by default"""
 
-    def __init__(self, pnet_type="vgg", pnet_rand=False, use_gpu=True):
+    def __init__(self, pnet_type="vgg", pnet_rand=False, use_gpu=True, device=None):
         super(PNet, self).__init__()
 
-        self.use_gpu = use_gpu
+        # device overrides use_gpu, e.g. device="cpu" on machines without a GPU
+        if device is None:
+            device = "cuda" if use_gpu else "cpu"
+        self.device = torch.device(device)
+        self.use_gpu = self.device.type == "cuda"
 
         self.pnet_type = pnet_type
         self.pnet_rand = pnet_rand
@@ -64,10 +68,9 @@ class PNet(nn.Module):
 
         self.L = self.net.N_slices
 
-        if use_gpu:
-            self.net.cuda()
-            self.shift = self.shift.cuda()
-            self.scale = self.scale.cuda()
+        self.net.to(self.device)
+        self.shift = self.shift.to(self.device)
+        self.scale = self.scale.to(self.device)
 
     def forward(self, in0, in1, retPerLayer=False):
         in0_sc = (in0 - self.shift.expand_as(in0)) / self.scale.expand_as(in0)
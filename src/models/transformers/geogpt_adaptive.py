@@ -8,10 +8,12 @@ from torch.optim.lr_scheduler import LambdaLR
 from einops import rearrange
 
 from src.main import instantiate_from_config
+from src.modules.transformer.mingpt_adaptive import sample_logits, full_precision, with_precision
 
 from timm.models.layers import trunc_normal_
 from timm.models.vision_transformer import Block
 
+import math
 import random
 
 class MAE_Encoder(torch.nn.Module):
@@ -55,6 +57,33 @@ def disabled_train(self, mode=True):
     does not change anymore."""
     return self
 
+class RolloutSession:
+    """
+    what a sliding-window rollout can reuse from one window to the next.
+    a frame enters as the target of one window and then shifts into the condition slots
+    of the following ones; its VQ indices / token embeddings do not depend on the slot,
+    so they are encoded once and reused. the role/time embeddings of the new slot are
+    added by the transformer and only the camera tokens have to be recomputed.
+    """
+    def __init__(self, model, keep=3):
+        self.model = model
+        self.keep = keep    #* 只需要留 window 內的 frame
+        self.frames = {}    #* frame idx -> (img, c_indices, c_emb)
+
+    @torch.no_grad()
+    def frame_tokens(self, idx, img):
+        cached = self.frames.get(idx)
+        #* 同一個 tensor 才能直接拿, 被 siamese 換掉的 frame 要重新 encode
+        if cached is not None and cached[0] is img:
+            return cached[1], cached[2]
+
+        _, c_indices = self.model.encode_to_c(img)
+        c_emb = self.model.transformer.tok_emb(c_indices)
+        self.frames[idx] = (img, c_indices, c_emb)
+        for old_idx in [k for k in self.frames if k <= idx - self.keep]:
+            del self.frames[old_idx]
+        return c_indices, c_emb
+
 class GeoTransformer(nn.Module):
     def __init__(self,
                  transformer_config,
@@ -143,12 +172,14 @@ class GeoTransformer(nn.Module):
                 self.emb_stage_model.train = disabled_train
 
     @torch.no_grad()
+    @full_precision
     def encode_to_z(self, x):
         quant_z, _, info = self.first_stage_model.encode(x)
         indices = info[2].view(quant_z.shape[0], -1)
         return quant_z, indices
 
     @torch.no_grad()
+    @full_precision
     def encode_to_c(self, c):
         quant_c, _, info = self.cond_stage_model.encode(c)
         indices = info[2].view(quant_c.shape[0], -1)
@@ -183,9 +214,20 @@ class GeoTransformer(nn.Module):
 
         return p
 
+    def compute_camera_pose(self, R_dst, t_dst, R_src, t_src):
+        R_src_inv = R_src.transpose(-1,-2)
+
+        R_rel = torch.matmul(R_dst, R_src_inv)
+        t_rel = t_dst.unsqueeze(-1)-torch.matmul(R_rel, t_src.unsqueeze(-1))
+
+        return R_rel, t_rel[:, :, 0]
+
     def forward(self, batch):
         # get time
         B, time_len = batch["rgbs"].shape[0], batch["rgbs"].shape[2]
+        #* frame / camera token 的位置跟 frame pair 的順序都照 transformer 的 SequenceLayout
+        layout = self.transformer.layout
+        assert time_len == layout.time_len, (time_len, layout.time_len)
         
         # create dict
         example = dict()
@@ -211,24 +253,15 @@ class GeoTransformer(nn.Module):
             # print(f"c_indice shape = {c_indices.shape}")
             # print(f"c_emb shape = {c_emb.shape}")
             
-            if t == 0:
-                example["R_rel"] = batch["R_01"]
-                example["t_rel"] = batch["t_01"]
-                #* encode camera 參數 (30個) encode成1024 channel
-                #* R(3x3) t(3x1) K(3x3) K-inv(3x3)
-                #* (B,30,1) -> nn.linear -> (B,30,1024)
-                #* (B,30,1024)
-                embeddings_warp = self.encode_to_e(example) 
-                #* 單純將camera 參數concat, (B,30)
-                p.append(self.encode_to_p(example))
-                conditions.append(embeddings_warp)
-                
-            if t == 1:
-                example["R_rel"] = batch["R_02"]
-                example["t_rel"] = batch["t_02"]
-                embeddings_warp = self.encode_to_e(example)
-                p.append(self.encode_to_p(example))
-                conditions.append(embeddings_warp)
+            #* frame t 後面接 camera 0 -> t+1 (t = 0: R_01, t = 1: R_02 ...)
+            example["R_rel"] = batch["R_0%d" % (t+1)]
+            example["t_rel"] = batch["t_0%d" % (t+1)]
+            #* encode camera 參數 (30個) encode成1024 channel
+            #* R(3x3) t(3x1) K(3x3) K-inv(3x3)
+            #* (B,30,1) -> nn.linear -> (B,30,1024)
+            #* (B,30,1024)
+            embeddings_warp = self.encode_to_e(example) 
+            conditions.append(embeddings_warp)
 
             if t > 0:
                 gts.append(c_indices) #* for loss, 要將gt機率與 predict結果做cross entropy loss
@@ -241,24 +274,27 @@ class GeoTransformer(nn.Module):
         
         #* condition = [rgb1_emb,cam01_emb,rgb2_emb,cam12_emb,rgb3_emb]
         conditions = torch.cat(conditions, 1) # B, L, 1024
-        prototype = conditions[:, 0:286, :] #* 286 = 256 (16x16 rgb emb) + 30 (camera emb), 應該代表已知條件?
-        z_emb = conditions[:, 286::, :]
+        prototype = conditions[:, 0:layout.n_unmasked, :] #* 286 = 256 (16x16 rgb emb) + 30 (camera emb), 應該代表已知條件?
+        z_emb = conditions[:, layout.n_unmasked::, :]
         
-        # p3 
-        example["R_rel"] = batch["R_12"]
-        example["t_rel"] = batch["t_12"]
-        p.append(self.encode_to_p(example))
+        #* 每個 frame pair (s, t) 的 camera 參數 concat, (B,30), 順序 p1 = 01, p2 = 02, p3 = 12 ...
+        for s, t in layout.pairs:
+            example["R_rel"] = batch["R_%d%d" % (s, t)]
+            example["t_rel"] = batch["t_%d%d" % (s, t)]
+            p.append(self.encode_to_p(example))
         
         #* logits shape = (B,827,16384)
-        logits, _ = self.transformer.iter_forward(prototype, z_emb, p = p,k=batch["K_ori"],w2c=batch['w2c_seq'])
+        #* dataset 有先算好 epipolar map 就直接用, 沒有的話在 iter_forward 裡用 K_ori / w2c_seq 算
+        logits, _ = self.transformer.iter_forward(prototype, z_emb, p = p,k=batch.get("K_ori"),w2c=batch.get('w2c_seq'),
+                                                  epipolar_maps=batch.get("epipolar_maps"))
         #* logits shape = (B,542,16384)
         #* 542 = 256+30+256
         logits = logits[:, prototype.shape[1]-1:] 
         
-        for t in range(0, time_len-2):
-            forecasts.append(logits[:, 286*t:286*t+256, :]) #* 預測的第二個rgb 字典機率
-        
-        forecasts.append(logits[:, -256::, :]) # final frame    #* 預測的第三個rgb 字典機率
+        #* 預測第 t 個 rgb 的字典機率 (第二個, 第三個 ...)
+        for t in range(1, time_len):
+            start, end = layout.rows(t)
+            forecasts.append(logits[:, start-(prototype.shape[1]-1):end-(prototype.shape[1]-1), :])
         
         loss, log_dict = self.compute_loss(torch.cat(forecasts, 0), torch.cat(gts, 0), split="train")
         
@@ -308,46 +344,49 @@ class GeoTransformer(nn.Module):
 
         return x, bias
     
-    @torch.no_grad()
-    def sample_latent(self, x, c, p, steps,k_ori=None,w2c=None,temperature=1.0, sample=False, top_k=None,
-               callback=lambda k: None, embeddings=None,show=False, **kwargs):
-        # in the current variant we always use embeddings for camera
-        # assert embeddings is not None
-        # check n_unmasked and conditioning length
-        # total_cond_length = embeddings.shape[1] + c.shape[1]
-        # assert total_cond_length == self.transformer.config.n_unmasked, (
-        #     embeddings.shape[1], c.shape[1], self.transformer.config.n_unmasked)
-
-        assert not self.transformer.training
-
-        #* 計算epipolar map [forward,backward,bidirectional,token_change]
-        #! 將epipolar 的計算拿出來做，不需要每個token 都算一次
-        batch = x.shape[0]
+    def get_epipolar_maps(self, k_ori, w2c):
+        """ forward / backward epipolar maps of one window, None for the directions the model doesn't use """
         forward_epipolar_map = None
         backward_epipolar_map = None
         if self.epipolar!=None:
+            assert k_ori is not None and w2c is not None, "epipolar models need K_ori / w2c_seq in the batch (realestate only, mp3d is not supported)"
+            #* f01 跟 b01 一次算完
+            epipolar_maps = self.transformer.cached_epipolar_tensors(16,16,k_ori,
+                                                                     torch.stack([w2c[:,0], w2c[:,1]],1),
+                                                                     torch.stack([w2c[:,1], w2c[:,0]],1))
             if self.epipolar == 'forward' or self.epipolar == 'bidirectional':
-                
-                w2c_0 = w2c[:,0]
-                w2c_1 = w2c[:,1]
-                # w2c_2 = w2c[:,2]
-                f01 = self.transformer.get_epipolar_tensor(batch,16,16,k_ori.clone(),w2c_0,w2c_1)
+                f01 = epipolar_maps[:,0]
                 f02 = f01.clone()
                 f12 = f01.clone()
                 # f02 = self.transformer.get_epipolar_tensor(batch,16,16,k_ori.clone(),w2c_0,w2c_2)
                 # f12 = self.transformer.get_epipolar_tensor(batch,16,16,k_ori.clone(),w2c_1,w2c_2)
                 forward_epipolar_map = [f01,f02,f12]
             if self.epipolar == 'backward' or self.epipolar == 'bidirectional':
-                # forward_epipolar_map = get_epipolar_tensor(1,h,h,k2.clone(),prev_w2c,now_w2c)
-                w2c_0 = w2c[:,0]
-                w2c_1 = w2c[:,1]
-                # w2c_2 = w2c[:,2]
-                b01 = self.transformer.get_epipolar_tensor(batch,16,16,k_ori.clone(),w2c_1,w2c_0)
+                b01 = epipolar_maps[:,1]
                 b02 = b01.clone()
                 b12 = b01.clone()
                 # b02 = self.transformer.get_epipolar_tensor(batch,16,16,k_ori.clone(),w2c_2,w2c_0)
                 # b12 = self.transformer.get_epipolar_tensor(batch,16,16,k_ori.clone(),w2c_2,w2c_1)
                 backward_epipolar_map = [b01,b02,b12]
+
+        return forward_epipolar_map, backward_epipolar_map
+
+    @torch.no_grad()
+    @with_precision
+    def sample_latent(self, x, c, p, steps,k_ori=None,w2c=None,temperature=1.0, sample=False, top_k=None,
+               callback=lambda k: None, embeddings=None,show=False,use_cache=True, decode="dynamic", **kwargs):
+        # in the current variant we always use embeddings for camera
+        # assert embeddings is not None
+        # check n_unmasked and conditioning length
+        # total_cond_length = embeddings.shape[1] + c.shape[1]
+        # assert total_cond_length == self.transformer.config.n_unmasked, (
+        #     embeddings.shape[1], c.shape[1], self.transformer.config.n_unmasked)
+
+        assert not self.transformer.training
+
+        #* 計算epipolar map [forward,backward,bidirectional,token_change]
+        #! 將epipolar 的計算拿出來做，不需要每個token 都算一次
+        forward_epipolar_map, backward_epipolar_map = self.get_epipolar_maps(k_ori, w2c)
         
         x_second = x.clone()
         x_third = x.clone()
@@ -355,55 +394,406 @@ class GeoTransformer(nn.Module):
         randk = random.randint(0, steps-1)
         randk = 88
         bi_epi_ratio = None
+        #* show 只在 randk 這一步抓每個 epipolar layer 的 attention map, 其他步照樣走 cache
+        show_hooks = []
+        if show:
+            for i in range(0, len(self.transformer.blocks), 2):
+                show_hooks.append([self.transformer.register_attn_hook(i, kind=kind, step=randk)
+                                   for kind in ("epipolar", "weight", "forward")])
+        #* decode: "dynamic" 用會長大的 KVCache, "static" / "compile" / "graph" 用固定大小的 StaticDecoder
+        past = None
+        decoder = None
         for k in range(steps):
             callback(k)
             x_cond = x            
-            logits,epipolar_attn_maps, attn_weights, attn_weights_for,ratio = self.transformer.test(c, x_cond, p,
+            if use_cache:
+                if self.transformer.attn_hooks and self.transformer.wants_attn(k):
+                    #* 這一步有註冊的 attention map 要看, 另外跑一次完整的 test() 去抓, 不用算 logits
+                    self.transformer.test(c, x_cond, p,
+                                          forward_epipolar_map=forward_epipolar_map,
+                                          backward_epipolar_map=backward_epipolar_map,
+                                          embeddings=embeddings,
+                                          positions=slice(0, 0),
+                                          step=k,
+                                          inference=True)
+                #* 第一步跑完整個 condition, 之後只餵新的 token, 其餘的 key/value 從 cache 拿
+                if past is None:
+                    logits, past, ratio = self.transformer.test_with_past(c, x_cond, p,
                                                 forward_epipolar_map=forward_epipolar_map,
                                                 backward_epipolar_map=backward_epipolar_map,
-                                                embeddings=embeddings,return_attn = show)
+                                                embeddings=embeddings,
+                                                positions=slice(-1, None))
+                    if decode != "dynamic":
+                        decoder = self.transformer.static_decoder(decode, x.shape[0], x.device)
+                        decoder.start(past, forward_epipolar_map, backward_epipolar_map)
+                elif decoder is not None:
+                    logits = decoder.step(x_cond[:, -1:])
+                    ratio = None
+                else:
+                    logits, past, ratio = self.transformer.test_with_past(None, x_cond[:, -1:], p,
+                                                forward_epipolar_map=forward_epipolar_map,
+                                                backward_epipolar_map=backward_epipolar_map,
+                                                past=past)
+            else:
+                logits,_,_,_,ratio = self.transformer.test(c, x_cond, p,
+                                                forward_epipolar_map=forward_epipolar_map,
+                                                backward_epipolar_map=backward_epipolar_map,
+                                                embeddings=embeddings,
+                                                positions=slice(-1, None),
+                                                step=k,
+                                                inference=True)
             
             #* 最後一個token, 最後一個layer, 的所有token 對應src image的attention 正確比例
             bi_epi_ratio = ratio
 
-            #* logits shape = (1, 286、287、288... ,16384)
-            logits_last = logits[:, -1, :] / temperature
-            if top_k is not None:
-                logits_last = self.top_k_logits(logits_last, top_k)
-            probs = F.softmax(logits_last, dim=-1)
-            
-            if sample:
-                ix = torch.multinomial(probs, num_samples=1)
-            else:
-                _, ix = torch.topk(probs, k=1, dim=-1)
+            #* 只算了最後一個 position 的 logits (B,1,16384)
+            ix = sample_logits(logits[:, -1:, :], temperature=temperature, top_k=top_k, sample=sample)
                 
             x = torch.cat((x, ix), dim=1)   
-
-            if randk == k:
-                return_weights = attn_weights
-                return_weights_for = attn_weights_for
-                return_attn_map = epipolar_attn_maps
         
+        if decoder is not None and steps > 1:
+            bi_epi_ratio = decoder.cache.frame_ratio()
+
         if show == False:
             return x,bi_epi_ratio
+
+        return_attn_map, return_weights, return_weights_for = [
+            [hooks[j].maps[0][1] if hooks[j].maps else None for hooks in show_hooks] for j in range(3)]
+        for hooks in show_hooks:
+            for hook in hooks:
+                self.transformer.remove_attn_hook(hook)
+
+        #* x_second / x_third 要最後一步所有 position 的 logits
+        logits,_,_,_,_ = self.transformer.test(c, x[:, :-1], p,
+                                        forward_epipolar_map=forward_epipolar_map,
+                                        backward_epipolar_map=backward_epipolar_map,
+                                        embeddings=embeddings)
         
+        #* 生成第二 / 第三個 frame 的 query row (285:541 / 571:827)
+        second_start, _ = self.transformer.layout.rows(1)
+        third_start, _ = self.transformer.layout.rows(2)
         for k in range(256):
-            logits_second = logits[:, 285+k, :] / temperature
+            logits_second = logits[:, second_start+k, :] / temperature
             if top_k is not None:
                 logits_second = self.top_k_logits(logits_second, top_k)
             probs = F.softmax(logits_second, dim=-1)
             _, ix = torch.topk(probs, k=1, dim=-1)
             x_second = torch.cat((x_second, ix), dim=1)   
 
-            if logits.shape[1] >= 572:
-                logits_third = logits[:, 571+k, :] / temperature
+            if logits.shape[1] > third_start:
+                logits_third = logits[:, third_start+k, :] / temperature
                 if top_k is not None:
                     logits_third = self.top_k_logits(logits_third, top_k)
                 probs = F.softmax(logits_third, dim=-1)
                 _, ix = torch.topk(probs, k=1, dim=-1)
                 x_third = torch.cat((x_third, ix), dim=1) 
 
-        return x,return_attn_map,return_weights,return_weights_for,randk,x_second,x_third,f12[0,randk],b12[0,randk],bi_epi_ratio
+        return x,return_attn_map,return_weights,return_weights_for,randk,x_second,x_third,forward_epipolar_map[2][0,randk],backward_epipolar_map[2][0,randk],bi_epi_ratio
+
+    @torch.no_grad()
+    @with_precision
+    def sample_latent_parallel(self, x, c, p, steps, k_ori=None, w2c=None, iterations=8, temperature=1.0,
+                               sample=False, top_k=None, init=None, **kwargs):
+        """
+        Jacobi / MaskGIT style version of sample_latent: all steps tokens of the frame are guessed
+        at once (init, e.g. the previous frame's tokens, else zeros) and every iteration re-predicts
+        the whole frame with one forward pass over the cached condition.
+        - the prefix up to the first guess that changed is exactly what sample_latent would produce,
+          it's locked and kept in sync with the new predictions
+        - the rest are locked by confidence with the MaskGIT cosine schedule, the unlocked
+          (low-confidence) tokens get re-predicted next iteration
+        iterations is the speed / quality knob: with greedy decoding and iterations >= steps the
+        result equals sample_latent, it stops early once every token is exact.
+        returns the same (x, bi_epi_ratio) as sample_latent
+        """
+        assert not self.transformer.training
+
+        B = c.shape[0]
+        forward_epipolar_map, backward_epipolar_map = self.get_epipolar_maps(k_ori, w2c)
+
+        def predict(logits):
+            return sample_logits(logits, temperature=temperature, top_k=top_k, sample=sample, return_prob=True)
+
+        #* condition 只跑一次, 之後每輪從 cache 的 condition 接著跑整個 frame
+        logits, past, _ = self.transformer.test_with_past(c, x, p,
+                                    forward_epipolar_map=forward_epipolar_map,
+                                    backward_epipolar_map=backward_epipolar_map,
+                                    positions=slice(-1, None))
+        cond_len = past.length
+        first, _ = predict(logits)
+
+        guess = x.new_zeros(B, steps) if init is None else init[:, :steps].clone()
+        guess[:, :1] = first
+        n_exact = torch.ones(B, dtype=torch.long, device=guess.device)
+        locked = torch.zeros(B, steps, dtype=torch.bool, device=guess.device)
+        locked[:, 0] = True
+        pos = torch.arange(steps, device=guess.device).unsqueeze(0)
+
+        bi_epi_ratio = None
+        for it in range(iterations):
+            if bool((n_exact >= steps).all()):
+                break
+
+            past.crop(cond_len)
+            logits, past, bi_epi_ratio = self.transformer.test_with_past(None, guess[:, :-1], p,
+                                        forward_epipolar_map=forward_epipolar_map,
+                                        backward_epipolar_map=backward_epipolar_map,
+                                        past=past)
+            ix, conf = predict(logits)
+            new = torch.cat([guess[:, :1], ix], 1)
+            conf = torch.cat([conf.new_ones(B, 1), conf], 1)
+
+            #* Jacobi: 第一個和 guess 不一樣的位置之前 context 都是對的, 那個位置的新預測也是對的
+            changed = (new != guess) & (pos >= n_exact.unsqueeze(1))
+            first_changed = torch.where(changed, pos, steps).min(dim=1)[0]
+            n_exact = (first_changed + 1).clamp(max=steps)
+            exact = pos < n_exact.unsqueeze(1)
+
+            guess = torch.where(locked & ~exact, guess, new)
+
+            #* MaskGIT: 依照 cosine schedule 把信心高的 token 鎖住, 剩下的下一輪再預測
+            n_lock = int(math.ceil(steps * (1 - math.cos(math.pi / 2 * (it + 1) / iterations))))
+            score = torch.where(exact | locked, torch.full_like(conf, float('inf')), conf)
+            rank = score.argsort(dim=1, descending=True).argsort(dim=1)
+            locked = exact | locked | (rank < n_lock)
+
+        #* bi_epi_ratio 是最後一輪 forward 的 (對應更新前的 guess)
+        if bi_epi_ratio is None:
+            past.crop(cond_len)
+            _, _, bi_epi_ratio = self.transformer.test_with_past(None, guess[:, :-1], p,
+                                        forward_epipolar_map=forward_epipolar_map,
+                                        backward_epipolar_map=backward_epipolar_map,
+                                        past=past,
+                                        positions=slice(0, 0))
+
+        return torch.cat((x, guess), dim=1), bi_epi_ratio
+
+    @torch.no_grad()
+    @with_precision
+    def sample_latent_candidates(self, x, c, p, steps, k_ori=None, w2c=None, n_candidates=4, beam=False,
+                                 score="logprob", temperature=1.0, sample=True, top_k=None, **kwargs):
+        """
+        N hypotheses of the same frame in one batch. the condition (prefix frames, camera tokens,
+        epipolar maps) is run once and its KVCache is copied to the N candidates.
+        beam=False: N independent samples (sample=True) scored at the end.
+        beam=True: beam search of width N, every step keeps the best N continuations and reorders
+                   the cache. score="logprob" ranks them on the accumulated log-probability,
+                   score="ratio" on the running mean bi_epi_ratio of the rows fed so far (ties on
+                   the log-probability).
+        score: "logprob" (accumulated log-probability of the tokens under the tempered top-k
+               distribution) or "ratio" (mean bi_epi_ratio of the frame, bidirectional only).
+        returns x (B, N, len), scores (B, N), logprob (B, N) and bi_epi_ratio (B, N, 256) or None,
+        candidates sorted best first
+        """
+        assert not self.transformer.training
+        assert score in ("logprob", "ratio")
+        assert score == "logprob" or self.epipolar == "bidirectional", "ratio score needs bidirectional epipolar attention"
+
+        B, N = c.shape[0], n_candidates
+        forward_epipolar_map, backward_epipolar_map = self.get_epipolar_maps(k_ori, w2c)
+
+        #* condition 只跑一次, 再把 cache 複製給 N 個 candidate
+        logits, past, ratio = self.transformer.test_with_past(c, x, p,
+                                    forward_epipolar_map=forward_epipolar_map,
+                                    backward_epipolar_map=backward_epipolar_map,
+                                    positions=slice(-1, None))
+        #* 這張 frame 的第一個 query row 是 condition 的最後一個 position
+        frame_start = past.length - 1
+        expand = torch.arange(B, device=c.device).repeat_interleave(N)
+        past.reorder(expand)
+        if forward_epipolar_map is not None:
+            forward_epipolar_map = [f.index_select(0, expand) for f in forward_epipolar_map]
+        if backward_epipolar_map is not None:
+            backward_epipolar_map = [b.index_select(0, expand) for b in backward_epipolar_map]
+        p = [q if q is None else q.index_select(0, expand) for q in p]
+        logits = logits.index_select(0, expand)
+        x = x.index_select(0, expand)
+
+        def log_probs(logits):
+            #* (B*N, V') 的 log-probability 以及對應的 token, top-k 只留 k 個候選
+            logits = logits[:, -1, :] / temperature
+            if top_k is not None:
+                logits, candidates = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1)
+            else:
+                candidates = None
+            return F.log_softmax(logits, dim=-1), candidates
+
+        logprob = c.new_zeros(B * N)
+        if beam:
+            #* 一開始 N 個 hypothesis 都一樣, 只留第一個才不會選到重複的
+            logprob.view(B, N)[:, 1:] = -float('inf')
+
+        for k in range(steps):
+            if k > 0:
+                logits, past, ratio = self.transformer.test_with_past(None, x[:, -1:], p,
+                                            forward_epipolar_map=forward_epipolar_map,
+                                            backward_epipolar_map=backward_epipolar_map,
+                                            past=past)
+            lp, candidates = log_probs(logits)
+            V = lp.shape[-1]
+
+            if beam:
+                total = (logprob.unsqueeze(1) + lp).view(B, N * V)
+                if score == "ratio":
+                    #* 先比 hypothesis 到目前為止的平均 bi_epi_ratio (它的 V 個 continuation 都一樣), 一樣再比 log-probability:
+                    #* ratio 的名次乘上比 log-probability 全距還大的間隔, 名次靠前的一定排在前面
+                    running = past.ratio[:, frame_start:past.length].mean(dim=-1).view(B, N)
+                    rank = (running.unsqueeze(1) > running.unsqueeze(2)).sum(dim=-1)
+                    finite = total.masked_fill(~torch.isfinite(total), 0)
+                    span = finite.amax(dim=-1) - finite.amin(dim=-1) + 1
+                    key = total - rank.repeat_interleave(V, dim=-1) * span.unsqueeze(1)
+                    best = key.topk(N, dim=-1).indices
+                    logprob = total.gather(-1, best)
+                else:
+                    logprob, best = total.topk(N, dim=-1)
+                logprob = logprob.view(B * N)
+                src = (best // V) + torch.arange(B, device=c.device).unsqueeze(1) * N  #* 從哪個 hypothesis 接下去
+                src = src.view(B * N)
+                ix = (best % V).view(B * N, 1)
+                if candidates is not None:
+                    ix = candidates.index_select(0, src).gather(-1, ix)
+                x = x.index_select(0, src)
+                past.reorder(src)
+                #* 這一步的 bi_epi_ratio 也跟著 hypothesis 換順序, 才會跟 x 對得上
+                if ratio is not None:
+                    ratio = ratio.index_select(0, src)
+            else:
+                if sample:
+                    choice = torch.multinomial(lp.exp(), num_samples=1)
+                else:
+                    choice = lp.argmax(dim=-1, keepdim=True)
+                logprob = logprob + lp.gather(-1, choice)[:, 0]
+                ix = choice if candidates is None else candidates.gather(-1, choice)
+
+            x = torch.cat((x, ix), dim=1)
+
+        #* 最後一步的 bi_epi_ratio 是整張 frame 的 (只有 bidirectional 才有)
+        bi_epi_ratio = ratio
+        if score == "ratio":
+            assert bi_epi_ratio is not None, "ratio score needs bidirectional epipolar attention"
+            scores = bi_epi_ratio.mean(dim=-1)
+        else:
+            scores = logprob
+
+        scores, order = scores.view(B, N).sort(dim=-1, descending=True)
+        order = (order + torch.arange(B, device=c.device).unsqueeze(1) * N).view(B * N)
+        x = x.index_select(0, order).view(B, N, -1)
+        logprob = logprob.index_select(0, order).view(B, N)
+        if bi_epi_ratio is not None:
+            bi_epi_ratio = bi_epi_ratio.index_select(0, order).view(B, N, -1)
+
+        return x, scores, logprob, bi_epi_ratio
+
+    @torch.no_grad()
+    def rollout_frames(self, batch, total_time_len, temperature=1.0, sample=False, top_k=100, refine=None,
+                       parallel_iters=None, candidates=None, beam=False, candidate_score="logprob",
+                       precision="fp32", decode="dynamic"):
+        """
+        generate the B trajectories of batch in lockstep: every window samples the next frame
+        of all videos together, with per-sample K / w2c, epipolar maps and bi_epi_ratio.
+        the first frame is conditioned on frame 0 only, every later one on the previous two.
+        refine(video_clips, bi_epi_ratio, window) may replace the newest frame (window is None
+        for the first frame).
+        parallel_iters switches every frame to sample_latent_parallel with that many refinement
+        iterations (initialized from the previous frame's tokens), None keeps sample_latent.
+        candidates samples that many hypotheses of every frame with sample_latent_candidates
+        (beam / candidate_score as there) and keeps the best one.
+        precision ("fp32" / "fp16" / "bf16") runs the GPT of every sampler under autocast, the VQ
+        encode / decode and the epipolar maps stay fp32.
+        decode picks the KV cache of sample_latent ("dynamic" / "static" / "compile" / "graph",
+        see StaticDecoder), the parallel / candidate samplers ignore it.
+        generator: yields (t, frame (B,3,H,W), bi_epi_ratio (B,256)) as soon as frame t is final,
+        so the caller can save / score it while the next frame is sampled. the decoded frame is
+        part of the next window's condition, so decode_to_img stays in here
+        """
+        B = batch["rgbs"].shape[0]
+        R_s, t_s = batch["R_s"], batch["t_s"]
+        k_ori = batch.get("K_ori")
+        w2c_seq = batch.get("w2c_seq")
+
+        video_clips = [batch["rgbs"][:, :, 0, ...]]
+        session = RolloutSession(self)
+
+        if candidates is not None:
+            def sample_frame(*args, **kwargs):
+                x, _, _, bi_epi_ratio = self.sample_latent_candidates(*args, n_candidates=candidates, beam=beam,
+                                                                      score=candidate_score, **kwargs)
+                return x[:, 0], None if bi_epi_ratio is None else bi_epi_ratio[:, 0]
+        elif parallel_iters is None:
+            sample_frame = self.sample_latent
+        else:
+            sample_frame = lambda *args, **kwargs: self.sample_latent_parallel(*args, iterations=parallel_iters, **kwargs)
+
+        # create dict
+        example = dict()
+        example["K"] = batch["K"]
+        example["K_inv"] = batch["K_inv"]
+
+        # first generate one frame
+        c_indices, c_emb = session.frame_tokens(0, video_clips[-1])
+        example["R_rel"], example["t_rel"] = self.compute_camera_pose(R_s[:, 1], t_s[:, 1], R_s[:, 0], t_s[:, 0])
+        prototype = torch.cat([c_emb, self.encode_to_e(example)], 1) #* (B,286,1024) rgb0+camera 的embed
+        p1 = self.encode_to_p(example)
+
+        index_sample, bi_epi_ratio = sample_frame(c_emb.new_zeros(B, 0, dtype=torch.long), prototype, [p1, None, None],
+                                        steps=c_emb.shape[1],
+                                        k_ori=k_ori,w2c=None if w2c_seq is None else w2c_seq[:,0:3,...],
+                                        temperature=temperature,
+                                        sample=sample,
+                                        top_k=top_k,
+                                        init=c_indices,
+                                        precision=precision,
+                                        decode=decode)
+        video_clips.append(self.decode_to_img(index_sample, [B, 256, 16, 16]))
+        if refine is not None:
+            video_clips[-1] = refine(video_clips, bi_epi_ratio, None)
+        yield len(video_clips)-1, video_clips[-1], bi_epi_ratio
+
+        for i in range(0, total_time_len-2):
+            conditions = []
+
+            _, c_emb = session.frame_tokens(len(video_clips)-2, video_clips[-2])
+            conditions.append(c_emb)
+            example["R_rel"], example["t_rel"] = self.compute_camera_pose(R_s[:, i+1], t_s[:, i+1], R_s[:, i], t_s[:, i])
+            conditions.append(self.encode_to_e(example))
+            p1 = self.encode_to_p(example)
+
+            c_indices, c_emb = session.frame_tokens(len(video_clips)-1, video_clips[-1])
+            conditions.append(c_emb)
+            example["R_rel"], example["t_rel"] = self.compute_camera_pose(R_s[:, i+2], t_s[:, i+2], R_s[:, i], t_s[:, i])
+            conditions.append(self.encode_to_e(example))
+            p2 = self.encode_to_p(example)
+
+            example["R_rel"], example["t_rel"] = self.compute_camera_pose(R_s[:, i+2], t_s[:, i+2], R_s[:, i+1], t_s[:, i+1])
+            p3 = self.encode_to_p(example)
+
+            prototype = torch.cat(conditions, 1)
+            index_sample, bi_epi_ratio = sample_frame(c_emb.new_zeros(B, 0, dtype=torch.long), prototype, [p1, p2, p3],
+                                            steps=c_emb.shape[1],
+                                            k_ori=k_ori,w2c=None if w2c_seq is None else w2c_seq[:,i:i+3,...],
+                                            temperature=temperature,
+                                            sample=sample,
+                                            top_k=top_k,
+                                            init=c_indices,
+                                            precision=precision,
+                                            decode=decode)
+            video_clips.append(self.decode_to_img(index_sample, [B, 256, 16, 16]))
+            if refine is not None:
+                video_clips[-1] = refine(video_clips, bi_epi_ratio, i)
+            yield len(video_clips)-1, video_clips[-1], bi_epi_ratio
+
+    @torch.no_grad()
+    def rollout(self, batch, total_time_len, **kwargs):
+        """
+        rollout_frames run to the end: returns video_clips (total_time_len tensors of (B,3,H,W))
+        and the bi_epi_ratio (B,256) of every generated frame
+        """
+        video_clips = [batch["rgbs"][:, :, 0, ...]]
+        ratios = []
+        for _, frame, bi_epi_ratio in self.rollout_frames(batch, total_time_len, **kwargs):
+            video_clips.append(frame)
+            ratios.append(bi_epi_ratio)
+        return video_clips, ratios
 
     @torch.no_grad()
     def sample(self, x, c, steps, temperature=1.0, sample=False, top_k=None,
@@ -445,6 +835,7 @@ class GeoTransformer(nn.Module):
 
 
     @torch.no_grad()
+    @full_precision
     def decode_to_img(self, index, zshape):
         bhwc = (zshape[0],zshape[2],zshape[3],zshape[1])
         quant_z = self.first_stage_model.quantize.get_codebook_entry(
@@ -9,6 +9,7 @@ from torch.optim.lr_scheduler import LambdaLR
 from einops import rearrange
 
 from src.main import instantiate_from_config
+from src.modules.transformer.mingpt_adaptive import full_precision
 
 def disabled_train(self, mode=True):
     """Overwrite model.train with this function to make sure train/eval mode
@@ -99,12 +100,14 @@ class GeoTransformer(nn.Module):
                 self.emb_stage_model.train = disabled_train
 
     @torch.no_grad()
+    @full_precision
     def encode_to_z(self, x):
         quant_z, _, info = self.first_stage_model.encode(x)
         indices = info[2].view(quant_z.shape[0], -1)
         return quant_z, indices
 
     @torch.no_grad()
+    @full_precision
     def encode_to_c(self, c):
         quant_c, _, info = self.cond_stage_model.encode(c)
         indices = info[2].view(quant_c.shape[0], -1)
@@ -441,6 +444,7 @@ class GeoTransformer(nn.Module):
 
 
     @torch.no_grad()
+    @full_precision
     def decode_to_img(self, index, zshape):
         bhwc = (zshape[0],zshape[2],zshape[3],zshape[1])
         quant_z = self.first_stage_model.quantize.get_codebook_entry(
@@ -0,0 +1,28 @@
+import torch
+import torch.nn.functional as F
+
+def confidence_noise(bi_epi_ratio, grid=16, scale=2):
+    """
+    bi_epi_ratio (B, grid*grid) of the 16x16 token grid -> masking noise (B, (grid*scale)^2) of the
+    siamese 8x8 patches. siamese keeps the smallest noise and masks the rest, bi_epi_ratio wants to
+    keep the largest, so the noise is 1/bi_epi_ratio, each token copied onto its scale x scale patches
+    """
+    ratio = bi_epi_ratio.reshape(-1, 1, grid, grid)
+    noise = 1 / F.interpolate(ratio, scale_factor=scale, mode="nearest")
+    return noise.flatten(1)
+
+def sample_siamese_masks(noise, n_masks, mask_ratio, candidates=0.5):
+    """
+    n_masks masking noises (n_masks, B, L) for siamese_model.forward(mask_example=...), all sampled
+    at once. every mask keeps int(L*(1-mask_ratio)) patches, a random subset (drawn per mask and
+    per sample) of the int(L*candidates) most confident ones: their noise is set to 0, below every
+    other patch, so siamese keeps exactly them. different masks reconstruct from different patches
+    """
+    B, L = noise.shape
+    n_keep = int(L * (1 - mask_ratio))
+    #* 每個 sample 最可信 (noise 最小) 的 candidates 比例的 patch
+    small_index = noise.argsort(dim=-1)[:, :int(L * candidates)]
+    #* 每個 mask 每個 sample 各自隨機取 n_keep 個 (random key 最小的 n_keep 個 = 隨機排列的前 n_keep 個)
+    pick = torch.rand(n_masks, B, small_index.shape[1], device=noise.device).topk(n_keep, dim=-1, largest=False, sorted=False).indices
+    keep = small_index.expand(n_masks, -1, -1).gather(-1, pick)
+    return noise.expand(n_masks, -1, -1).scatter(-1, keep, 0)
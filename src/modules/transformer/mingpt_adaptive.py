@@ -8,14 +8,24 @@ GPT model:
 - the final decoder is a linear projection into a vanilla Softmax classifier
 """
 
+import os
 import math
+import inspect
+import copy
+import hashlib
+import functools
 import logging
+from collections import OrderedDict
 import numpy as np
 
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 from einops import rearrange, reduce, repeat
+
+#* pytorch 2 要明確指定 use_reentrant (之後不給會直接報錯), torch 1.7 的 checkpoint 還沒有這個參數
+checkpoint_kwargs = {"use_reentrant": False} if "use_reentrant" in inspect.signature(checkpoint).parameters else {}
 import torchvision.transforms as T
 
 from src.main import instantiate_from_config
@@ -42,6 +52,58 @@ def get_sinusoid_encoding(n_position, d_hid):
     return torch.FloatTensor(sinusoid_table).unsqueeze(0)
 
 
+#### mixed precision
+amp_dtypes = {"fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+def autocast(precision="fp32", device_type="cuda"):
+    """
+    autocast context for precision in amp_dtypes. "fp32" gives a disabled autocast, which also
+    switches an outer autocast off (used for the parts that have to stay in fp32)
+    """
+    dtype = amp_dtypes[precision]
+    if hasattr(torch, "autocast"):
+        return torch.autocast(device_type=device_type, dtype=dtype, enabled=dtype is not None)
+    #* torch 1.7 只有 cuda 的 fp16 autocast
+    assert dtype in (None, torch.float16), f"{precision} autocast needs a newer pytorch"
+    return torch.cuda.amp.autocast(enabled=dtype is not None)
+
+def full_precision(fn):
+    """ decorator: fn runs with autocast off (epipolar geometry, VQ encode / codebook lookup / decode) """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with autocast("fp32", "cuda"), autocast("fp32", "cpu"):
+            return fn(*args, **kwargs)
+    return wrapper
+
+def with_precision(fn):
+    """ decorator for the GeoTransformer samplers: adds precision="fp32" | "fp16" | "bf16" """
+    @functools.wraps(fn)
+    def wrapper(self, *args, precision="fp32", **kwargs):
+        if precision == "fp32":
+            return fn(self, *args, **kwargs)
+        with autocast(precision, next(self.parameters()).device.type):
+            return fn(self, *args, **kwargs)
+    return wrapper
+
+
+def attention_chunk_rows(chunk_size, memory_mb, n_rows, n_keys, batch, n_head, n_buffers=3):
+    """
+    query rows per tile of the chunked attention, None = no chunking. chunk_size caps the tile,
+    memory_mb is a hard ceiling on the n_buffers fp32 (batch, n_head, rows, n_keys) scores / weights
+    one tile keeps alive at the same time (the attention working set, not the whole process)
+    """
+    if chunk_size is None and memory_mb is None:
+        return None
+    rows = n_rows if chunk_size is None else chunk_size
+    if memory_mb is not None:
+        row_bytes = n_buffers * batch * n_head * n_keys * 4
+        fit = int(memory_mb * 2**20) // row_bytes
+        if fit < 1:
+            raise ValueError(f"attn_memory_mb={memory_mb} is below one query row of attention ({row_bytes / 2**20:.3f} MB)")
+        rows = min(rows, fit)
+    return max(1, min(rows, n_rows))
+
+
 class GPTConfig:
     """ base GPT config, params common to all GPT versions """
     embd_pdrop = 0.1
@@ -60,14 +122,493 @@ class GPT1Config(GPTConfig):
     n_layer = 12
     n_head = 12
     n_embd = 768
-    
+
+
+class SequenceLayout:
+    """
+    token layout of the GPT input: frame 0, camera 0->1, frame 1, camera 0->2, ..., frame N-1,
+    shifted by one (the last token is never fed). the offsets of GPT, AdaptiveAttention,
+    CausalSelfAttention and GeoTransformer all come from here; every (earlier, later) frame pair
+    gets a locality / epipolar block. time_len = 3 is the original layout: frames 0:256 286:542
+    572:828, cameras 256:286 542:572, block_size 827, query rows 285:541 generate frame 1 and
+    571:827 frame 2
+    """
+    def __init__(self, time_len=3, img_dim=256, camera_dim=30):
+        self.time_len = time_len
+        self.img_dim = img_dim
+        self.camera_dim = camera_dim
+        stride = img_dim + camera_dim
+        self.frames = [(t*stride, t*stride + img_dim) for t in range(time_len)]
+        self.cameras = [(t*stride + img_dim, (t+1)*stride) for t in range(time_len-1)]
+        self.block_size = self.frames[-1][1] - 1
+        self.n_unmasked = stride    #* frame 0 + 第一個 camera 是 condition, 互相都看得到
+
+        #* frame pair (src, target), src < target; p / locality / epipolar map 都照這個順序: (0,1) (0,2) (1,2) ...
+        self.pairs = [(src, target) for target in range(1, time_len) for src in range(target)]
+        #* bi_epi_ratio 一律看最後兩張 frame 那個 pair 的 epipolar 區域 (原本的 f12*b12)
+        self.ratio_pair = len(self.pairs) - 1
+
+        #* (query row 起點, query row 終點, [(key 起點, key 終點, pair index)])
+        #* 生成 frame t 的 row 對前面每一張 frame 的 image token 做 epipolar
+        self.epipolar_segments = []
+        for target in range(1, time_len):
+            row_start, row_end = self.rows(target)
+            key_blocks = [(*self.frames[src], self.pairs.index((src, target))) for src in range(target)]
+            self.epipolar_segments.append((row_start, row_end, key_blocks))
+
+        #* 每個 position 在 cat([frame_emb, camera_emb], 1) 裡的 index
+        role_index = []
+        for t in range(time_len):
+            role_index += list(range(img_dim))
+            if t < time_len-1:
+                role_index += list(range(img_dim, stride))
+        self.role_index = torch.tensor(role_index[:self.block_size])
+
+    def rows(self, t):
+        """ query rows that predict the tokens of frame t """
+        start, end = self.frames[t]
+        return start - 1, end - 1
+
+    def segments(self, q0, q1):
+        """
+        epipolar segments hit by the query rows q0:q1, as (rows of att (q0 = row 0), rows of the
+        epipolar map, key blocks)
+        """
+        for row_start, row_end, key_blocks in self.epipolar_segments:
+            start = max(row_start, q0)
+            end = min(row_end, q1)
+            if start < end:
+                yield slice(start - q0, end - q0), slice(start - row_start, end - row_start), key_blocks
+
+    def completed_frame(self, t):
+        """ (row_start, row_end) of the frame whose last query row is t-1, None if t ends no frame """
+        for row_start, row_end, _ in self.epipolar_segments:
+            if t == row_end:
+                return row_start, row_end
+        return None
+
+    def context_rows(self):
+        """ query rows outside the epipolar segments (condition and camera tokens) """
+        rows, prev_end = [], 0
+        for row_start, row_end, _ in self.epipolar_segments:
+            rows.append((prev_end, row_start))
+            prev_end = row_end
+        rows.append((prev_end, self.block_size))
+        return [(start, end) for start, end in rows if start < end]
+
+
+class LayerCache:
+    """ keys/values of one attention layer, grows by the new positions on every decode step """
+    def __init__(self):
+        self.k = None
+        self.v = None
+
+    def __len__(self):
+        return 0 if self.k is None else self.k.shape[-2]
+
+    def append(self, k, v):
+        if self.k is not None:
+            k = torch.cat((self.k, k), dim=-2)
+            v = torch.cat((self.v, v), dim=-2)
+        self.k, self.v = k, v
+        return k, v
+
+    def crop(self, n):
+        if self.k is not None:
+            self.k = self.k[..., :n, :]
+            self.v = self.v[..., :n, :]
+
+    def reorder(self, index):
+        if self.k is not None:
+            self.k = self.k.index_select(0, index)
+            self.v = self.v.index_select(0, index)
+
+
+class KVCache:
+    """ state GPT.test_with_past keeps between decode steps of one frame """
+    def __init__(self, n_layer, batch, block_size, device):
+        self.layers = [LayerCache() for _ in range(n_layer)]
+        self.length = 0
+        self.h = None   #* locality bias (LocalityBias), 只有 adaptive block 需要
+        #* 每個 query row 在最後一個 epipolar layer 的 bi_epi_ratio, 一個 frame 生成完再一起回傳
+        self.ratio = torch.zeros(batch, block_size, device=device)
+
+    def crop(self, n):
+        #* 丟掉 n 之後的 position, 回到只有 condition 的狀態 (parallel decoding 每輪重跑整個 frame)
+        for layer in self.layers:
+            layer.crop(n)
+        self.length = n
+
+    def reorder(self, index):
+        #* 依 index 重排 batch (beam search 換 hypothesis, 或把同一個 condition 複製成多個 candidate)
+        for layer in self.layers:
+            layer.reorder(index)
+        self.ratio = self.ratio.index_select(0, index)
+        if self.h is not None:
+            self.h = self.h.index_select(index)
+
+
+class StaticKVCache:
+    """
+    fixed-size state of GPT.decode_step: keys / values of every layer preallocated to block_size,
+    the position is a (1,) tensor and everything that depends on it (causal mask row, locality
+    row, epipolar weighting) is gathered from full (T, T) tables. every decode step therefore has
+    the same shapes and no host sync, so it can go through torch.compile / a CUDA graph.
+    load() starts a frame from the KVCache of the condition, always by copying into the same buffers
+    """
+    def __init__(self, model, batch, device, dtype=torch.float32):
+        T = model.block_size
+        n_layer = len(model.blocks)
+        n_head = model.config.n_head
+        hs = model.config.n_embd // n_head
+        #* 每層各自一塊 buffer (不是同一個 tensor 的 slice), compile 後寫入才不會複製整個 cache
+        self.k = [torch.zeros(batch, n_head, T, hs, device=device, dtype=dtype) for _ in range(n_layer)]
+        self.v = [torch.zeros(batch, n_head, T, hs, device=device, dtype=dtype) for _ in range(n_layer)]
+        self.pos = torch.zeros(1, dtype=torch.long, device=device)
+        self.ratio = torch.zeros(batch, T, device=device)
+        self.pos_emb = torch.zeros(T, model.config.n_embd, device=device)   #* role_emb + time_emb
+        self.h = torch.zeros(batch, 1, T, T, device=device) if model.epipolar == None else None
+
+        self.layout = model.layout
+        self.epipolar = model.epipolar
+        if self.epipolar == None:
+            return
+        #* 每個 key block 一個 group: key_groups 哪些 key 屬於它, row_groups 哪些 query row 要對它做 epipolar
+        segments = self.layout.epipolar_segments
+        key_blocks = sorted(set((ks, ke) for _, _, blocks in segments for ks, ke, _ in blocks))
+        self.key_groups = torch.zeros(len(key_blocks), T, dtype=torch.bool, device=device)
+        self.row_groups = torch.zeros(len(key_blocks), T, dtype=torch.bool, device=device)
+        self.row_epipolar = torch.zeros(T, dtype=torch.bool, device=device)
+        self.row_multi = torch.zeros(T, dtype=torch.bool, device=device)    #* 看多張 frame, 要做第二次 softmax
+        self.ratio_keys = torch.zeros(T, T, device=device)                  #* bi_epi_ratio 看的 key block
+        for g, (ks, ke) in enumerate(key_blocks):
+            self.key_groups[g, ks:ke] = True
+        for row_start, row_end, blocks in segments:
+            for ks, ke, _ in blocks:
+                self.row_groups[key_blocks.index((ks, ke)), row_start:row_end] = True
+            self.row_epipolar[row_start:row_end] = True
+            self.row_multi[row_start:row_end] = len(blocks) > 1
+            self.ratio_keys[row_start:row_end, blocks[-1][0]:blocks[-1][1]] = 1
+
+        #* 每個 frame 換一次: epipolar map 乘上去的權重, 跟 bi_epi_ratio 用的 epipolar 區域
+        self.epi_mult = torch.ones(batch, T, T, device=device)
+        self.ratio_mask = torch.zeros(batch, T, T, device=device)
+
+    def load(self, model, past, forward_map=None, backward_map=None):
+        """ start decoding a frame from the KVCache past of its condition (GPT.test_with_past) """
+        n = past.length
+        for i, layer in enumerate(past.layers):
+            self.k[i][:, :, :n].copy_(layer.k)
+            self.v[i][:, :, :n].copy_(layer.v)
+        self.pos.fill_(n)
+        self.ratio.copy_(past.ratio)
+        if self.h is not None:
+            #* decode_step 要用 pos 去 gather 一個 row, 這裡還是攤成完整的 (T, T) table, 每個 frame 做一次
+            self.h.zero_()
+            past.h.add_to(self.h)
+
+        self.pos_emb.copy_(model.position_embeddings(0, self.pos_emb.shape[0])[0])
+
+        if self.epipolar == None:
+            return
+        #* 跟 epipolar_rows 一樣的權重, 只是先填進完整的 (T, T) table
+        self.epi_mult.fill_(1)
+        self.ratio_mask.zero_()
+        weights = model.epipolar_weights(forward_map, backward_map)
+        for row_start, row_end, blocks in self.layout.epipolar_segments:
+            map_rows = slice(0, row_end - row_start)
+            for ks, ke, m in blocks:
+                self.epi_mult[:, row_start:row_end, ks:ke] = weights.weight(m, map_rows)[:, 0]
+            if self.epipolar == "bidirectional":
+                ks, ke, _ = blocks[-1]
+                self.ratio_mask[:, row_start:row_end, ks:ke] = weights.ratio_mask(map_rows)[0][:, 0]
+
+    def frame_ratio(self):
+        """ bi_epi_ratio (B, 256) of the frame whose last row was just fed, None otherwise (same as test_with_past) """
+        rows = self.layout.completed_frame(int(self.pos.item()))
+        if rows is None:
+            return None
+        return self.ratio[:, rows[0]:rows[1]].clone()
+
+
+class StaticDecoder:
+    """
+    GPT.decode_step for a fixed batch size, run eagerly ("static"), through torch.compile
+    ("compile") or replayed from a captured CUDA graph ("graph", cuda only, captured on the first
+    step). the tokens go through a preallocated (B, 1) buffer; in "graph" mode the returned logits
+    are the graph's output buffer and get overwritten by the next step
+    """
+    modes = ("static", "compile", "graph")
+
+    def __init__(self, model, batch, device, mode="static"):
+        assert mode in self.modes, f"unknown decode mode {mode}"
+        assert mode != "graph" or torch.device(device).type == "cuda", "CUDA graphs need a cuda device"
+        self.model = model
+        self.mode = mode
+        self.cache = StaticKVCache(model, batch, device)
+        self.idx = torch.zeros(batch, 1, dtype=torch.long, device=device)
+        self.step_fn = model.decode_step
+        if mode == "compile":
+            self.step_fn = torch.compile(model.decode_step, dynamic=False)
+        self.graph = None
+        self.logits = None
+
+    def start(self, past, forward_map=None, backward_map=None):
+        self.cache.load(self.model, past, forward_map, backward_map)
+
+    def capture(self):
+        #* warmup 會寫 cache 跟推進 pos, 做完再把 pos 放回去; 寫進去的 key / value 之後會被蓋掉
+        pos = self.cache.pos.clone()
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self.step_fn(self.idx, self.cache)
+                self.cache.pos.copy_(pos)
+        torch.cuda.current_stream().wait_stream(stream)
+        self.graph = torch.cuda.CUDAGraph()
+        #* autocast 的 weight cast cache 在 capture 完會被清掉, graph 裡不能用
+        amp = torch.is_autocast_enabled()
+        with torch.autocast("cuda", dtype=torch.get_autocast_gpu_dtype(), enabled=amp, cache_enabled=False):
+            with torch.cuda.graph(self.graph):
+                self.logits = self.step_fn(self.idx, self.cache)
+        self.cache.pos.copy_(pos)
+
+    def step(self, idx):
+        """ feed the (B, 1) tokens idx, returns the (B, 1, vocab) logits of the next position """
+        self.idx.copy_(idx)
+        if self.mode == "graph":
+            if self.graph is None:
+                self.capture()
+            self.graph.replay()
+            return self.logits
+        return self.step_fn(self.idx, self.cache)
+
+
+class EpipolarCache:
+    """
+    LRU cache around GPT.get_epipolar_tensors, one entry per (sample, camera pair). the maps only
+    depend on K and the two w2c, so the key is a hash of those rounded to `decimals` places plus the
+    grid size and the sigmoid (steep, offset): the same clip in another candidate / rollout /
+    evaluation run hits. entries are kept in `dtype` (fp16: 128KB per 16x16 map) and the least
+    recently used ones are dropped past max_mb. with a path, the entries saved by save() are
+    loaded back at init, so repeated evaluation runs start warm
+    """
+    def __init__(self, max_mb=512, path=None, dtype=torch.float16, decimals=4):
+        self.max_bytes = int(max_mb * 2**20)
+        self.path = path
+        self.dtype = dtype
+        self.itemsize = torch.tensor([], dtype=dtype).element_size()
+        self.decimals = decimals
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self, h, w, k, src_w2c, target_w2c, steep, offset):
+        """ one hex key per (b, pair) of the (B,P,4,4) w2c """
+        B, P = src_w2c.shape[:2]
+        k = k[:, None, 0:3, 0:3].expand(B, P, 3, 3)
+        #* w2c 最後一個 row 固定是 (0,0,0,1), 不用進 key
+        params = torch.cat([k.reshape(B*P, 9), src_w2c[..., 0:3, :].reshape(B*P, 12),
+                            target_w2c[..., 0:3, :].reshape(B*P, 12)], -1)
+        params = torch.round(params.double() * 10**self.decimals).long().cpu().numpy()
+        header = ("%d,%d,%r,%r,%d" % (h, w, float(steep), float(offset), self.decimals)).encode()
+        return [hashlib.sha1(header + row.tobytes()).hexdigest() for row in params]
+
+    def put(self, key, epipolar_map):
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nelement() * self.itemsize
+        #* 複製一份自己的 storage: unbind 出來的 view 會把整個 batch 的 storage 留著, 丟掉也不會釋放
+        epipolar_map = epipolar_map.clone()
+        self.entries[key] = epipolar_map
+        self.nbytes += epipolar_map.nelement() * self.itemsize
+        while self.nbytes > self.max_bytes and len(self.entries) > 0:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nelement() * self.itemsize
+            self.evictions += 1
+
+    def __call__(self, model, h, w, k, src_w2c, target_w2c, steep=5, offset=0.75):
+        """
+        same as model.get_epipolar_tensors(h, w, k, src_w2c, target_w2c), (B,P,hw,hw) float32,
+        only the missing pairs are computed (in one call). hits and misses both come back from
+        the stored `dtype`, so the result doesn't depend on what was cached before
+        """
+        B, P = src_w2c.shape[:2]
+        keys = self.keys(h, w, k, src_w2c, target_w2c, steep, offset)
+        maps = [None] * (B*P)
+        missing = []
+        for i, key in enumerate(keys):
+            epipolar_map = self.entries.get(key)
+            if epipolar_map is None:
+                missing.append(i)
+                continue
+            if epipolar_map.device != k.device:
+                #* 從硬碟讀回來的在 cpu 上, 第一次用到時搬過去
+                epipolar_map = epipolar_map.to(k.device)
+                self.entries[key] = epipolar_map
+            self.entries.move_to_end(key)
+            maps[i] = epipolar_map
+        self.hits += B*P - len(missing)
+        self.misses += len(missing)
+
+        if len(missing) > 0:
+            index = torch.tensor(missing, device=k.device)
+            computed = model.get_epipolar_tensors(h, w, k.index_select(0, index // P),
+                                                  src_w2c.flatten(0, 1).index_select(0, index)[:, None],
+                                                  target_w2c.flatten(0, 1).index_select(0, index)[:, None],
+                                                  steep=steep, offset=offset)[:, 0]
+            for i, epipolar_map in zip(missing, computed.to(self.dtype).unbind(0)):
+                maps[i] = epipolar_map
+                self.put(keys[i], epipolar_map)
+
+        return torch.stack(maps).to(torch.float32).view(B, P, h*w, h*w)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total > 0 else 0.,
+                "entries": len(self.entries), "evictions": self.evictions,
+                "mb": self.nbytes / 2**20}
+
+    def save(self, path=None):
+        path = self.path if path is None else path
+        assert path is not None, "EpipolarCache.save needs a path"
+        #* 照 LRU 順序存, 讀回來的時候超過 budget 會先丟最舊的
+        torch.save(OrderedDict((key, m.cpu()) for key, m in self.entries.items()), path)
+
+    def load(self, path):
+        for key, epipolar_map in torch.load(path, map_location="cpu").items():
+            self.put(key, epipolar_map.to(self.dtype))
+
+
+class EpipolarWeights:
+    """
+    the epipolar weights of one batch, shared by all epipolar layers (and all decode steps of a
+    frame) instead of every layer permuting / multiplying the maps again. per pair m the weight
+    multiplied onto the attention (forward: f, backward: b^T, bidirectional: b^T*f) is made once,
+    contiguous, on first use; the bi_epi_ratio region (b^T*f of the ratio pair >= 0.1) likewise.
+    the accessors return (B, 1, R, hw) views that broadcast over the heads
+    """
+    def __init__(self, epipolar, forward_map, backward_map, ratio_pair):
+        assert epipolar in ("forward", "backward", "bidirectional"), "Invalid type for epipolar"
+        self.epipolar = epipolar
+        self.forward_map = forward_map
+        self.backward_map = backward_map
+        self.ratio_pair = ratio_pair
+        self.weights = {}
+        self.ratio = None
+
+    def matches(self, forward_map, backward_map):
+        """ built from these very map tensors (same objects, not just equal values) """
+        def same(a, b):
+            if a is None or b is None:
+                return a is b
+            return len(a) == len(b) and all(x is y for x, y in zip(a, b))
+        return same(self.forward_map, forward_map) and same(self.backward_map, backward_map)
+
+    def weight(self, m, map_rows=slice(None)):
+        if m not in self.weights:
+            if self.epipolar == "forward":
+                weight = self.forward_map[m]
+            elif self.epipolar == "backward":
+                weight = self.backward_map[m].permute(0,2,1).contiguous()
+            else:
+                weight = self.backward_map[m].permute(0,2,1) * self.forward_map[m]
+            self.weights[m] = weight.unsqueeze(1)    #* (B,1,hw,hw)
+        return self.weights[m][:, :, map_rows]
+
+    def forward_weight(self, m, map_rows=slice(None)):
+        """ forward-only weight of the "forward" attention map (bidirectional only) """
+        return self.forward_map[m].unsqueeze(1)[:, :, map_rows]
+
+    def ratio_mask(self, map_rows=slice(None)):
+        """ (region mask, # of keys in the region) of the bi_epi_ratio rows map_rows """
+        if self.ratio is None:
+            #* bidirectional 的 weight 就是 f*b^T
+            mask = (self.weight(self.ratio_pair) >= 0.1).float()
+            self.ratio = mask, mask.sum(dim=-1)
+        mask, area = self.ratio
+        return mask[:, :, map_rows], area[:, :, map_rows]
+
+
+class AttentionCapture:
+    """
+    one attention map GPT.test should keep, registered with GPT.register_attn_hook.
+    kind: "epipolar" (scores after the per-frame softmax, before the epipolar weighting),
+          "forward" (final attention with forward-only epipolar weighting, bidirectional only)
+          or "weight" (final attention).
+    step / head None means every decode step / all heads. maps collects (step, tensor) with
+    tensor (B, T, T) for a single head or (B, nh, T, T)
+    """
+    kinds = ("epipolar", "forward", "weight")
+
+    def __init__(self, layer, kind="weight", step=None, head=None):
+        assert kind in self.kinds, f"unknown attention kind {kind}"
+        self.layer = layer
+        self.kind = kind
+        self.step = step
+        self.head = head
+        self.current_step = None
+        self.maps = []
+
+    def match(self, layer, step):
+        return self.layer == layer and (self.step is None or self.step == step)
+
+    def keep(self, maps):
+        att = maps.get(self.kind)
+        if att is None:
+            return
+        att = att if self.head is None else att[:, self.head]
+        self.maps.append((self.current_step, att.detach().clone()))
+
+
+class LocalityBias:
+    """
+    locality bias of AdaptiveAttention in compact form: one dense (B, 1, R, n) block per
+    (query rows, key block) of the layout plus its offsets (row_start, row_end, key_start, key_end),
+    instead of a (B, 1, T, T) matrix that is zero everywhere else. add_to() adds the blocks that
+    hit some query rows onto their attention scores by slice-add. made once per frame and shared by
+    all adaptive layers and decode steps; a batch of 1 broadcasts over the batch of the scores
+    """
+    def __init__(self, offsets, blocks, p=None):
+        self.offsets = offsets
+        self.blocks = blocks
+        self.p = p
+
+    def matches(self, p):
+        """ made from these very camera params (same objects, not just equal values) """
+        return self.p is not None and len(self.p) == len(p) and all(a is b for a, b in zip(self.p, p))
+
+    def add_to(self, att, q0=0):
+        """ att: (B, nh, T_q, T) scores of the query rows q0:q0+T_q, the bias is added in place """
+        T_q, T = att.shape[2], att.shape[3]
+        for (row_start, row_end, key_start, key_end), block in zip(self.offsets, self.blocks):
+            start, end = max(row_start, q0), min(row_end, q0 + T_q)
+            key_end = min(key_end, T)
+            if start < end and key_start < key_end:
+                att[:, :, start-q0:end-q0, key_start:key_end] += block[:, :, start-row_start:end-row_start, :key_end-key_start]
+        return att
+
+    def index_select(self, index):
+        """ reorder the batch (KVCache.reorder), a batch of 1 is shared and stays as is """
+        blocks = [block if block.shape[0] == 1 else block.index_select(0, index) for block in self.blocks]
+        return LocalityBias(self.offsets, blocks, self.p)
+
 
 class AdaptiveAttention(nn.Module):
-    def __init__(self, block_size, time_len = 3, camera_dim = 30, img_dim = 256):
+    def __init__(self, block_size, time_len = 3, camera_dim = 30, img_dim = 256, layout = None):
         super().__init__()
         self.block_size = block_size
         self.camera_dim = camera_dim
         self.img_dim = img_dim
+        self.layout = layout if layout is not None else SequenceLayout(time_len, img_dim, camera_dim)
         
         self.fc = nn.Sequential(
             nn.Linear(camera_dim, 2 * camera_dim),
@@ -75,24 +616,20 @@ class AdaptiveAttention(nn.Module):
             nn.Linear(2 * camera_dim, img_dim**2),
         )
         
-    def forward(self, p1=None, p2=None, p3=None):
-        # hand-craft assign:
-        B = p1.shape[0]
-        h = torch.zeros(B, 1, self.block_size, self.block_size).cuda()
-        # C 0->1
-        if p1 is not None:
-            h_01 = self.fc(p1).view(B, 1, self.img_dim, self.img_dim)
-            h[:, :, 285:541, 0:256] = h_01  #* query為rgb1 要跟 key rgb0 找關係
-        # C 0->2
-        if p2 is not None:
-            h_02 = self.fc(p2).view(B, 1, self.img_dim, self.img_dim)
-            h[:, :, 571:827, 0:256] = h_02  #* query為rgb2 要跟 key rgb0 找關係
-        # C 1->2
-        if p3 is not None:
-            h_12 = self.fc(p3).view(B, 1, self.img_dim, self.img_dim)
-            h[:, :, 571:827, 286:542] = h_12 #* query為rgb2 要跟 key rgb1 找關係
-
-        return h
+    def forward(self, *p):
+        #* p: 每個 frame pair 一個 camera 參數 (B,30), 順序跟 layout.pairs 一樣 (p1 = 0->1, p2 = 0->2, p3 = 1->2 ...)
+        #* None 的 pair 不加 locality (例如只有一張 condition frame 時)
+        #* 只留每個 pair 的 (B,1,256,256) block 跟它在 (T,T) 裡的位置, 不做整個 (B,1,T,T) 的 zeros
+        B = next(pi.shape[0] for pi in p if pi is not None)
+        offsets, blocks = [], []
+        for row_start, row_end, key_blocks in self.layout.epipolar_segments:
+            for key_start, key_end, m in key_blocks:
+                if m < len(p) and p[m] is not None:
+                    #* query 為 target frame 要跟 key src frame 找關係
+                    offsets.append((row_start, row_end, key_start, key_end))
+                    blocks.append(self.fc(p[m]).view(B, 1, self.img_dim, self.img_dim))
+
+        return LocalityBias(offsets, blocks, list(p))
     
 class cross_Attention(nn.Module):
     def __init__(self, config,epipolar = None):
@@ -114,6 +651,9 @@ class cross_Attention(nn.Module):
 
         if config.two_cond==True and epipolar!=None:
             self.epipolar = "two_cond"
+        #* 跟 CausalSelfAttention 一樣, no_grad 時 query 分塊做 attention, None = 不分塊
+        self.attn_chunk_size = getattr(config, "attn_chunk_size", None)
+        self.attn_memory_mb = getattr(config, "attn_memory_mb", None)
     
     def forward(self, x, src_encode,forward_map = None,backward_map = None, src_encode0=None):
         
@@ -124,62 +664,115 @@ class cross_Attention(nn.Module):
         q = self.query(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         v = self.value(src_encode).view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
 
-        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-
+        #* att 的 (query 0:256, key 0:256) 要乘的 epipolar map (B, 256, 256), two_cond 的 att2 乘 weight2
+        weight, weight2 = None, None
         if self.epipolar == "forward":
-            f01 = forward_map[0]
-            f01 = repeat(f01,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-            att[:,:,0:256,0:256] = att[:,:,0:256,0:256]*f01
+            weight = forward_map[0]
         elif self.epipolar == "backward":
-            b01 = backward_map[0]
-            b01 = b01.permute(0,2,1)
-            b01 = repeat(b01,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-            att[:,:,0:256,0:256] = att[:,:,0:256,0:256]*b01
+            weight = backward_map[0].permute(0,2,1)
         elif self.epipolar == "bidirectional":
-            f01 = forward_map[0]
-            f01 = repeat(f01,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-            b01 = backward_map[0]
-            b01 = b01.permute(0,2,1)
-            b01 = repeat(b01,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-            att[:,:,0:256,0:256] = att[:,:,0:256,0:256]*b01*f01
+            weight = backward_map[0].permute(0,2,1)*forward_map[0]
         elif self.epipolar == "two_cond":
             k2 = self.key(src_encode0).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
             q2 = self.query2(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
             v2 = self.value(src_encode0).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
-            att2 = (q2 @ k2.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
 
-            #* 讓前兩張圖片的condition 隨機作 forward 或 backward
+            #* 讓前兩張圖片的condition 隨機作 forward 或 backward (整個 forward 抽一次, 不是每個 chunk)
             if torch.randint(0, 2, (1,)).item() == 0: 
-                f02 = forward_map[0]
-                f02 = repeat(f02,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                b12 = backward_map[1]
-                b12 = b12.permute(0,2,1)
-                b12 = repeat(b12,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                att[:,:,0:256,0:256] = att[:,:,0:256,0:256]*b12
-                att2[:,:,0:256,0:256] = att2[:,:,0:256,0:256]*f02
+                weight, weight2 = backward_map[1].permute(0,2,1), forward_map[0]
             else:
-                f12 = forward_map[1]
-                f12 = repeat(f12,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                b02 = backward_map[0]
-                b02 = b02.permute(0,2,1)
-                b02 = repeat(b02,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                att[:,:,0:256,0:256] = att[:,:,0:256,0:256]*f12
-                att2[:,:,0:256,0:256] = att2[:,:,0:256,0:256]*b02
-        
-        att = F.softmax(att, dim=-1)
-        att = self.attn_drop(att)
-        y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
-        if self.epipolar=="two_cond":
-            att2 = F.softmax(att2, dim=-1)
-            att2 = self.attn_drop(att2)
-            y2 = att2 @ v2
-            y = (y+y2)/2
+                weight, weight2 = forward_map[1], backward_map[0].permute(0,2,1)
+
+        rows = None
+        if not torch.is_grad_enabled():
+            rows = attention_chunk_rows(self.attn_chunk_size, self.attn_memory_mb, T, T, B, self.n_head)
+        rows = rows or T
+        y = torch.empty_like(q)
+        #* 每個 query row 的 softmax 只跟自己有關, 分塊跟一次做完的結果一樣
+        for r0 in range(0, T, rows):
+            r1 = min(r0 + rows, T)
+            y_rows = self.attend_rows(q[:, :, r0:r1], k, v, weight, r0)
+            if self.epipolar=="two_cond":
+                y_rows = (y_rows + self.attend_rows(q2[:, :, r0:r1], k2, v2, weight2, r0))/2
+            y[:, :, r0:r1] = y_rows
         y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
 
         # output projection
         y = self.resid_drop(self.proj(y))
         return y
 
+    def attend_rows(self, q, k, v, weight, q0):
+        """
+        attention output (B, nh, T_q, hs) of the query rows q0:q0+T_q, the rows < 256 get their
+        rows of weight on the first 256 keys
+        """
+        #* score / softmax 一律用 fp32, autocast 下 half 的 epipolar 乘積跟 -inf 容易變 nan
+        att = (q @ k.transpose(-2, -1)).float() * (1.0 / math.sqrt(k.size(-1)))
+        if weight is not None and q0 < 256:
+            r1 = min(q0 + q.size(2), 256)
+            att[:,:,0:r1-q0,0:256] = att[:,:,0:r1-q0,0:256]*weight[:,None,q0:r1]
+        att = F.softmax(att, dim=-1)
+        att = self.attn_drop(att)
+        return att.to(v.dtype) @ v # (B, nh, T_q, T) x (B, nh, T, hs) -> (B, nh, T_q, hs)
+
+class EpipolarAttention(torch.autograd.Function):
+    """
+    final attention weights of an epipolar layer in one op: per key block softmax, times the epipolar
+    weight, a second per-frame softmax for rows that look at several frames, mask_cam, causal mask and
+    the outer softmax. the explicit path of CausalSelfAttention.forward writes these into slices of
+    the tracked att, which keeps several (B, nh, T, T) buffers and CopySlices nodes alive for backward;
+    here backward only needs the output and the per-block softmax (B, nh, R, 256), the rest of the
+    chain rule is written out by hand.
+    segments: [(att rows, [(key_start, key_end, weight (B, 1, R, n))])], the weights need no gradient
+    """
+    @staticmethod
+    def forward(ctx, att, mask, segments, mask_cam):
+        z = att.masked_fill(mask == 0, float('-inf'))
+        block_softmax = []
+        for rows, key_blocks in segments:
+            for key_start, key_end, weight in key_blocks:
+                s = F.softmax(att[:, :, rows, key_start:key_end], dim=-1)
+                u = s * weight
+                if len(key_blocks) > 1:
+                    #* 看多張 frame 時, 每張 frame 各自再做一次 softmax
+                    u = F.softmax(u, dim=-1)
+                z[:, :, rows, key_start:key_end] = u
+                block_softmax.append(s)
+            if mask_cam:
+                #* 只留下前面 frame 的 image token
+                prev_end = 0
+                for key_start, key_end, _ in key_blocks:
+                    z[:, :, rows, prev_end:key_start] = float('-inf')
+                    prev_end = key_end
+                z[:, :, rows, prev_end:] = float('-inf')
+
+        #* in-place softmax, 不再多開一個 (B, nh, T, T)
+        z.sub_(z.amax(dim=-1, keepdim=True)).exp_()
+        z.div_(z.sum(dim=-1, keepdim=True))
+        ctx.save_for_backward(z)
+        ctx.segments = segments
+        ctx.block_softmax = block_softmax
+        return z
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        att_weight, = ctx.saved_tensors
+        #* 外層 softmax: dz = P * (dP - <dP, P>), <dP, P> 用 matmul 算, 不用 (B, nh, T, T) 的暫存
+        dot = (grad_out.unsqueeze(-2) @ att_weight.unsqueeze(-1)).squeeze(-1)
+        grad = (grad_out - dot).mul_(att_weight)
+        block_softmax = iter(ctx.block_softmax)
+        for rows, key_blocks in ctx.segments:
+            for key_start, key_end, weight in key_blocks:
+                s = next(block_softmax)
+                grad_u = grad[:, :, rows, key_start:key_end]
+                if len(key_blocks) > 1:
+                    v = F.softmax(s * weight, dim=-1)
+                    grad_u = v * (grad_u - (grad_u * v).sum(dim=-1, keepdim=True))
+                grad_s = grad_u * weight
+                grad[:, :, rows, key_start:key_end] = s * (grad_s - (grad_s * s).sum(dim=-1, keepdim=True))
+        return grad, None, None, None
+
+
 class CausalSelfAttention(nn.Module):
     def __init__(self, config, adaptive,epipolar = None,do_blur = False,mask_cam = False):
         super().__init__()
@@ -220,8 +813,36 @@ class CausalSelfAttention(nn.Module):
         self.gaussian_transform = T.GaussianBlur(7,1.5)
         self.do_blur = do_blur
         self.mask_cam = mask_cam
+        #* epipolar weight 的 threshold, 設了就用 sparse_epipolar_rows 只算 epipolar line 附近的 key, None = dense
+        self.sparse_epipolar = getattr(config, "sparse_epipolar", None)
+        #* training 時用 EpipolarAttention 一次算完 epipolar 的 attention weight, False = 原本 in-place 寫 slice 的版本
+        self.fused_epipolar = getattr(config, "fused_epipolar", True)
+        #* 非 epipolar 的 layer 用 F.scaled_dot_product_attention (pytorch 2), False = 原本 explicit 的 att, debug 用
+        self.sdpa = getattr(config, "sdpa", True) and hasattr(F, "scaled_dot_product_attention")
+        #* epipolar 的 query row / key block 都從 layout 的 segment table 來
+        #* 原本的 3 frame: query 285:541 生成 rgb1, 只看 rgb0; query 571:827 生成 rgb2, 看 rgb0 跟 rgb1
+        self.layout = getattr(config, "layout", None) or SequenceLayout()
+        #* no_grad 時 query 分成 attn_chunk_size 個 row 一塊做 attention, attn_memory_mb: 一塊最多用多少 MB, None = 不分塊
+        self.attn_chunk_size = getattr(config, "attn_chunk_size", None)
+        self.attn_memory_mb = getattr(config, "attn_memory_mb", None)
         
-    def forward(self, x, x_kv, h, layer_past=None,forward_map = None,backward_map = None,return_attn=False):
+    def forward(self, x, x_kv, h, layer_past=None,forward_map = None,backward_map = None,return_attn=False,return_ratio=False,capture=None,
+                epipolar_weights=None,inference=False):
+        """
+        return_ratio: also return bi_epi_ratio (B, 256) when T just completes a frame (bidirectional only).
+        inference: nobody looks at att_for / the attention maps, only the final attention weights are
+        computed (in place, like forward_with_past); falls back to the explicit path when a capture /
+        return_attn wants the maps or att needs gradients.
+        with attn_chunk_size / attn_memory_mb set and no gradients, the query rows go through
+        chunked_rows() in tiles instead (unless a capture / return_attn wants the whole maps)
+        """
+        if self.epipolar!=None and epipolar_weights is None:
+            #* 沒有從 GPT 傳進來 (單獨跑這個 layer) 就自己做一份
+            epipolar_weights = EpipolarWeights(self.epipolar, forward_map, backward_map, self.layout.ratio_pair)
+        if layer_past is not None:
+            return self.forward_with_past(x, x_kv, h, layer_past,
+                                          epipolar_weights = epipolar_weights,
+                                          return_ratio = return_ratio)
         B, T, C = x.size()
         # print(f"T = {T}")
 
@@ -230,131 +851,128 @@ class CausalSelfAttention(nn.Module):
         q = self.query(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         v = self.value(x_kv).view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
 
+        rows = self.chunk_rows(B, T, T) if not capture and not return_attn else None
+        if rows is not None:
+            #* 有人要, 而且 T 剛好生成完一張 frame 時才算那張 frame 的 bi_epi_ratio
+            ratio_rows = self.layout.completed_frame(T) if self.epipolar == "bidirectional" and return_ratio else None
+            y, bi_epi_ratio = self.chunked_rows(q, k, v, h, 0, rows, epipolar_weights, return_ratio = ratio_rows is not None)
+            if bi_epi_ratio is not None:
+                bi_epi_ratio = bi_epi_ratio[:, ratio_rows[0]:ratio_rows[1]]
+            y = y.transpose(1, 2).contiguous().view(B, T, C)
+            return self.resid_drop(self.proj(y)),[],[],[],(bi_epi_ratio if self.epipolar!=None else [])
+
+        if self.use_sdpa(capture, return_attn):
+            y = self.sdpa_rows(q, k, v, h, 0)
+            y = y.transpose(1, 2).contiguous().view(B, T, C)
+            return self.resid_drop(self.proj(y)),[],[],[],[]
+
         # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
-        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+        #* mixed precision 時 q/k/v 是 half, 後面的 partial softmax / epipolar 乘積 / -inf mask 都在 fp32 做
+        att = (q @ k.transpose(-2, -1)).float() * (1.0 / math.sqrt(k.size(-1)))
         
         if self.adaptive:
-            att = h[:,:,:T,:T] + att
+            att = h.add_to(att)
         
         epipolar_attn_map = None
         bi_epi_ratio = None
         att_for = None
-        if self.epipolar!=None:
+        att_weight_for = None
+        #* 只在有人要看的時候才做 attention map 的複製 / forward-only 的 attention
+        capture = capture or []
+        kinds = set(c.kind for c in capture)
+        if return_attn:
+            kinds.update(AttentionCapture.kinds)
+        #* 要看 attention map 時一律走 dense, sparse / inference 不會有 epipolar / forward-only 的 map
+        rows_fn = None
+        if self.epipolar!=None and not kinds:
+            if self.sparse_epipolar is not None:
+                rows_fn = self.sparse_epipolar_rows
+            elif inference and not att.requires_grad:
+                rows_fn = self.epipolar_rows
+        #* 有人要, 而且 T 剛好生成完一張 frame 時才算那張 frame 的 bi_epi_ratio
+        ratio_rows = self.layout.completed_frame(T) if self.epipolar == "bidirectional" and return_ratio else None
+        #* training 時 (要 gradient, 沒有要看 map / bi_epi_ratio) 用 EpipolarAttention 一次算到最後的 attention weight
+        fused = (self.epipolar!=None and rows_fn is None and not kinds and ratio_rows is None
+                 and self.fused_epipolar and att.requires_grad)
+        if fused:
+            segments = [(rows, [(key_start, key_end, epipolar_weights.weight(m, map_rows)) for key_start, key_end, m in key_blocks])
+                        for rows, map_rows, key_blocks in self.layout.segments(0, T)]
+            att_weight = EpipolarAttention.apply(att, self.mask[:,:,:T,:T], segments, self.mask_cam)
+        elif rows_fn is not None:
+            att, bi_epi_ratio = rows_fn(att, 0, epipolar_weights, return_ratio = ratio_rows is not None)
+            if bi_epi_ratio is not None:
+                bi_epi_ratio = bi_epi_ratio[:, ratio_rows[0]:ratio_rows[1]]
+        elif self.epipolar!=None:
+            segments = list(self.layout.segments(0, T))
             #* 在做epipolar 之前先把attention 經由softmax 全為正數, 有負數有可能會出錯
-            att[:,:,285:541, 0:256] = F.softmax(att[:,:,285:541, 0:256],dim=-1)
-            att[:, :, 571:827, 0:256] = F.softmax(att[:,:,571:827, 0:256],dim=-1)
-            att[:, :, 571:827, 286:542] = F.softmax(att[:,:,571:827, 286:542],dim=-1)
-            if return_attn:
-                epipolar_attn_map = att.clone()
-                epipolar_attn_map = epipolar_attn_map.masked_fill(self.mask[:,:,:T,:T] == 0, float('-inf'))
-                # epipolar_attn_map = F.softmax(epipolar_attn_map,dim=-1)
-                # epipolar_attn_map[:, :, 571:827, 0:256] = F.softmax(epipolar_attn_map[:, :, 571:827, 0:256], dim=-1)
-                # epipolar_attn_map[:, :, 571:827, 286:542] = F.softmax(epipolar_attn_map[:, :, 571:827, 286:542], dim=-1)
-            if self.epipolar == "forward":
-                # forward_map = repeat(forward_map,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                f01, f02, f12 = forward_map
-                f01 = repeat(f01,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                f02 = repeat(f02,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                f12 = repeat(f12,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                att[:,:,285:541, 0:256] = att[:,:,285:541, 0:256]*f01[:,:,:min(T-285,256),...] #*query 能找到 key一定可以找到全部
-                if T>571:
-                    att[:, :, 571:827, 0:256] = att[:, :, 571:827, 0:256]*f02[:,:,:T-571,...]
-                    att[:, :, 571:827, 286:542] = att[:, :, 571:827, 286:542]*f12[:,:,:T-571,...]
-                # att = att*forward_map
-            elif self.epipolar == "backward":
-                # backward_map = repeat(backward_map,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                b01, b02, b12 = backward_map
-                b01 = b01.permute(0,2,1)
-                b02 = b02.permute(0,2,1)
-                b12 = b12.permute(0,2,1)
-                b01 = repeat(b01,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                b02 = repeat(b02,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                b12 = repeat(b12,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                att[:,:,285:541, 0:256] = att[:,:,285:541, 0:256]*b01[:,:,:min(T-285,256),...]
-                if T>571:
-                    att[:, :, 571:827, 0:256] = att[:, :, 571:827, 0:256]*b02[:,:,:T-571,...]
-                    att[:, :, 571:827, 286:542] = att[:, :, 571:827, 286:542]*b12[:,:,:T-571,...]
-                # att = att*backward_map
-            elif self.epipolar == "bidirectional":
-                # forward_map = repeat(forward_map,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                # backward_map = repeat(backward_map,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                f01, f02, f12 = forward_map
-
-                b01, b02, b12 = backward_map
-                b01 = b01.permute(0,2,1)
-                b02 = b02.permute(0,2,1)
-                b12 = b12.permute(0,2,1)
-
-                bi_12 = f12*b12
-                bi_12_mask = (bi_12>=0.1).float() #* 用來看epipolar line 所選定的區域, epipolar 內的區域為1 其餘為0
-
-                f01 = repeat(f01,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                f02 = repeat(f02,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                f12 = repeat(f12,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                b01 = repeat(b01,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                b02 = repeat(b02,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                b12 = repeat(b12,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-
-                bi_12_mask = repeat(bi_12_mask,'b hw hw2 -> b nh hw hw2',nh=att.shape[1])
-                if T==827:
+            for rows, _, key_blocks in segments:
+                for key_start, key_end, _ in key_blocks:
+                    att[:, :, rows, key_start:key_end] = F.softmax(att[:, :, rows, key_start:key_end], dim=-1)
+            if "epipolar" in kinds:
+                epipolar_attn_map = att.masked_fill(self.mask[:,:,:T,:T] == 0, float('-inf'))
+
+            #* epipolar weight (forward: f, backward: b^T, bidirectional: b^T*f) 由 EpipolarWeights 做好一次, 每個 layer 共用
+            if self.epipolar == "bidirectional":
+                if ratio_rows is not None:
+                    #* 用 f*b 選出 epipolar 區域 (bi_12 >= 0.1 的為1 其餘為0), 看剛生成完的 frame 對前一張 frame 的 attention
+                    rows, map_rows, key_blocks = segments[-1]
+                    key_start, key_end, _ = key_blocks[-1]
+                    bi_12_mask, bi_12_area = epipolar_weights.ratio_mask(map_rows)
                     #* token 對整張圖的attention平均值
-                    att_mean = att[:,:,571:827,286:542].mean(dim=-1)
-                    
-                    att_mask = att[:, :, 571:827, 286:542]*bi_12_mask[:,:,:T-571,...]
-                    #* bidirection epipolar 所在區域的token 數 (b nh hw)
-                    bi_12_mask_sum = bi_12_mask[:,:,:T-571,...].sum(dim=-1)
+                    att_mean = att[:, :, rows, key_start:key_end].mean(dim=-1)
+                    att_mask = att[:, :, rows, key_start:key_end]*bi_12_mask
                     #* 區域內attention 的總和 / 區域token 數 = epipolar 範圍內的attention 平均值
-                    att_mask_mean = att_mask.sum(dim=-1) / bi_12_mask_sum
-
+                    att_mask_mean = att_mask.sum(dim=-1) / bi_12_area
                     #* epipolar 範圍內attention 佔全體的比例，比例越高代表這個token 有更好的找到對應epipolar的區塊，也代表這個token 更可信
                     #* (b hw)
                     bi_epi_ratio = att_mask_mean.mean(dim=1) / att_mean.mean(dim=1)
-                elif T==541:
-                    att_mean = att[:,:,285:541, 0:256].mean(dim=-1)
-                    att_mask = att[:, :,285:541, 0:256]*bi_12_mask[:,:,:min(T-285,256),...]
-                    bi_12_mask_sum = bi_12_mask[:,:,:min(T-285,256),...].sum(dim=-1)
-                    att_mask_mean = att_mask.sum(dim=-1) / bi_12_mask_sum
-                    bi_epi_ratio = att_mask_mean.mean(dim=1) / att_mean.mean(dim=1)
-                else:
-                    #* 只有第二張image 或 第三張image 全部token 生成完畢才需要計算ratio 回傳
-                    #* 所以只需要看 T=541 跟 T=827 就好，其他不需要重複計算
-                    bi_epi_ratio = None
-
-                att_for = att.clone()
-                att[:,:,285:541, 0:256] = att[:,:,285:541, 0:256]*b01[:,:,:min(T-285,256),...]*f01[:,:,:min(T-285,256),...]
-                att_for[:,:,285:541, 0:256] = att_for[:,:,285:541, 0:256]*f01[:,:,:min(T-285,256),...]
-                if T>571:
-                    att[:, :, 571:827, 0:256] = att[:, :, 571:827, 0:256]*b02[:,:,:T-571,...]*f02[:,:,:T-571,...]
-                    att[:, :, 571:827, 286:542] = att[:, :, 571:827, 286:542]*b12[:,:,:T-571,...]*f12[:,:,:T-571,...]
-                    att_for[:, :, 571:827, 0:256] = att_for[:, :, 571:827, 0:256]*f02[:,:,:T-571,...]
-                    att_for[:, :, 571:827, 286:542] = att_for[:, :, 571:827, 286:542]*f12[:,:,:T-571,...]
-            else:
-                raise AssertionError("Invalid type for epipolar")
+
+                if "forward" in kinds:
+                    att_for = att.clone()
+                    for rows, map_rows, key_blocks in segments:
+                        for key_start, key_end, m in key_blocks:
+                            att_for[:, :, rows, key_start:key_end] = att_for[:, :, rows, key_start:key_end]*epipolar_weights.forward_weight(m, map_rows)
+
+            for rows, map_rows, key_blocks in segments:
+                for key_start, key_end, m in key_blocks:
+                    att[:, :, rows, key_start:key_end] = att[:, :, rows, key_start:key_end]*epipolar_weights.weight(m, map_rows)
         
             if self.mask_cam:
-                att[:,:,285:541, 256:] = float('-inf')
-                att[:,:,571:827, 256:286] = float('-inf')
-                att[:,:,571:827, 542:] = float('-inf')
-                att_for[:,:,285:541, 256:] = float('-inf')
-                att_for[:,:,571:827, 256:286] = float('-inf')
-                att_for[:,:,571:827, 542:] = float('-inf')
-
-        # if self.epipolar==None:
-        att_weight = att.masked_fill(self.mask[:,:,:T,:T] == 0, float('-inf'))
-        if self.epipolar!=None:
-            att_weight[:, :, 571:827, 0:256]= F.softmax(att[:, :, 571:827, 0:256], dim=-1)
-            att_weight[:, :, 571:827, 286:542]= F.softmax(att[:, :, 571:827, 286:542], dim=-1)
-        att_weight = F.softmax(att_weight, dim=-1)
-
-        if self.epipolar!=None:
-            att_weight_for = att_for.masked_fill(self.mask[:,:,:T,:T] == 0, float('-inf'))
-            if self.epipolar!=None:
-                att_weight_for[:, :, 571:827, 0:256]= F.softmax(att_for[:, :, 571:827, 0:256], dim=-1)
-                att_weight_for[:, :, 571:827, 286:542]= F.softmax(att_for[:, :, 571:827, 286:542], dim=-1)
-            att_weight_for = F.softmax(att_weight_for, dim=-1)
+                #* 只留下前面 frame 的 image token
+                for rows, _, key_blocks in segments:
+                    prev_end = 0
+                    for key_start, key_end, _ in key_blocks:
+                        att[:, :, rows, prev_end:key_start] = float('-inf')
+                        if att_for is not None:
+                            att_for[:, :, rows, prev_end:key_start] = float('-inf')
+                        prev_end = key_end
+                    att[:, :, rows, prev_end:] = float('-inf')
+                    if att_for is not None:
+                        att_for[:, :, rows, prev_end:] = float('-inf')
+
+        if not fused:
+            # if self.epipolar==None:
+            att_weight = att.masked_fill(self.mask[:,:,:T,:T] == 0, float('-inf'))
+            if att_for is not None:
+                att_weight_for = att_for.masked_fill(self.mask[:,:,:T,:T] == 0, float('-inf'))
+            if self.epipolar!=None and rows_fn is None:
+                #* 看多張 frame 時, 每張 frame 各自再做一次 softmax
+                for rows, _, key_blocks in segments:
+                    if len(key_blocks) == 1:
+                        continue
+                    for key_start, key_end, _ in key_blocks:
+                        att_weight[:, :, rows, key_start:key_end] = F.softmax(att[:, :, rows, key_start:key_end], dim=-1)
+                        if att_for is not None:
+                            att_weight_for[:, :, rows, key_start:key_end] = F.softmax(att_for[:, :, rows, key_start:key_end], dim=-1)
+            att_weight = F.softmax(att_weight, dim=-1)
+            if att_for is not None:
+                att_weight_for = F.softmax(att_weight_for, dim=-1)
+
+        for c in capture:
+            c.keep({"epipolar": epipolar_attn_map, "forward": att_weight_for, "weight": att_weight})
 
         att = self.attn_drop(att_weight)
-        y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+        y = att.to(v.dtype) @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
         y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
 
         # output projection
@@ -368,6 +986,297 @@ class CausalSelfAttention(nn.Module):
             else:
                 return y,[],[],[],[]
 
+    def use_sdpa(self, capture=None, return_attn=False):
+        """ non-epipolar layer that nobody looks into: F.scaled_dot_product_attention instead of the explicit (T, T) att """
+        return self.sdpa and self.epipolar == None and not capture and not return_attn
+
+    def sdpa_rows(self, q, k, v, h, q0):
+        """
+        softmax(q k^T / sqrt(hs) + h + causal mask) v of the query rows q0:q0+T_q, same as the explicit
+        path of a non-epipolar layer but fused (no (B, nh, T_q, T) att kept), (B, nh, T_q, hs)
+        """
+        T_q, T = q.size(2), k.size(2)
+        mask = self.mask[:,:,q0:q0+T_q,:T] != 0
+        if self.adaptive:
+            #* locality bias 跟 causal mask 合成一個 additive mask, 對每個 head broadcast
+            bias = h.add_to(q.new_zeros(q.size(0), 1, T_q, T, dtype=torch.float), q0)
+            mask = bias.to(q.dtype).masked_fill(~mask, float('-inf'))
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask,
+                                              dropout_p=self.attn_drop.p if self.training else 0.)
+
+    def forward_with_past(self, x, x_kv, h, layer_past, epipolar_weights = None, return_ratio = False):
+        """
+        incremental decoding: x / x_kv only hold the new positions, their keys/values are
+        appended to layer_past and only the new query rows are computed
+        """
+        B, T_q, C = x.size()
+        q0 = len(layer_past)
+
+        k = self.key(x_kv).view(B, T_q, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T_q, hs)
+        q = self.query(x).view(B, T_q, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T_q, hs)
+        v = self.value(x_kv).view(B, T_q, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T_q, hs)
+        k, v = layer_past.append(k, v)
+        T = k.size(2)
+
+        rows = self.chunk_rows(B, T_q, T)
+        if rows is not None:
+            y, bi_epi_ratio = self.chunked_rows(q, k, v, h, q0, rows, epipolar_weights, return_ratio)
+        else:
+            y, bi_epi_ratio = self.attend_rows(q, k, v, h, q0, epipolar_weights, return_ratio)
+        y = y.transpose(1, 2).contiguous().view(B, T_q, C)
+
+        y = self.resid_drop(self.proj(y))
+        return y,[],[],[],bi_epi_ratio
+
+    def attend_rows(self, q, k, v, h, q0, epipolar_weights=None, return_ratio=False):
+        """
+        attention output (B, nh, T_q, hs) of the query rows q0:q0+T_q against the keys / values k, v
+        (B, nh, T, hs): sdpa for a non-epipolar layer, otherwise the explicit scores with the epipolar
+        weighting of those rows. also returns bi_epi_ratio (B, T_q) of those rows if return_ratio is set
+        """
+        if self.use_sdpa():
+            return self.sdpa_rows(q, k, v, h, q0), None
+        T_q, T = q.size(2), k.size(2)
+
+        #* (B, nh, T_q, hs) x (B, nh, hs, T) -> (B, nh, T_q, T), 跟 forward() 一樣用 fp32
+        att = (q @ k.transpose(-2, -1)).float() * (1.0 / math.sqrt(k.size(-1)))
+
+        if self.adaptive:
+            att = h.add_to(att, q0)
+
+        bi_epi_ratio = None
+        if self.epipolar!=None and self.sparse_epipolar is not None:
+            att, bi_epi_ratio = self.sparse_epipolar_rows(att, q0, epipolar_weights, return_ratio)
+        elif self.epipolar!=None:
+            att, bi_epi_ratio = self.epipolar_rows(att, q0, epipolar_weights, return_ratio)
+
+        att = att.masked_fill(self.mask[:,:,q0:q0+T_q,:T] == 0, float('-inf'))
+        att = F.softmax(att, dim=-1)
+        att = self.attn_drop(att)
+        y = att.to(v.dtype) @ v # (B, nh, T_q, T) x (B, nh, T, hs) -> (B, nh, T_q, hs)
+        return y, bi_epi_ratio
+
+    def chunk_rows(self, B, T_q, T):
+        """ query rows per tile for T_q query rows against T keys, None = no chunking (also whenever gradients are needed) """
+        if torch.is_grad_enabled():
+            return None
+        return attention_chunk_rows(self.attn_chunk_size, self.attn_memory_mb, T_q, T, B, self.n_head)
+
+    def chunked_rows(self, q, k, v, h, q0, rows, epipolar_weights=None, return_ratio=False):
+        """
+        attend_rows() over tiles of at most rows query rows, only one (B, nh, rows, T) tile of
+        scores is alive at a time. the epipolar weighting is row-local (per key block softmax,
+        weight, per-frame softmax, mask_cam), so the tiles give the same result as all rows at once
+        """
+        T_q = q.size(2)
+        y = torch.empty_like(q)
+        bi_epi_ratio = None
+        if return_ratio and self.epipolar == "bidirectional":
+            bi_epi_ratio = q.new_zeros(q.size(0), T_q, dtype=torch.float)
+        for r0 in range(0, T_q, rows):
+            r1 = min(r0 + rows, T_q)
+            #* causal mask 下每個 row 看到的 key 都是前綴, 這塊只需要到最後一個看得到的 key
+            n_keys = int(self.mask[0, 0, q0+r0:q0+r1, :k.size(2)].sum(dim=-1).max())
+            y[:, :, r0:r1], ratio = self.attend_rows(q[:, :, r0:r1], k[:, :, :n_keys], v[:, :, :n_keys], h, q0 + r0,
+                                                     epipolar_weights, return_ratio)
+            if bi_epi_ratio is not None:
+                bi_epi_ratio[:, r0:r1] = ratio
+        return y, bi_epi_ratio
+
+    def epipolar_rows(self, att, q0, weights, return_ratio=False):
+        """
+        the epipolar weighting of forward() for the query rows q0:q0+att.shape[2] only.
+        att holds the raw scores of those rows against all keys, the result still has to
+        go through the causal mask and the final softmax.
+        weights is the EpipolarWeights of the batch.
+        also returns bi_epi_ratio (B, T_q) of those rows if return_ratio is set
+        """
+        T_q = att.shape[2]
+
+        bi_epi_ratio = None
+        if return_ratio and self.epipolar == "bidirectional":
+            bi_epi_ratio = att.new_zeros(att.shape[0], T_q)
+
+        #* rows: att 中的 row, map_rows: epipolar map 中的 row
+        for rows, map_rows, key_blocks in self.layout.segments(q0, q0 + T_q):
+
+            for key_start, key_end, _ in key_blocks:
+                att[:, :, rows, key_start:key_end] = F.softmax(att[:, :, rows, key_start:key_end], dim=-1)
+
+            if bi_epi_ratio is not None:
+                #* 跟 forward() 一樣用 f12*b12 選出 epipolar 區域, 看最近一張 frame 的 attention
+                key_start, key_end, _ = key_blocks[-1]
+                bi_12_mask, bi_12_area = weights.ratio_mask(map_rows)
+                att_block = att[:, :, rows, key_start:key_end]
+                att_mean = att_block.mean(dim=-1)
+                att_mask_mean = (att_block * bi_12_mask).sum(dim=-1) / bi_12_area
+                bi_epi_ratio[:, rows] = att_mask_mean.mean(dim=1) / att_mean.mean(dim=1)
+
+            for key_start, key_end, m in key_blocks:
+                att[:, :, rows, key_start:key_end] = att[:, :, rows, key_start:key_end]*weights.weight(m, map_rows)
+
+            if self.mask_cam:
+                #* 只留下前面 frame 的 image token
+                prev_end = 0
+                for key_start, key_end, _ in key_blocks:
+                    att[:, :, rows, prev_end:key_start] = float('-inf')
+                    prev_end = key_end
+                att[:, :, rows, prev_end:] = float('-inf')
+
+            if len(key_blocks) > 1:
+                #* 看多張 frame 時, 每張 frame 各自再做一次 softmax
+                for key_start, key_end, _ in key_blocks:
+                    att[:, :, rows, key_start:key_end] = F.softmax(att[:, :, rows, key_start:key_end], dim=-1)
+
+        return att, bi_epi_ratio
+
+    def epipolar_band(self, weight):
+        """
+        (B, R, n) epipolar weight of one key block -> the keys with weight >= self.sparse_epipolar
+        as (B, R, K) key index and weight (0 on the padding), K = widest row of the batch.
+        None if the band covers more than half the keys (e.g. rows whose epipolar line is out of
+        view are all 1), then the block is cheaper dense
+        """
+        in_band = weight >= self.sparse_epipolar
+        K = int(in_band.sum(dim=-1).max())
+        if K > weight.shape[-1] // 2:
+            return None
+        band_weight, index = weight.topk(max(K, 1), dim=-1)
+        return index, band_weight * (band_weight >= self.sparse_epipolar)
+
+    def sparse_epipolar_rows(self, att, q0, weights, return_ratio=False):
+        """
+        epipolar_rows() with the key blocks in band form: weights below self.sparse_epipolar count
+        as 0, so outside the band the weighted attention is exactly 0 (and after the per-frame
+        softmax one value per row). only the (B, nh, R, K) band is gathered, weighted and
+        normalized, the rest of the block is filled with that value. the partial softmax still
+        needs the normalizer over the whole block (logsumexp of the scores); bi_epi_ratio is
+        computed from the full block as in epipolar_rows
+        """
+        T_q = att.shape[2]
+
+        bi_epi_ratio = None
+        if return_ratio and self.epipolar == "bidirectional":
+            bi_epi_ratio = att.new_zeros(att.shape[0], T_q)
+
+        #* rows: att 中的 row, map_rows: epipolar map 中的 row
+        for rows, map_rows, key_blocks in self.layout.segments(q0, q0 + T_q):
+            multi = len(key_blocks) > 1
+
+            for b_i, (key_start, key_end, m) in enumerate(key_blocks):
+                scores = att[:, :, rows, key_start:key_end]
+                if att.requires_grad:
+                    #* 後面會 in-place 寫回 att, backward 要用的 score 先複製一份
+                    scores = scores.clone()
+                lse = torch.logsumexp(scores, dim=-1, keepdim=True)
+
+                if bi_epi_ratio is not None and b_i == len(key_blocks) - 1:
+                    #* 跟 epipolar_rows 一樣用 f12*b12 選出 epipolar 區域, 看最近一張 frame 的 attention
+                    att_block = (scores - lse).exp()
+                    bi_12_mask, bi_12_area = weights.ratio_mask(map_rows)
+                    att_mask_mean = (att_block * bi_12_mask).sum(dim=-1) / bi_12_area
+                    bi_epi_ratio[:, rows] = att_mask_mean.mean(dim=1) / att_block.mean(dim=-1).mean(dim=1)
+
+                weight = weights.weight(m, map_rows)
+                band = self.epipolar_band(weight[:, 0])
+                if band is None:
+                    att_block = (scores - lse).exp() * weight
+                    if multi:
+                        att_block = F.softmax(att_block, dim=-1)
+                else:
+                    index, band_weight = band
+                    index = index.unsqueeze(1).expand(-1, att.shape[1], -1, -1)
+                    band_att = (scores.gather(-1, index) - lse).exp() * band_weight.unsqueeze(1)
+                    outside = torch.zeros_like(lse)
+                    if multi:
+                        #* band 外的值都是 0, softmax 的分母裡各貢獻 exp(0) = 1
+                        band_att = band_att.exp()
+                        norm = band_att.sum(dim=-1, keepdim=True) + (key_end - key_start - index.shape[-1])
+                        band_att = band_att / norm
+                        outside = 1 / norm
+                    att_block = outside.expand_as(scores).scatter(-1, index, band_att)
+                att[:, :, rows, key_start:key_end] = att_block
+
+            if self.mask_cam:
+                #* 只留下前面 frame 的 image token
+                prev_end = 0
+                for key_start, key_end, _ in key_blocks:
+                    att[:, :, rows, prev_end:key_start] = float('-inf')
+                    prev_end = key_end
+                att[:, :, rows, prev_end:] = float('-inf')
+
+        return att, bi_epi_ratio
+
+    def decode_step(self, x, x_kv, k_buf, v_buf, cache, return_ratio=False):
+        """
+        forward_with_past for the single new position cache.pos with static shapes: k_buf / v_buf
+        are this layer's (B, nh, block_size, hs) buffers of the StaticKVCache, the query row is
+        scored against all block_size keys and the unwritten ones are dropped by the causal mask.
+        returns y (B, 1, C) and bi_epi_ratio (B, 1) if return_ratio is set
+        """
+        B, _, C = x.size()
+        pos = cache.pos
+
+        k = self.key(x_kv).view(B, 1, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, 1, hs)
+        q = self.query(x).view(B, 1, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, 1, hs)
+        v = self.value(x_kv).view(B, 1, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, 1, hs)
+        k_buf.index_copy_(2, pos, k.to(k_buf.dtype))
+        v_buf.index_copy_(2, pos, v.to(v_buf.dtype))
+
+        #* (B, nh, 1, hs) x (B, nh, hs, T) -> (B, nh, 1, T)
+        att = (q @ k_buf.transpose(-2, -1)).float() * (1.0 / math.sqrt(k.size(-1)))
+
+        if self.adaptive:
+            att = att + cache.h.index_select(2, pos)
+
+        bi_epi_ratio = None
+        if self.epipolar!=None:
+            att, bi_epi_ratio = self.epipolar_row(att, cache, return_ratio)
+
+        att = att.masked_fill(self.mask[0, 0].index_select(0, pos) == 0, float('-inf'))
+        att = F.softmax(att, dim=-1)
+        att = self.attn_drop(att)
+        y = att.to(v_buf.dtype) @ v_buf # (B, nh, 1, T) x (B, nh, T, hs) -> (B, nh, 1, hs)
+        y = y.transpose(1, 2).contiguous().view(B, 1, C)
+
+        y = self.resid_drop(self.proj(y))
+        return y, bi_epi_ratio
+
+    def epipolar_row(self, att, cache, return_ratio=False):
+        """
+        epipolar_rows() for the query row cache.pos: the partial softmax of every key block is a
+        softmax masked to the block, selected with torch.where only if the row uses that block,
+        so the same ops run for every position
+        """
+        pos = cache.pos
+        #* (G, T): 這個 row 要做 epipolar 的 key block
+        active = cache.key_groups & cache.row_groups.index_select(1, pos)
+
+        for sel in active:
+            att = torch.where(sel, F.softmax(att.masked_fill(~sel, float('-inf')), dim=-1), att)
+
+        bi_epi_ratio = None
+        if return_ratio:
+            bi_12_mask = cache.ratio_mask.index_select(1, pos).unsqueeze(1)   # (B, 1, 1, T)
+            ratio_keys = cache.ratio_keys.index_select(0, pos)                # (1, T)
+            att_mean = (att * ratio_keys).sum(dim=-1) / ratio_keys.sum(dim=-1)
+            att_mask_mean = (att * bi_12_mask).sum(dim=-1) / bi_12_mask.sum(dim=-1)
+            bi_epi_ratio = att_mask_mean.mean(dim=1) / att_mean.mean(dim=1)
+
+        att = att * cache.epi_mult.index_select(1, pos).unsqueeze(1)
+
+        if self.mask_cam:
+            #* 只留下前面 frame 的 image token
+            att = att.masked_fill(cache.row_epipolar.index_select(0, pos) & ~active.any(0), float('-inf'))
+
+        #* 看多張 frame 時, 每張 frame 各自再做一次 softmax
+        multi = cache.row_multi.index_select(0, pos)
+        for sel in active:
+            sel = sel & multi
+            att = torch.where(sel, F.softmax(att.masked_fill(~sel, float('-inf')), dim=-1), att)
+
+        return att, bi_epi_ratio
+
 class Block(nn.Module):
     """ an unassuming Transformer block """
     def __init__(self, config, adaptive,epipolar=None,do_blur=False,mask_cam=False,selfremain=False):
@@ -383,21 +1292,36 @@ class Block(nn.Module):
         )
         self.selfremain = selfremain
 
-    def forward(self, x,x_kv, p,forward_map=None,backward_map=None,return_attn=False):
+    def forward(self, x,x_kv, p,forward_map=None,backward_map=None,return_attn=False,layer_past=None,return_ratio=False,capture=None,
+                epipolar_weights=None,inference=False):
         out, epipolar_attn_map, attn_weight,attn_weight_for,bi_epi_ratio = self.attn(self.ln1(x),self.ln1(x_kv),p,
+                                layer_past = layer_past,
                                 forward_map = forward_map,
                                 backward_map = backward_map,
-                                return_attn = return_attn)
+                                return_attn = return_attn,
+                                return_ratio = return_ratio,
+                                capture = capture,
+                                epipolar_weights = epipolar_weights,
+                                inference = inference)
         if self.selfremain:
             #* epipolar cross attend
             #* 想法是在epipolar時只做要生成image的部分, 其他維持self attend 的結果
             #* 其實沒啥道理, 亂槍打鳥試試看
-            out[:,0:285,:] = x[:,0:285,:]
-            out[:,541:571,:] = x[:,541:571,:]
+            q0 = 0 if layer_past is None else len(layer_past) - x.shape[1]
+            for start, end in self.attn.layout.context_rows():
+                out[:,max(start-q0,0):max(end-q0,0),:] = x[:,max(start-q0,0):max(end-q0,0),:]
         
         x = x + out
         x = x + self.mlp(self.ln2(x))
         return x, epipolar_attn_map, attn_weight,attn_weight_for,bi_epi_ratio
+
+    def decode_step(self, x, x_kv, k_buf, v_buf, cache, return_ratio=False):
+        #* decode 的 position 都在 image token 上, selfremain 換回去的 row (condition / camera) 不會出現
+        out, bi_epi_ratio = self.attn.decode_step(self.ln1(x), self.ln1(x_kv), k_buf, v_buf, cache,
+                                                  return_ratio = return_ratio)
+        x = x + out
+        x = x + self.mlp(self.ln2(x))
+        return x, bi_epi_ratio
     
 class Block_cross(nn.Module):
     """ an unassuming Transformer block """
@@ -430,24 +1354,35 @@ class GPT(nn.Module):
     def __init__(self, vocab_size, block_size, time_len, n_layer=12, n_head=8, n_embd=256,
                  embd_pdrop=0., resid_pdrop=0., attn_pdrop=0., n_unmasked=0,
                  input_vocab_size=None,epipolar=None,do_cross=False,sep_pe = False,
-                 two_cond = False,do_blur=False,mask_cam=False,srcimg_pe=True,selfremain=False):
+                 two_cond = False,do_blur=False,mask_cam=False,srcimg_pe=True,selfremain=False,
+                 checkpoint_every=0,sparse_epipolar=None,fused_epipolar=True,sdpa=True,
+                 attn_chunk_size=None,attn_memory_mb=None):
         super().__init__()
+        #* 每個 frame / camera token 的位置, 以及哪些 frame pair 要做 locality / epipolar
+        layout = SequenceLayout(time_len)
+        assert block_size == layout.block_size, f"block_size {block_size} does not match time_len {time_len} ({layout.block_size})"
         config = GPTConfig(vocab_size=vocab_size, block_size=block_size,
                            embd_pdrop=embd_pdrop, resid_pdrop=resid_pdrop, attn_pdrop=attn_pdrop,
                            n_layer=n_layer, n_head=n_head, n_embd=n_embd,
-                           n_unmasked=n_unmasked,two_cond = two_cond)
+                           n_unmasked=n_unmasked,two_cond = two_cond,
+                           sparse_epipolar=sparse_epipolar, fused_epipolar=fused_epipolar, sdpa=sdpa,
+                           attn_chunk_size=attn_chunk_size, attn_memory_mb=attn_memory_mb,
+                           layout=layout)
+        self.layout = layout
         # input embedding stem
         in_vocab_size = vocab_size if not input_vocab_size else input_vocab_size
         self.tok_emb = nn.Embedding(in_vocab_size, config.n_embd)
         
         # Locality
-        self.locality = AdaptiveAttention(config.block_size)
+        self.locality = AdaptiveAttention(config.block_size, layout=layout)
         
         # init pos embedding
         self.time_len = time_len
-        self.frame_emb = nn.Parameter(torch.zeros(1, 256, config.n_embd))
-        self.camera_emb = nn.Parameter(torch.zeros(1, 30, config.n_embd))
+        self.frame_emb = nn.Parameter(torch.zeros(1, layout.img_dim, config.n_embd))
+        self.camera_emb = nn.Parameter(torch.zeros(1, layout.camera_dim, config.n_embd))
         self.role_emb = None
+        #* 每個 position 在 cat([frame_emb, camera_emb]) 裡的 index, 不存進 checkpoint
+        self.register_buffer("role_index", layout.role_index, persistent=False)
         
         self.time_emb = nn.Parameter(data=get_sinusoid_encoding(n_position=block_size, d_hid=config.n_embd), requires_grad=False)
         
@@ -485,9 +1420,88 @@ class GPT(nn.Module):
         self.config = config
         logger.info("number of parameters: %e", sum(p.numel() for p in self.parameters()))
 
+        #* 要看的 attention map (AttentionCapture), 沒有註冊就完全不做額外計算
+        self.attn_hooks = []
+        #* sampling 用的 StaticDecoder, 依 (mode, batch, device) 存著重複用
+        self.static_decoders = {}
+
+        #* training 時每 checkpoint_every 個 block 做一次 activation checkpointing, 0 = 不做
+        #* 中間的 activation (含每層 T×T 的 attention) 不存, backward 時重算, 用時間換 batch size
+        self.checkpoint_every = checkpoint_every
+
+        #* sampling 時的 epipolar map cache (EpipolarCache), None = 每次重算
+        self.epipolar_cache = None
+        #* 上一次 test / test_with_past 的 EpipolarWeights, 同一組 map 進來 (同一張 frame 的每一步) 就直接用
+        self.last_epipolar_weights = None
+        #* 上一次 test / test_with_past 的 LocalityBias, 同一組 camera 參數 (同一張 frame 的每一步) 就直接用
+        self.last_locality_bias = None
+
     def get_block_size(self):
         return self.block_size
 
+    def position_embeddings(self, t0, t):
+        """ role_emb + time_emb of positions t0:t, (1, t-t0, n_embd) """
+        role_emb = torch.cat([self.frame_emb, self.camera_emb], 1)
+        return role_emb[:, self.role_index[t0:t]] + self.time_emb[:, t0:t]
+
+    def epipolar_weights(self, forward_map, backward_map):
+        """ EpipolarWeights of the maps for all epipolar layers, reused while the same map tensors come in """
+        if self.epipolar == None:
+            return None
+        weights = self.last_epipolar_weights
+        if weights is None or not weights.matches(forward_map, backward_map):
+            weights = EpipolarWeights(self.epipolar, forward_map, backward_map, self.layout.ratio_pair)
+            self.last_epipolar_weights = weights
+        return weights
+
+    def locality_bias(self, p):
+        """
+        LocalityBias of the camera params p for the adaptive layers, reused while the same p tensors
+        come in (sampling, no gradients). None for the epipolar models, they have no adaptive layer
+        """
+        if self.epipolar != None:
+            return None
+        if torch.is_grad_enabled():
+            return self.locality(*p)
+        bias = self.last_locality_bias
+        if bias is None or not bias.matches(p):
+            bias = self.locality(*p)
+            self.last_locality_bias = bias
+        return bias
+
+    def set_sparse_epipolar(self, threshold=None):
+        """ epipolar weight threshold of the sparse epipolar attention of every block, None = dense """
+        for block in self.blocks:
+            block.attn.sparse_epipolar = threshold
+
+    def set_attn_chunking(self, chunk_size=None, memory_mb=None):
+        """
+        query-chunked attention (no_grad only) of every attention layer: at most chunk_size query rows
+        per tile, and tiles small enough for memory_mb of attention scores. None, None = whole att at once
+        """
+        for module in self.modules():
+            if isinstance(module, (CausalSelfAttention, cross_Attention)):
+                module.attn_chunk_size = chunk_size
+                module.attn_memory_mb = memory_mb
+
+    def register_attn_hook(self, layer, kind="weight", step=None, head=None):
+        """ keep the kind attention map of block layer (head, decode step) in test(), see AttentionCapture """
+        hook = AttentionCapture(layer, kind=kind, step=step, head=head)
+        self.attn_hooks.append(hook)
+        return hook
+
+    def remove_attn_hook(self, hook):
+        self.attn_hooks.remove(hook)
+
+    def wants_attn(self, step):
+        return any(hook.step is None or hook.step == step for hook in self.attn_hooks)
+
+    def attn_captures(self, layer, step):
+        captures = [hook for hook in self.attn_hooks if hook.match(layer, step)]
+        for hook in captures:
+            hook.current_step = step
+        return captures
+
     def _init_weights(self, module):
         if isinstance(module, (nn.Linear, nn.Embedding)):
             module.weight.data.normal_(mean=0.0, std=0.02)
@@ -498,6 +1512,79 @@ class GPT(nn.Module):
             module.weight.data.fill_(1.0)
 
     def get_epipolar_tensor(self,b,h,w,k,src_w2c,target_w2c):
+        """ (b, hw, hw) epipolar map of one camera pair, see get_epipolar_tensors """
+        return self.get_epipolar_tensors(h, w, k, src_w2c[:, None], target_w2c[:, None])[:, 0]
+
+    @full_precision
+    def get_epipolar_tensors(self, h, w, k, src_w2c, target_w2c, steep=5, offset=0.75):
+        """
+        epipolar maps of P camera pairs in one call: k (B,3,3) or (B,4,4), src_w2c / target_w2c
+        (B,P,4,4), returns (B,P,hw,hw), row = target pixel, column = src pixel.
+        closed form of get_epipolar_tensor_pairwise: the target pixel c_i goes through the same
+        unprojection / projection as there, but only as the line l_i = e x (A c_i) = F c_i in the
+        src image (e: projected target camera center, A c_i: projected ray direction). the distance
+        of every src pixel c_j to it is |l_i . c_j| / |l_i[:2]|, one (hw,3) x (3,hw) matmul per pair,
+        no (hw*hw,3) tensors
+        """
+        H = h
+        W = H*16/9  #* 原始圖像為 16:9
+
+        #* unormalize intrinsic, 跟 pairwise 版本一樣 principal point 固定在 h/2
+        k = k.to(dtype=torch.float32)[:, None, 0:3, 0:3]
+        k = k * k.new_tensor([W, H, 1.]).view(1, 1, 3, 1)   #* (B,1,3,3), 新的 tensor, 可以直接改
+        k[..., 0, 2] = h/2
+        k[..., 1, 2] = h/2
+        src_w2c = src_w2c.to(dtype=torch.float32)
+        target_w2c = target_w2c.to(dtype=torch.float32)
+
+        fx = k[..., 0, 0]
+        fy = k[..., 1, 1]
+        zero = torch.zeros_like(fx)
+        one = torch.ones_like(fx)
+        #* pixel -> 相機平面座標 (跟 pairwise 版本一樣不管 skew)
+        k_norm_inv = torch.stack([1/fx, zero, -(h/2)/fx,
+                                  zero, 1/fy, -(h/2)/fy,
+                                  zero, zero, one], -1).view(*fx.shape, 3, 3)
+
+        src_w2c_r = src_w2c[..., 0:3, 0:3]
+        src_w2c_t = src_w2c[..., 0:3, 3:4]
+        target_c2w_r = target_w2c[..., 0:3, 0:3].transpose(-1, -2)   #* rotation 的 inverse
+        target_c2w_t = -target_w2c[..., 0:3, 3:4]
+
+        #* target pixel 的 ray 方向投到 src 平面 (A), 跟 target 相機中心投到 src 平面 (epipole e)
+        ray = k @ src_w2c_r @ target_c2w_r @ k_norm_inv                 #* (B,P,3,3)
+        e = (k @ (src_w2c_r @ target_c2w_t + src_w2c_t))[..., 0]       #* (B,P,3)
+        e_cross = torch.stack([zero.expand_as(e[..., 0]), -e[..., 2], e[..., 1],
+                               e[..., 2], zero.expand_as(e[..., 0]), -e[..., 0],
+                               -e[..., 1], e[..., 0], zero.expand_as(e[..., 0])], -1).view(*e.shape[:-1], 3, 3)
+        fundamental = e_cross @ ray                                     #* (B,P,3,3)
+
+        #* h*w 的 pixel 座標 (u, v, 1), flatten 順序跟 pairwise 版本一樣
+        y_coords, x_coords = torch.meshgrid(torch.arange(h), torch.arange(w))
+        coords = torch.stack((x_coords.flatten(), y_coords.flatten(), torch.ones_like(x_coords).flatten()), dim=1)
+        coords = coords.to(device=k.device, dtype=torch.float32)        #* (hw,3)
+
+        lines = coords @ fundamental.transpose(-1, -2)                  #* (B,P,hw,3) 每個 target pixel 的 epipolar line
+        distance = (lines @ coords.t()).abs() / lines[..., 0:2].norm(dim=-1, keepdim=True)
+
+        #* 5 0.75 flexible epipolar, 希望epipolar 可以多看一點
+        epipolar_map = 1 - torch.sigmoid(steep*(distance-offset))
+
+        #* epipolar line 不在畫面內 (整個 row 最大權重 < 0.5) 就整個 row 都看
+        max_values, _ = torch.max(epipolar_map, dim=-1, keepdim=True)
+        epipolar_map = epipolar_map.masked_fill(max_values < 0.5, 1)
+
+        return epipolar_map
+
+    def cached_epipolar_tensors(self, h, w, k, src_w2c, target_w2c):
+        """ get_epipolar_tensors through self.epipolar_cache when one is set """
+        if self.epipolar_cache is None:
+            return self.get_epipolar_tensors(h, w, k, src_w2c, target_w2c)
+        return self.epipolar_cache(self, h, w, k, src_w2c, target_w2c)
+
+    @full_precision
+    def get_epipolar_tensor_pairwise(self,b,h,w,k,src_w2c,target_w2c):
+        """ original pairwise version of get_epipolar_tensor, kept as the reference of the closed form """
         H = h
         W = H*16/9  #* 原始圖像為 16:9
 
@@ -621,7 +1708,7 @@ class GPT(nn.Module):
 
         return epipolar_map
     
-    def iter_forward(self, dc_emb, z_emb, p,k=None,w2c=None, embeddings=None, targets=None, return_layers=False):
+    def iter_forward(self, dc_emb, z_emb, p,k=None,w2c=None, embeddings=None, targets=None, return_layers=False, epipolar_maps=None):
         
         token_embeddings_dc = dc_emb
 
@@ -636,22 +1723,11 @@ class GPT(nn.Module):
         t = token_embeddings.shape[1]
         assert t <= self.block_size, "Cannot forward, model block size is exhausted."
         
-        role_emb = []
-        for _ in range(self.time_len-1):
-            role_emb.append(self.frame_emb)
-            role_emb.append(self.camera_emb)
-
-        role_emb.append(self.frame_emb)
-        role_emb = torch.cat(role_emb, 1)
-
-        #* role emb shape (1,828,1024), 但是取前827個
-        #* time emb shape (1,827,1024)
-        
-        role_embeddings = role_emb[:, :t, :] # each position maps to a (learnable) vector
-        time_embeddings = self.time_emb[:, :t, :] # each position maps to a (learnable) vector
+        #* role emb + time emb, shape (1,827,1024)
+        position_embeddings = self.position_embeddings(0, t) # each position maps to a (learnable) vector
         
         #* x shape (B,827,1024)
-        x = token_embeddings + role_embeddings + time_embeddings
+        x = token_embeddings + position_embeddings
 
         origin_x = x.clone()
 
@@ -663,48 +1739,53 @@ class GPT(nn.Module):
             return layers
         
         #* 計算epipolar map [forward,backward,bidirectional,token_change]
-        batch = x.shape[0]
         forward_epipolar_map = None
         backward_epipolar_map = None
-        if self.epipolar!=None:
+        n_pairs = len(self.layout.pairs)
+        if self.epipolar!=None and epipolar_maps is not None:
+            #* dataset 先算好的 (B,6,hw,hw), 順序 f01 f02 f12 b01 b02 b12 (src.data.epipolar.EPIPOLAR_PAIRS)
+            if epipolar_maps.dtype == torch.uint8:
+                epipolar_maps = epipolar_maps.to(torch.float32) / 255
+            epipolar_maps = list(epipolar_maps.to(torch.float32).unbind(1))
+            if self.epipolar == 'forward' or self.epipolar == 'bidirectional':
+                forward_epipolar_map = epipolar_maps[:n_pairs]
+            if self.epipolar == 'backward' or self.epipolar == 'bidirectional':
+                backward_epipolar_map = epipolar_maps[-n_pairs:]
+        elif self.epipolar!=None:
+            #* 要用到的 camera pair 一次算完: forward (f01,f02,f12), backward (b01,b02,b12), 順序跟 layout.pairs 一樣
+            src_w2c, target_w2c = [], []
             if self.epipolar == 'forward' or self.epipolar == 'bidirectional':
-                # forward_epipolar_map = get_epipolar_tensor(1,h,h,k2.clone(),prev_w2c,now_w2c)
-                
-                w2c_0 = w2c[:,0]
-                w2c_1 = w2c[:,1]
-                w2c_2 = w2c[:,2]
-                f01 = self.get_epipolar_tensor(batch,16,16,k.clone(),w2c_0,w2c_1)
-                f02 = self.get_epipolar_tensor(batch,16,16,k.clone(),w2c_0,w2c_2)
-                f12 = self.get_epipolar_tensor(batch,16,16,k.clone(),w2c_1,w2c_2)
-                forward_epipolar_map = [f01,f02,f12]
+                src_w2c += [w2c[:,s] for s, _ in self.layout.pairs]
+                target_w2c += [w2c[:,t] for _, t in self.layout.pairs]
             if self.epipolar == 'backward' or self.epipolar == 'bidirectional':
-                # forward_epipolar_map = get_epipolar_tensor(1,h,h,k2.clone(),prev_w2c,now_w2c)
-                w2c_0 = w2c[:,0]
-                w2c_1 = w2c[:,1]
-                w2c_2 = w2c[:,2]
-                b01 = self.get_epipolar_tensor(batch,16,16,k.clone(),w2c_1,w2c_0)
-                b02 = self.get_epipolar_tensor(batch,16,16,k.clone(),w2c_2,w2c_0)
-                b12 = self.get_epipolar_tensor(batch,16,16,k.clone(),w2c_2,w2c_1)
-                backward_epipolar_map = [b01,b02,b12]
+                src_w2c += [w2c[:,t] for _, t in self.layout.pairs]
+                target_w2c += [w2c[:,s] for s, _ in self.layout.pairs]
+            epipolar_maps = list(self.get_epipolar_tensors(16,16,k,torch.stack(src_w2c,1),torch.stack(target_w2c,1)).unbind(1))
+            if self.epipolar == 'forward' or self.epipolar == 'bidirectional':
+                forward_epipolar_map = epipolar_maps[:n_pairs]
+            if self.epipolar == 'backward' or self.epipolar == 'bidirectional':
+                backward_epipolar_map = epipolar_maps[-n_pairs:]
 
         # locality
-        p1, p2, p3 = p
-        h = self.locality(p1, p2, p3)
-        # h = h.repeat(x.shape[0], 1, 1, 1)
+        h = self.locality(*p)
 
+        #* 每個 batch 的 map 都不一樣, 不用 last_epipolar_weights, 只在這次 forward 的 layer 之間共用
+        epipolar_weights = None
         if self.epipolar!=None:
-            for i in range(len(self.blocks)):
-                if i%2==0:
-                    x,_,_,_ = self.blocks[i](x, origin_x,h,
-                                            forward_map = forward_epipolar_map,
-                                            backward_map = backward_epipolar_map)
-                else:
-                    x,_,_,_ = self.blocks[i](x, x, h,
-                                            forward_map = forward_epipolar_map,
-                                            backward_map = backward_epipolar_map)
-        else:
-            for block in self.blocks:
-                x = block(x, h,forward_map = forward_epipolar_map,backward_map = backward_epipolar_map)
+            epipolar_weights = EpipolarWeights(self.epipolar, forward_epipolar_map, backward_epipolar_map, self.layout.ratio_pair)
+
+        n_blocks = len(self.blocks)
+        every = self.checkpoint_every if self.training and torch.is_grad_enabled() else 0
+        for start in range(0, n_blocks, every or n_blocks):
+            end = min(start + (every or n_blocks), n_blocks)
+            if every:
+                #* epipolar map 不需要 gradient, 用 partial 綁進去; x / origin_x / locality 的 block 要 gradient, 當 checkpoint 的 input
+                run = functools.partial(self.run_blocks_checkpoint, start, end, h.offsets,
+                                        epipolar_weights = epipolar_weights)
+                x = checkpoint(run, x, origin_x, *h.blocks, **checkpoint_kwargs)
+            else:
+                x = self.run_blocks(start, end, x, origin_x, h,
+                                    epipolar_weights = epipolar_weights)
         
         # x = self.blocks(x)
         x = self.ln_f(x)
@@ -717,10 +1798,25 @@ class GPT(nn.Module):
             
         return logits, loss
     
+    def run_blocks(self, start, end, x, origin_x, h, epipolar_weights=None):
+        """ blocks start:end of iter_forward, the epipolar (even) blocks take their keys / values from origin_x """
+        for i in range(start, end):
+            x_kv = origin_x if self.epipolar!=None and i%2==0 else x
+            x,_,_,_,_ = self.blocks[i](x, x_kv, h,
+                                    epipolar_weights = epipolar_weights)
+        return x
+
+    def run_blocks_checkpoint(self, start, end, offsets, x, origin_x, *blocks, epipolar_weights=None):
+        """ run_blocks for checkpoint(): the locality bias comes in as its block tensors, so they get gradients """
+        return self.run_blocks(start, end, x, origin_x, LocalityBias(offsets, list(blocks)),
+                               epipolar_weights = epipolar_weights)
+
     def test(self, dc_emb, z_indices, p,forward_epipolar_map=None,backward_epipolar_map=None, embeddings=None, 
              targets=None, return_layers=False, return_bias=False,
-                return_attn = False
+                return_attn = False, positions=None, step=None, inference=False
              ):
+        #* inference: sampling 用, layer 只算最後的 attention weight, bi_epi_ratio 只在最後一個 epipolar layer
+        #* 而且剛好生成完一張 frame 時才算; 有 return_attn / 註冊的 attention map 的 layer 還是走原本完整的版本
         token_embeddings_dc = dc_emb
 
         # add the token embedding with z_indices
@@ -733,25 +1829,14 @@ class GPT(nn.Module):
         t = token_embeddings.shape[1]
         assert t <= self.block_size, "Cannot forward, model block size is exhausted."
         
-        role_emb = []
-        for _ in range(self.time_len-1):
-            role_emb.append(self.frame_emb)
-            role_emb.append(self.camera_emb)
-
-        role_emb.append(self.frame_emb)
-        role_emb = torch.cat(role_emb, 1)
-        
-        role_embeddings = role_emb[:, :t, :] # each position maps to a (learnable) vector
-        time_embeddings = self.time_emb[:, :t, :] # each position maps to a (learnable) vector
+        position_embeddings = self.position_embeddings(0, t) # each position maps to a (learnable) vector
         
-        x = token_embeddings + role_embeddings + time_embeddings
+        x = token_embeddings + position_embeddings
 
         origin_x = x.clone()
 
-        # locality
-        p1, p2, p3 = p
-        h = self.locality(p1, p2, p3)
-        h = h.repeat(x.shape[0], 1, 1, 1) #* (1,1,827,827)
+        # locality, 同一張 frame 的每一步共用 (p 的 batch 是 1 時對整個 batch broadcast)
+        h = self.locality_bias(p)
         
         #* x shape (1,286,1024)
         #* f01 shape (1,256,256)
@@ -764,25 +1849,38 @@ class GPT(nn.Module):
 
         bi_epi_ratio = None
         if self.epipolar!=None:
+            epipolar_weights = self.epipolar_weights(forward_epipolar_map, backward_epipolar_map)
+            #* bi_epi_ratio 取最後一個 epipolar layer
+            ratio_layer = len(self.blocks) - 2
             for i in range(len(self.blocks)):
                 if i%2==0:
                     x, epipolar_attn_map,attn_weight,attn_weight_for,ratio = self.blocks[i](x, origin_x,h,
                                             forward_map = forward_epipolar_map,
                                             backward_map = backward_epipolar_map,
-                                            return_attn = return_attn
+                                            epipolar_weights = epipolar_weights,
+                                            return_attn = return_attn,
+                                            return_ratio = i == ratio_layer,
+                                            capture = self.attn_captures(i, step) if self.attn_hooks else None,
+                                            inference = inference
                                             )
                     attn_weights.append(attn_weight)
                     attn_weights_for.append(attn_weight_for)
                     epipolar_attn_maps.append(epipolar_attn_map)
-                    bi_epi_ratio = ratio
+                    if i == ratio_layer:
+                        bi_epi_ratio = ratio
                 else:
                     x,_,_,_,_ = self.blocks[i](x, x, h,
                                             forward_map = forward_epipolar_map,
-                                            backward_map = backward_epipolar_map)
+                                            backward_map = backward_epipolar_map,
+                                            capture = self.attn_captures(i, step) if self.attn_hooks else None)
         else:
-            for block in self.blocks:
-                x,_,_,_ = block(x,x, h,forward_map = forward_epipolar_map,backward_map = backward_epipolar_map)
+            for i, block in enumerate(self.blocks):
+                x,_,_,_,_ = block(x,x, h,forward_map = forward_epipolar_map,backward_map = backward_epipolar_map,
+                                  capture = self.attn_captures(i, step) if self.attn_hooks else None)
             
+        #* 只把需要的 position 過 ln_f / head (例如 slice(-1, None)), 不用每一步都算 (B,T,16384)
+        if positions is not None:
+            x = x[:, positions]
         x = self.ln_f(x)
         logits = self.head(x)
 
@@ -797,6 +1895,93 @@ class GPT(nn.Module):
         else:
             return logits, loss
 
+    @torch.no_grad()
+    def test_with_past(self, dc_emb, z_indices, p, forward_epipolar_map=None, backward_epipolar_map=None,
+                       past=None, embeddings=None, positions=None):
+        """
+        incremental version of test(). the first call (past=None) runs the condition dc_emb
+        followed by z_indices and creates the KVCache, later calls only pass the newly sampled
+        z_indices together with the cache, so each step only computes the newest query rows.
+        positions picks which of the new positions get logits (e.g. slice(-1, None)), None = all.
+        returns the logits of the new positions, the cache and bi_epi_ratio (only on the step
+        that completes a frame, same as test())
+        """
+        assert not self.training
+
+        token_embeddings = self.tok_emb(z_indices)
+        if past is None:
+            token_embeddings = torch.cat([dc_emb, token_embeddings], 1)
+            if embeddings is not None:  # prepend explicit embeddings
+                token_embeddings = torch.cat((embeddings, token_embeddings), dim=1)
+            past = KVCache(len(self.blocks), token_embeddings.shape[0], self.block_size, token_embeddings.device)
+            # locality, 整個 frame 都一樣只算一次
+            past.h = self.locality_bias(p)
+
+        t0 = past.length
+        t = t0 + token_embeddings.shape[1]
+        assert t <= self.block_size, "Cannot forward, model block size is exhausted."
+
+        x = token_embeddings + self.position_embeddings(t0, t)
+        origin_x = x
+
+        #* 跟 test() 一樣, bi_epi_ratio 取最後一個 epipolar layer
+        ratio_layer = len(self.blocks) - 2 if self.epipolar == "bidirectional" else None
+        epipolar_weights = self.epipolar_weights(forward_epipolar_map, backward_epipolar_map)
+        for i, block in enumerate(self.blocks):
+            x_kv = origin_x if (self.epipolar != None and i%2==0) else x
+            x,_,_,_,ratio = block(x, x_kv, past.h,
+                                  forward_map = forward_epipolar_map,
+                                  backward_map = backward_epipolar_map,
+                                  epipolar_weights = epipolar_weights,
+                                  layer_past = past.layers[i],
+                                  return_ratio = i == ratio_layer)
+            if i == ratio_layer:
+                past.ratio[:, t0:t] = ratio
+        past.length = t
+
+        if positions is not None:
+            x = x[:, positions]
+        x = self.ln_f(x)
+        logits = self.head(x)
+
+        bi_epi_ratio = None
+        rows = self.layout.completed_frame(t)
+        if ratio_layer is not None and rows is not None:
+            bi_epi_ratio = past.ratio[:, rows[0]:rows[1]]
+
+        return logits, past, bi_epi_ratio
+
+    def decode_step(self, idx, cache):
+        """
+        static-shape version of test_with_past for one new token per sample: idx (B, 1) sits at
+        position cache.pos of the StaticKVCache, its keys / values are written into the cache and
+        the (B, 1, vocab) logits of the next position are returned. cache.pos is advanced in place,
+        nothing here depends on its value on the host
+        """
+        pos = cache.pos
+        x = self.tok_emb(idx) + cache.pos_emb.index_select(0, pos)
+        origin_x = x
+
+        #* 跟 test_with_past 一樣, bi_epi_ratio 取最後一個 epipolar layer
+        ratio_layer = len(self.blocks) - 2 if self.epipolar == "bidirectional" else None
+        for i, block in enumerate(self.blocks):
+            x_kv = origin_x if (self.epipolar != None and i%2==0) else x
+            x, ratio = block.decode_step(x, x_kv, cache.k[i], cache.v[i], cache,
+                                         return_ratio = i == ratio_layer)
+            if i == ratio_layer:
+                cache.ratio.index_copy_(1, pos, ratio)
+
+        logits = self.head(self.ln_f(x))
+        cache.pos.add_(1)
+        return logits
+
+    def static_decoder(self, mode, batch, device):
+        """ StaticDecoder for (mode, batch, device), built once and reused so compiled / captured steps stay valid """
+        key = (mode, batch, str(device))
+        if key not in self.static_decoders:
+            self.static_decoders[key] = StaticDecoder(self, batch, device, mode=mode)
+        return self.static_decoders[key]
+
 class DummyGPT(nn.Module):
     # for debugging
     def __init__(self, add_value=1):
@@ -806,6 +1991,22 @@ class DummyGPT(nn.Module):
     def forward(self, idx):
         return idx + self.add_value, None
 
+#### quantization
+def quantize_gpt(model, dtype=torch.qint8):
+    """
+    int8 copy of a GPT for sampling on x86 CPUs: dynamic quantization (int8 weights, activations
+    quantized per call) of every nn.Linear in the transformer blocks (key/query/value/proj and
+    the mlp) and of the output head. embeddings, the locality fc and the layer norms stay fp32.
+    model itself is left untouched
+    """
+    names = set()
+    for name, module in model.named_modules():
+        if isinstance(module, nn.Linear) and (name.startswith("blocks.") or name == "head"):
+            names.add(name)
+
+    quantized = copy.deepcopy(model).cpu().eval()
+    return torch.quantization.quantize_dynamic(quantized, names, dtype=dtype)
+
 #### sampling utils
 def top_k_logits(logits, k):
     v, ix = torch.topk(logits, k)
@@ -813,6 +2014,41 @@ def top_k_logits(logits, k):
     out[out < v[:, [-1]]] = -float('Inf')
     return out
 
+def sample_logits(logits, temperature=1.0, top_k=None, sample=False, return_prob=False):
+    """
+    temperature + top-k + greedy / multinomial in one step over the last dim of logits (any
+    leading shape), without cloning or -inf masking the whole vocabulary: top-k only keeps the
+    k candidates, greedy is a plain argmax. everything stays on the logits' device.
+    returns the sampled indices (leading shape) and, with return_prob, their probability under
+    the tempered top-k distribution
+    """
+    shape = logits.shape[:-1]
+    logits = logits.reshape(-1, logits.shape[-1])
+
+    candidates = None
+    if top_k is not None:
+        logits, candidates = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1)
+
+    prob = None
+    if sample:
+        probs = F.softmax(logits / temperature, dim=-1)
+        ix = torch.multinomial(probs, num_samples=1)
+        if return_prob:
+            prob = probs.gather(-1, ix)
+    else:
+        ix = logits.argmax(dim=-1, keepdim=True)
+        if return_prob:
+            scaled = logits / temperature
+            prob = torch.exp(scaled.gather(-1, ix) - scaled.logsumexp(dim=-1, keepdim=True))
+
+    if candidates is not None:
+        ix = candidates.gather(-1, ix)
+
+    ix = ix.reshape(shape)
+    if return_prob:
+        return ix, prob.reshape(shape)
+    return ix
+
 @torch.no_grad()
 def sample(model, x, steps, temperature=1.0, sample=False, top_k=None):
     """